@@ -7,6 +7,7 @@
 """Main function for the project. See the help message."""
 
 import argparse
+import json
 import logging
 import os
 import sys
@@ -42,6 +43,11 @@ LANG_TABLE = {
 }
 
 
+# Kinds of game objects that can be exported
+ALL_OBJECTS = ['engines', 'missilelaunchers', 'shields', 'ships', 'wares',
+               'weapons']
+
+
 HELP_MESSAGE = """./X4FProjector -g path/to/x4_foundations/ export all \
 -d ./x4-projected -f csv
 
@@ -90,30 +96,11 @@ def cmd_resolve_strings(lresolver, resolve_strings):
     return 0
 
 
-def cmd_export(floader, lresolver, macro_db, export_objects, export_dir,
-               export_format):
-    """Handle export command."""
-
-    objects = set(obj.strip().lower() for obj in export_objects)
-
-    if 'all' in objects:
-        objects = set(['engines', 'shields', 'ships', 'wares', 'weapons',
-                       'missilelaunchers'])
-        LOG.info('Exportint stats for all game objects: %s',
-                 ', '.join(sorted(objects)))
-    else:
-        LOG.info('Exporting stats for %s', ', '.join(sorted(objects)))
-
-    wares = None
-
-    export_format = export_format.strip().lower()
-    file_extension = exporters.AutoFormatter.get_extension(export_format)
-
-    def make_path(obj):
-        return os.path.normpath(os.path.join(
-            export_dir, '{}.{}'.format(obj, file_extension)
-        ))
-
+def load_objects(floader, lresolver, macro_db, objects):
+    """Load game objects of the given kinds from the base game and all the
+    extensions. Macros are loaded into macro_db.
+    Returns the dictionary of loaded wares.
+    """
     wares = {}
 
     for ext_name in [None] + floader.get_extensions():
@@ -136,6 +123,34 @@ def cmd_export(floader, lresolver, macro_db, export_objects, export_dir,
 
         macro_db.resolve_dependencies()
 
+    return wares
+
+
+def cmd_export(floader, lresolver, macro_db, export_objects, export_dir,
+               export_format):
+    """Handle export command."""
+
+    objects = set(obj.strip().lower() for obj in export_objects)
+
+    if 'all' in objects:
+        objects = set(ALL_OBJECTS)
+        LOG.info('Exportint stats for all game objects: %s',
+                 ', '.join(sorted(objects)))
+    else:
+        LOG.info('Exporting stats for %s', ', '.join(sorted(objects)))
+
+    export_format = export_format.strip().lower()
+    file_extension = exporters.AutoFormatter.get_extension(export_format)
+
+    def make_path(obj):
+        return os.path.normpath(os.path.join(
+            export_dir, '{}.{}'.format(obj, file_extension)
+        ))
+
+    # only parse the properties of the macros that are exported
+    macro_db.set_wanted_types(loaders.get_macro_types(objects))
+    wares = load_objects(floader, lresolver, macro_db, objects)
+
     for obj in objects:
         dest = make_path(obj)
 
@@ -155,10 +170,91 @@ def cmd_export(floader, lresolver, macro_db, export_objects, export_dir,
     return 0
 
 
-# pylint: disable=too-many-arguments
+def cmd_pack(floader, lresolver, pack_path, compress):
+    """Handle pack command."""
+    recorder = file_loaders.RecordingFileLoader(floader)
+
+    # pack all the languages, not only the one in use
+    for lang_file_path in LANG_TABLE:
+        if recorder.file_exists(lang_file_path):
+            with recorder.open_file(lang_file_path):
+                pass
+
+    macro_db = macros.MacroDB(recorder)
+    load_objects(recorder, lresolver, macro_db, ALL_OBJECTS)
+
+    # lazily loaded macros read their files only when they are used, which
+    # an export can do
+    macro_db.load_properties()
+
+    count = file_loaders.write_pack_file(pack_path, floader, recorder.paths,
+                                         recorder.dirs, compress=compress)
+    LOG.info('Packed %d game files into %s', count, pack_path)
+
+    return 0
+
+
+def print_stats(stats, stats_path):
+    """Print the file loader, cache and macro database statistics.
+
+    Arguments:
+    stats: dictionary of statistics, as returned by FileLoader.get_stats,
+           extended with the statistics of the caches and of the MacroDB.
+    stats_path: path to a file into which the statistics are dumped as JSON,
+                '-' to dump them to stdout or None to print them in a human
+                readable form to stderr.
+    """
+
+    if stats_path == '-':
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+        return
+
+    if stats_path:
+        with open(stats_path, 'w') as stats_file:
+            json.dump(stats, stats_file, indent=2)
+        return
+
+    print('File loader statistics:', file=sys.stderr)
+
+    for (name, value) in stats.get('counters', {}).items():
+        print('  {}: {}'.format(name, value), file=sys.stderr)
+
+    for (name, timing) in stats.get('times', {}).items():
+        print('  {} time: {:.3f}s in {} calls'.format(
+            name, timing['seconds'], timing['calls']), file=sys.stderr)
+
+    for (name, value) in stats.items():
+        if 'lookups' in value:
+            print('  {}: {} hits in {} lookups, {} entries'.format(
+                name, value['hits'], value['lookups'], value['size']),
+                  file=sys.stderr)
+        elif 'hits' in value:
+            print('  {}: {} hits, {} misses, {} entries'.format(
+                name, value['hits'], value['misses'], value['size']),
+                  file=sys.stderr)
+
+    macro_stats = stats.get('macro_db')
+    if macro_stats:
+        print('Macro statistics:', file=sys.stderr)
+        print('  macros: {} ({} never parsed), files loaded: {} ({} '
+              'missing), dependency depth: {}'.format(
+                  macro_stats['macros'], macro_stats['unparsed_macros'],
+                  macro_stats['files_loaded'], macro_stats['files_missing'],
+                  macro_stats['dependency_depth']), file=sys.stderr)
+
+        for (ref, referrers) in sorted(
+                macro_stats['unresolved_refs'].items()):
+            print('  unresolved {}, referred to by {}'.format(
+                ref, ', '.join(referrers)), file=sys.stderr)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
 def main(command, verbose=False, game_root='./', file_loader='cat',
-         language='en', resolve_strings=None, export_objects=None,
-         export_dir='./', export_format='csv'):
+         language='en', cache_dir=None, use_mmap=False, jobs=1,
+         resolve_strings=None, export_objects=None, export_dir='./',
+         export_format='csv', pack_path=None, compress=False,
+         stats=False, stats_json=None):
     """Main function. Arguments are passed from the cmdline parser."""
 
     if verbose:
@@ -169,41 +265,65 @@ def main(command, verbose=False, game_root='./', file_loader='cat',
     floader = None
     file_loader = file_loader.strip().lower()
     if file_loader == 'cat':
-        floader = file_loaders.CatFileLoader(game_root)
+        floader = file_loaders.CatFileLoader(
+            game_root, cache_dir=cache_dir, use_mmap=use_mmap
+        )
         floader.load_from_game_root()
 
         for ext_name, ext_dir in list_extension_paths(game_root):
             floader.load_extension(ext_name, ext_dir)
     elif file_loader == 'fs':
         floader = file_loaders.FSFileLoader(game_root)
+    elif file_loader == 'pack':
+        floader = file_loaders.PackFileLoader(game_root)
     else:
         raise ValueError('Invalid file loader: {}'.format(file_loader))
 
     language = language.strip().lower()
     lresolver = lang.LanguageResolver()
+    parse_cache = None
     for (lang_file_path, lang_aliases) in LANG_TABLE.items():
         if language in lang_aliases:
             with floader.open_file(lang_file_path) as lang_file:
-                lresolver.load_lang_file(language, lang_file)
+                lresolver.load_lang_file(
+                    language, file_loaders.read_game_file(lang_file))
+
+            # parsed names depend on the language file
+            if cache_dir:
+                parse_cache = macros.ParseCache(cache_dir, '{}:{}'.format(
+                    language, floader.get_file_hash(lang_file_path)))
             break
 
     if not lresolver.get_loaded_languages():
         raise ValueError('Unknown language: {}'.format(language))
 
-    macro_db = macros.MacroDB(floader)
+    macro_db = macros.MacroDB(floader, parse_cache, workers=jobs)
 
     if command == 'resolve-string':
-        return cmd_resolve_strings(lresolver, resolve_strings)
+        ret = cmd_resolve_strings(lresolver, resolve_strings)
+    elif command == 'export':
+        ret = cmd_export(floader, lresolver, macro_db, export_objects,
+                         export_dir, export_format)
+    elif command == 'pack':
+        ret = cmd_pack(floader, lresolver, pack_path, compress)
+    elif not command:
+        print('No command given. Exiting.')
+        ret = 0
+    else:
+        raise ValueError('Invalid command: {}'.format(command))
 
-    if command == 'export':
-        return cmd_export(floader, lresolver, macro_db, export_objects,
-                          export_dir, export_format)
+    macro_db.save_parse_cache()
 
-    if not command:
-        print('No command given. Exiting.')
-        return 0
+    if stats or stats_json:
+        all_stats = floader.get_stats()
+        if parse_cache is not None:
+            all_stats['parse_cache'] = parse_cache.get_stats()
+        all_stats['component_cache'] = macro_db.component_cache.get_stats()
+        all_stats['macro_db'] = macro_db.get_stats()
+
+        print_stats(all_stats, stats_json)
 
-    raise ValueError('Invalid command: {}'.format(command))
+    return ret
 
 
 def parse_arguments():
@@ -222,13 +342,41 @@ def parse_arguments():
         help='Path to the game installation. Default: current directory.'
     )
     base_parser.add_argument(
-        '--file-loader', default=argparse.SUPPRESS, choices=['fs', 'cat'],
-        help='File loader to use. Default: cat.'
+        '--file-loader', default=argparse.SUPPRESS,
+        choices=['fs', 'cat', 'pack'],
+        help='File loader to use. The pack file loader expects the path to a '
+        'pack file as game root. Default: cat.'
     )
     base_parser.add_argument(
         '-l', '--lang', default=argparse.SUPPRESS, dest='language',
         help='Language used for names. Default: english.'
     )
+    base_parser.add_argument(
+        '--cache-dir', default=argparse.SUPPRESS,
+        help='Directory where parsed .cat files and parsed game files are '
+        'cached to speed up subsequent runs. Default: no caching.'
+    )
+    base_parser.add_argument(
+        '--mmap', action='store_true', default=argparse.SUPPRESS,
+        dest='use_mmap',
+        help='Memory-map the .dat files instead of reading each game file '
+        'separately. Only used by the cat file loader. Default: off.'
+    )
+    base_parser.add_argument(
+        '-j', '--jobs', type=int, default=argparse.SUPPRESS,
+        help='Number of worker processes used to parse game files in '
+        'parallel. Default: 1.'
+    )
+    base_parser.add_argument(
+        '--stats', action='store_true', default=argparse.SUPPRESS,
+        help='Print file loader statistics at the end of the run. '
+        'Default: off.'
+    )
+    base_parser.add_argument(
+        '--stats-json', default=argparse.SUPPRESS, metavar='FILE',
+        help='Dump file loader statistics as JSON to FILE at the end of the '
+        'run. Use - for stdout. Default: off.'
+    )
 
     parser = argparse.ArgumentParser(
         prog='X4FProjector',
@@ -268,6 +416,22 @@ def parse_arguments():
         help='Format to export as. Default: CSV.'
     )
 
+    pack_parser = subparsers.add_parser(
+        'pack', help='Write the game files used by the exporters into a pack '
+        'file that can be loaded with --file-loader pack.',
+        parents=[base_parser]
+    )
+
+    pack_parser.add_argument(
+        metavar='pack', dest='pack_path',
+        help='Path of the pack file to write.'
+    )
+
+    pack_parser.add_argument(
+        '-c', '--compress', action='store_true',
+        help='Compress each game file in the pack. Default: off.'
+    )
+
     return parser.parse_args()
 
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmark of the macro and component parsers.
+Measures the time spent per macro and per component by macro_parser and
+component_parser, with the XPath registry in misc and with every query
+compiled again, as it was done before the registry.
+"""
+
+import argparse
+import logging
+import time
+
+from lxml import etree
+
+import file_loaders
+import lang
+import macros
+import misc
+from loaders import macro_loaders
+from X4FProjector import LANG_TABLE, list_extension_paths
+
+
+def load_nodes(floader, index, xpath, count):
+    """Returns up to count (name, type, node) tuples of the entries of an
+    index that are found in the game files.
+
+    Arguments:
+    floader: FileLoader to use.
+    index: dictionary of name -> game path, e.g. MacroDB.macro_index.
+    xpath: XPath of the node of an entry, with a $name variable.
+    count: maximum number of nodes.
+    """
+    nodes = []
+
+    for (name, path) in sorted(index.items()):
+        if len(nodes) >= count:
+            break
+
+        if not floader.file_exists(path):
+            continue
+
+        with floader.open_file(path) as xml_file:
+            tree = etree.parse(xml_file)
+
+        for node in tree.xpath(xpath, name=name):
+            nodes.append((name, node.get('class', '').strip(), node))
+
+    return nodes
+
+
+def run(name, func, args, repeat):
+    """Calls func with every tuple of args, repeat times, and prints the best
+    time per call.
+    """
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            func(*arg)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print('{}: {:.1f} us per call, {} calls'.format(
+        name, best * 1e6 / max(1, len(args)), len(args)))
+
+
+def main(game_root, file_loader, count, repeat):
+    """Main function. Arguments are passed from the cmdline parser."""
+    # the parsers warn about the same game files on every run
+    logging.basicConfig(level=logging.ERROR)
+
+    if file_loader == 'cat':
+        floader = file_loaders.CatFileLoader(game_root)
+        floader.load_from_game_root()
+
+        for ext_name, ext_dir in list_extension_paths(game_root):
+            floader.load_extension(ext_name, ext_dir)
+    else:
+        floader = file_loaders.FSFileLoader(game_root)
+
+    lresolver = lang.LanguageResolver()
+    for (lang_file_path, lang_aliases) in LANG_TABLE.items():
+        if 'en' in lang_aliases:
+            with floader.open_file(lang_file_path) as lang_file:
+                lresolver.load_lang_file('en', lang_file)
+
+    macro_db = macros.MacroDB(floader)
+
+    macro_nodes = [
+        (name, macro_type, props)
+        for (name, macro_type, node) in load_nodes(
+            floader, macro_db.macro_index, './macro[@name=$name]', count)
+        for props in node.iterchildren('properties')
+    ]
+    comp_nodes = load_nodes(floader, macro_db.component_index,
+                            './component[@name=$name]', count)
+
+    def parse_macro(name, macro_type, node):
+        macro_loaders.macro_parser(name, macro_type, node, lresolver)
+
+    for (mode, use_registry) in [('compiled', True), ('uncompiled', False)]:
+        misc.USE_XPATH_REGISTRY = use_registry
+        run('macro_parser, ' + mode, parse_macro, macro_nodes, repeat)
+        run('component_parser, ' + mode, macro_loaders.component_parser,
+            comp_nodes, repeat)
+
+    misc.USE_XPATH_REGISTRY = True
+
+
+def parse_arguments():
+    """Parses the command line arguments and returns them as a dictionary."""
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        '-g', '--game-root', default='./',
+        help='Path to the game root, the directory that contains the .cat '
+        'files or the extracted game files. Default: current directory.'
+    )
+    parser.add_argument(
+        '--file-loader', choices=['cat', 'fs'], default='cat',
+        help='File loader to use. Default: cat.'
+    )
+    parser.add_argument(
+        '-n', '--count', type=int, default=500,
+        help='Maximum number of macros and of components to parse. '
+        'Default: 500.'
+    )
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='Number of runs. The best run is reported. Default: 5.'
+    )
+
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main(**parse_arguments())
@@ -1,9 +1,23 @@
+# pylint: disable=too-many-lines
+
 """Loaders for game files."""
 
+import bisect
+import hashlib
 import io
+import json
 import logging
+import mmap
 import os
-from collections import namedtuple
+import pickle
+import re
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, namedtuple, OrderedDict
+from contextlib import contextmanager
 
 
 LOG = logging.getLogger(__name__)
@@ -20,6 +34,172 @@ def split_game_path(path):
     return [p for p in path.split('/') if p]
 
 
+def normalize_game_path(path):
+    """Lowercase a game path and remove redundant slashes.
+    Normalized paths are used as keys of the CatFileLoader file index.
+    """
+    path = path.lower()
+
+    # only split the path when it actually contains redundant slashes
+    if path.startswith('/') or path.endswith('/') or '//' in path:
+        path = '/'.join(split_game_path(path))
+
+    return path
+
+
+def compile_glob(pattern):
+    """Compile a glob pattern over game paths.
+    Returns a (base, regex) tuple, where base is the longest directory prefix
+    of the pattern that contains no wildcards and regex is a compiled regular
+    expression that matches whole game paths.
+
+    Wildcards:
+    *: matches any part of a path component.
+    ?: matches a single character of a path component.
+    [seq], [!seq]: matches a single character in/not in seq.
+    **: as a whole path component, matches zero or more directories.
+
+    Arguments:
+    pattern: glob pattern. E.g. 'assets/props/weaponsystems/*/macros/*.xml'
+    """
+    parts = split_game_path(pattern)
+
+    base_len = 0
+    while base_len < len(parts) - 1 and \
+            not any(c in parts[base_len] for c in '*?['):
+        base_len += 1
+
+    regex = []
+    for (i, part) in enumerate(parts):
+        last = i == len(parts) - 1
+
+        if part == '**':
+            regex.append('.*' if last else '(?:[^/]+/)*')
+            continue
+
+        j = 0
+        while j < len(part):
+            c = part[j]
+            end = part.find(']', j + 2) if c == '[' else -1
+
+            if c == '*':
+                regex.append('[^/]*')
+            elif c == '?':
+                regex.append('[^/]')
+            elif end != -1:
+                seq = part[j + 1:end].replace('\\', '\\\\')
+                if seq.startswith('!'):
+                    # negated sequences don't match the path separator
+                    seq = '^/' + seq[1:]
+
+                regex.append('[' + seq + ']')
+                j = end
+            else:
+                regex.append(re.escape(c))
+
+            j += 1
+
+        if not last:
+            regex.append('/')
+
+    return '/'.join(parts[:base_len]), re.compile(''.join(regex) + r'\Z')
+
+
+class NegativeCache:
+    """Set of game paths that are known not to exist.
+    Used by file loaders to answer repeated lookups of missing files without
+    searching for them again.
+
+    Members:
+    paths: set of missing paths.
+    hits: number of lookups answered by the cache.
+    lookups: number of lookups, including the ones answered by the cache.
+    """
+
+    __slots__ = ('paths', 'hits', 'lookups')
+
+    def __init__(self):
+        """Initialize an empty cache."""
+        self.paths = set()
+        self.hits = 0
+        self.lookups = 0
+
+    def check(self, path):
+        """Returns True if the path is known to be missing and updates the
+        counters.
+        """
+        self.lookups += 1
+
+        if path in self.paths:
+            self.hits += 1
+            return True
+
+        return False
+
+    def add(self, path):
+        """Records a missing path."""
+        self.paths.add(path)
+
+    def clear(self):
+        """Forgets all missing paths. The counters are kept."""
+        self.paths.clear()
+
+    def get_stats(self):
+        """Returns a dictionary with the counters and the size of the cache."""
+        return {
+            'hits': self.hits,
+            'lookups': self.lookups,
+            'size': len(self.paths),
+        }
+
+
+class LoaderStats:
+    """Counters and cumulative wall times of file loader operations.
+    A loader shares its LoaderStats with its extension loaders and with the
+    game files it opens. Times of nested operations are included in the times
+    of the operations that contain them.
+
+    Members:
+    counters: Counter of event name -> number of events or bytes.
+    times: Counter of operation name -> cumulative wall time in seconds.
+    calls: Counter of operation name -> number of timed calls.
+    """
+
+    __slots__ = ('counters', 'times', 'calls')
+
+    def __init__(self):
+        """Initialize empty stats."""
+        self.counters = Counter()
+        self.times = Counter()
+        self.calls = Counter()
+
+    def count(self, name, value=1):
+        """Adds value to a counter."""
+        self.counters[name] += value
+
+    @contextmanager
+    def timed(self, name):
+        """Context manager that adds the wall time spent inside it to an
+        operation.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def get_stats(self):
+        """Returns a dictionary with the counters and the times."""
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'times': dict(
+                (name, {'calls': self.calls[name], 'seconds': seconds})
+                for (name, seconds) in sorted(self.times.items())
+            ),
+        }
+
+
 class FileLoader:
     """Base class for file loaders."""
 
@@ -55,12 +235,103 @@ class FileLoader:
         """
         raise NotImplementedError()
 
+    def walk(self, path):
+        """Recursively list game files under a game directory.
+        Returns an iterable over Entry objects. Nothing is returned if the
+        directory doesn't exist.
+
+        Arguments:
+        path: path to game data directory. See open_file().
+        """
+        raise NotImplementedError()
+
+    def glob(self, pattern):
+        """List game files whose paths match a glob pattern.
+        Returns an iterable over Entry objects. See compile_glob() for the
+        supported wildcards.
+
+        Arguments:
+        pattern: glob pattern over game data paths.
+                 E.g. 'assets/props/weaponsystems/*/macros/weapon_*.xml'
+        """
+        raise NotImplementedError()
+
+    def read_many(self, paths):
+        """Read multiple game files.
+        Returns an iterable over (path, data) pairs, where data is the content
+        of the file as bytes. The pairs are not necessarily returned in the
+        order of paths: loaders may reorder the reads to make them faster.
+        Each path is read only once.
+
+        Arguments:
+        paths: iterable of paths to game data files. See open_file().
+        """
+        seen = set()
+
+        for path in paths:
+            if path in seen:
+                continue
+
+            seen.add(path)
+
+            with self.open_file(path) as game_file:
+                yield path, game_file.read()
+
+    def get_stats(self):
+        """Returns a dictionary with statistics about the operations performed
+        by the file loader. The default implementation returns an empty
+        dictionary.
+        """
+        return {}
+
+    def get_file_hash(self, path):
+        """Returns the hash of the content of a game file as a hex string, or
+        None if the file doesn't exist or its hash is not known. Used as a
+        cache key by MacroDB. The default implementation returns None.
+
+        Arguments:
+        path: path to game data file. See open_file().
+        """
+        # pylint: disable=unused-argument
+        return None
+
+    def prefetch(self, paths):
+        """Hint that game files will be read soon, so that the file loader
+        can start reading them in the background. Missing files are ignored.
+        The default implementation does nothing.
+
+        Arguments:
+        paths: iterable of paths to game data files. See open_file().
+        """
+
+
+# Directory recorded in the FSFileLoader index.
+# game_path is the game path of the directory as cased on disk, files maps
+# lowercase file names to Entry objects and subdirs is the set of lowercase
+# names of subdirectories.
+IndexedDir = namedtuple('IndexedDir',
+                        ['fs_path', 'game_path', 'mtime_ns', 'files',
+                         'subdirs'])
 
-class FSFileLoader:
+
+class FSFileLoader(FileLoader):
     """File System File Loader.
     Loads game files that have been extracted using X Rebirth Cat tool or
     another tool.
     When extracting the files you MUST keep the folder hierarchy.
+
+    Game paths are case insensitive, so the extracted tree is indexed by
+    lowercase path the first time it's accessed. A directory is re-indexed
+    when its modification time changes, which is checked when the directory
+    is listed or when a lookup misses the index.
+
+    Members:
+    root: location of the extracted game files.
+    negative_cache: NegativeCache of normalized game paths that don't exist.
+    stats: LoaderStats of the operations of this loader.
+    files: dictionary that maps normalized game paths to file system paths.
+    dirs: dictionary that maps normalized game directory paths to IndexedDir
+          objects. None until the index is built.
     """
 
     def __init__(self, files_root='./'):
@@ -70,66 +341,508 @@ class FSFileLoader:
         files_root: location of the extracted game files.
         """
         self.root = os.path.normpath(files_root)
+        self.negative_cache = NegativeCache()
+        self.stats = LoaderStats()
+        self.files = {}
+        self.dirs = None
 
     def get_extensions(self):
         """Not implemented yet."""
         return []
 
+    def _index_tree(self, dir_path, fs_path, game_path):
+        """Adds a directory and all its subdirectories to the index.
+
+        Arguments:
+        dir_path: normalized game path of the directory.
+        fs_path: file system path of the directory.
+        game_path: game path of the directory as cased on disk.
+        """
+        stack = [(dir_path, fs_path, game_path)]
+
+        while stack:
+            (dir_path, fs_path, game_path) = stack.pop()
+
+            try:
+                mtime_ns = os.stat(fs_path).st_mtime_ns
+                it = os.scandir(fs_path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            prefix = dir_path + '/' if dir_path else ''
+            game_prefix = game_path + '/' if game_path else ''
+            files = {}
+            subdirs = set()
+
+            with it:
+                for entry in it:
+                    name = entry.name.lower()
+
+                    if entry.is_dir():
+                        subdirs.add(name)
+                        stack.append((prefix + name, entry.path,
+                                      game_prefix + entry.name))
+                    elif entry.is_file():
+                        files[name] = Entry(game_prefix + entry.name,
+                                            entry.name)
+                        self.files.setdefault(prefix + name, entry.path)
+
+            self.dirs[dir_path] = IndexedDir(fs_path, game_path, mtime_ns,
+                                             files, subdirs)
+
+    def _drop_tree(self, dir_path):
+        """Removes a directory and all its subdirectories from the index."""
+        stack = [dir_path]
+
+        while stack:
+            dir_path = stack.pop()
+            indexed_dir = self.dirs.pop(dir_path, None)
+            if indexed_dir is None:
+                continue
+
+            prefix = dir_path + '/' if dir_path else ''
+            for name in indexed_dir.files:
+                self.files.pop(prefix + name, None)
+
+            stack.extend(prefix + name for name in indexed_dir.subdirs)
+
+    def _build_index(self):
+        """Indexes the extracted tree if it wasn't indexed yet."""
+        if self.dirs is None:
+            self.dirs = {}
+            with self.stats.timed('index'):
+                self._index_tree('', self.root, '')
+
+    def _refresh_dir(self, dir_path):
+        """Re-indexes an indexed directory if its modification time changed.
+        Returns True if the directory was re-indexed.
+        """
+        indexed_dir = self.dirs[dir_path]
+
+        try:
+            mtime_ns = os.stat(indexed_dir.fs_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+
+        if mtime_ns == indexed_dir.mtime_ns:
+            return False
+
+        self.stats.count('dirs_reindexed')
+
+        with self.stats.timed('index'):
+            self._drop_tree(dir_path)
+            self._index_tree(dir_path, indexed_dir.fs_path,
+                             indexed_dir.game_path)
+
+        self.negative_cache.clear()
+
+        return True
+
+    def _refresh_ancestor(self, path):
+        """Re-indexes the closest indexed ancestor directory of a normalized
+        game path if it was modified. Returns True if it was re-indexed.
+        """
+        dir_path = path.rpartition('/')[0]
+        while dir_path and dir_path not in self.dirs:
+            dir_path = dir_path.rpartition('/')[0]
+
+        return dir_path in self.dirs and self._refresh_dir(dir_path)
+
     def _resolve(self, path):
-        """Resolves a game file path to a file system path."""
-        return os.path.join(self.root, path)
+        """Resolves a normalized game file path to a file system path.
+        Returns None if the file doesn't exist. Missing paths are recorded in
+        the negative cache.
+        """
+        self.stats.count('file_lookups')
+        self._build_index()
+
+        # the directory is checked even for cached misses, since the file
+        # might have been created since. Re-indexing clears the cache.
+        if self.negative_cache.check(path) and \
+           not self._refresh_ancestor(path):
+            self.stats.count('file_lookup_misses')
+            return None
+
+        fs_path = self.files.get(path)
+        if fs_path is None and self._refresh_ancestor(path):
+            fs_path = self.files.get(path)
+
+        if fs_path is None:
+            self.negative_cache.add(path)
+            self.stats.count('file_lookup_misses')
+
+        return fs_path
+
+    def _get_dir(self, path):
+        """Returns the IndexedDir of a game directory, or None if the
+        directory doesn't exist. The directory is re-indexed if it was
+        modified.
+        """
+        self._build_index()
+        path = normalize_game_path(path)
+
+        if path in self.dirs:
+            self._refresh_dir(path)
+        else:
+            self._refresh_ancestor(path)
+
+        return self.dirs.get(path)
+
+    def _walk_index(self, path):
+        """Recursively lists the indexed files under a game directory.
+        Returns an iterable over (normalized path, Entry) pairs.
+        """
+        if self._get_dir(path) is None:
+            return
+
+        stack = [normalize_game_path(path)]
+        while stack:
+            dir_path = stack.pop()
+            if dir_path not in self.dirs:
+                continue
+
+            self._refresh_dir(dir_path)
+            indexed_dir = self.dirs.get(dir_path)
+            if indexed_dir is None:
+                continue
+
+            prefix = dir_path + '/' if dir_path else ''
+            for (name, entry) in indexed_dir.files.items():
+                yield prefix + name, entry
+
+            stack.extend(prefix + name for name in indexed_dir.subdirs)
 
     def open_file(self, path):
         """Open game file."""
-        return open(self._resolve(path), 'rb')
+        with self.stats.timed('open_file'):
+            fs_path = self._resolve(normalize_game_path(path))
+
+            if fs_path is None:
+                raise FileNotFoundError('Game file {} not found'.format(path))
+
+            # pylint: disable=consider-using-with
+            game_file = open(fs_path, 'rb')
+
+        self.stats.count('files_opened')
+        self.stats.count('bytes_opened', os.fstat(game_file.fileno()).st_size)
+
+        return game_file
 
     def file_exists(self, path):
         """Check if file exists."""
-        return os.path.isfile(self._resolve(path))
+        return self._resolve(normalize_game_path(path)) is not None
+
+    def get_stats(self):
+        """Returns a dictionary with statistics about the operations performed
+        by the file loader.
+        """
+        stats = self.stats.get_stats()
+        stats['negative_cache'] = self.negative_cache.get_stats()
+
+        return stats
+
+    def read_many(self, paths):
+        """Read multiple game files."""
+        for (path, data) in super(FSFileLoader, self).read_many(paths):
+            self.stats.count('bytes_read', len(data))
+            yield path, data
+
+    def prefetch(self, paths):
+        """Hint that game files will be read soon."""
+        fs_paths = (self._resolve(normalize_game_path(path))
+                    for path in paths)
+        prefetch_ranges((fs_path, 0, 0) for fs_path in fs_paths if fs_path)
 
     def list_files(self, path):
         """List game files under a game directory."""
-        for entry in os.scandir(self._resolve(path)):
-            if entry.is_file():
-                yield Entry(entry.path, entry.name)
+        indexed_dir = self._get_dir(path)
+        if indexed_dir is None:
+            raise FileNotFoundError(
+                'Game directory {} not found'.format(path))
+
+        yield from indexed_dir.files.values()
+
+    def walk(self, path):
+        """Recursively list game files under a game directory."""
+        for (_, entry) in self._walk_index(path):
+            yield entry
+
+    def glob(self, pattern):
+        """List game files whose paths match a glob pattern.
+        Matching is case insensitive.
+        """
+        (base, regex) = compile_glob(pattern.lower())
+
+        for (path, entry) in self._walk_index(base):
+            if regex.match(path):
+                yield entry
+
+
+# Maximum number of .dat files kept open by a DatFilePool by default
+DEFAULT_MAX_OPEN_DATS = 32
+
+# Game files read by CatFileLoader.read_many that are separated by at most
+# this many bytes are read with a single read.
+MAX_READ_GAP = 16 * 1024
+
+# Maximum size of a single read performed by CatFileLoader.read_many, unless a
+# single game file is bigger.
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+# os.pread is not available on Windows
+HAS_PREAD = hasattr(os, 'pread')
+
+# os.posix_fadvise is only available on some Unix systems
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+
+def _read_ranges(ranges):
+    """Reads file ranges and discards the data. Used to bring the ranges into
+    the OS page cache.
+    """
+    for (path, group) in _group_ranges(ranges):
+        try:
+            with open(path, 'rb') as range_file:
+                for (offset, size) in group:
+                    range_file.seek(offset)
+
+                    # size 0 means until the end of the file
+                    remaining = size or -1
+                    while remaining:
+                        data = range_file.read(
+                            MAX_READ_SIZE if remaining < 0
+                            else min(remaining, MAX_READ_SIZE))
+                        if not data:
+                            break
+
+                        if remaining > 0:
+                            remaining -= len(data)
+        except OSError as ex:
+            LOG.debug('Failed to prefetch %s: %s', path, ex)
+
+
+def _group_ranges(ranges):
+    """Groups (path, offset, size) file ranges by path, ordered by offset.
+    Returns a list of (path, [(offset, size)]) tuples.
+    """
+    groups = {}
+    for (path, offset, size) in ranges:
+        groups.setdefault(path, []).append((offset, size))
+
+    return [(path, sorted(group)) for (path, group) in sorted(groups.items())]
+
+
+def prefetch_ranges(ranges):
+    """Tells the OS that file ranges will be read soon, so they are read in
+    the background while the caller does other work.
+    Uses posix_fadvise(POSIX_FADV_WILLNEED) when available. Otherwise the
+    ranges are read by a background thread to bring them into the page
+    cache. Failures are logged and otherwise ignored.
+
+    Arguments:
+    ranges: iterable of (file system path, offset, size) tuples. A size of 0
+            means until the end of the file.
+    """
+    ranges = list(ranges)
+    if not ranges:
+        return
+
+    if not HAS_FADVISE:
+        threading.Thread(target=_read_ranges, args=(ranges,),
+                         daemon=True).start()
+        return
+
+    for (path, group) in _group_ranges(ranges):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as ex:
+            LOG.debug('Failed to prefetch %s: %s', path, ex)
+            continue
+
+        try:
+            for (offset, size) in group:
+                os.posix_fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+        except OSError as ex:
+            LOG.debug('Failed to prefetch %s: %s', path, ex)
+        finally:
+            os.close(fd)
+
+
+class DatHandle:
+    """Open .dat file descriptor owned by a DatFilePool.
+
+    Members:
+    dat_path: path to the .dat file.
+    fd: OS-level file descriptor.
+    refs: number of game files currently using the descriptor.
+    evicted: True if the handle was removed from the pool. The descriptor is
+             closed when the last game file using it is closed.
+    lock: lock that serializes seek + read pairs on systems without
+          os.pread.
+    """
+
+    __slots__ = ('dat_path', 'fd', 'refs', 'evicted', 'lock')
+
+    def __init__(self, dat_path):
+        """Opens the .dat file.
+
+        Arguments:
+        dat_path: path to the .dat file.
+        """
+        self.dat_path = dat_path
+        self.fd = os.open(dat_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.refs = 0
+        self.evicted = False
+        self.lock = threading.Lock()
+
+    def pread(self, size, offset):
+        """Read up to size bytes starting at offset, without using or changing
+        a shared file position.
+        """
+        if HAS_PREAD:
+            return os.pread(self.fd, size, offset)
+
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+
+class DatFilePool:
+    """Bounded LRU pool of open .dat file descriptors.
+    Game files acquire a handle from the pool and release it when they are
+    closed. Handles are shared between game files and reads are positional,
+    so any number of threads can read from the same .dat file at the same
+    time.
+    When the pool is full the least recently used handle is evicted. Evicted
+    handles that are still in use are closed when they are released.
+
+    Members:
+    max_size: maximum number of handles kept in the pool.
+    handles: OrderedDict of dat_path -> DatHandle, from least to most recently
+             used.
+    lock: lock that protects the pool.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_OPEN_DATS):
+        """Initialize an empty pool.
+
+        Arguments:
+        max_size: maximum number of handles kept in the pool.
+        """
+        self.max_size = max(1, max_size)
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, dat_path):
+        """Returns an open DatHandle for a .dat file.
+        The handle must be given back using release.
+
+        Arguments:
+        dat_path: path to the .dat file.
+        """
+        with self.lock:
+            handle = self.handles.get(dat_path)
+
+            if handle is None:
+                handle = DatHandle(dat_path)
+                self.handles[dat_path] = handle
+
+                while len(self.handles) > self.max_size:
+                    _, old = self.handles.popitem(last=False)
+                    self._evict(old)
+            else:
+                self.handles.move_to_end(dat_path)
+
+            handle.refs += 1
+
+        return handle
+
+    def release(self, handle):
+        """Gives back a handle acquired from the pool."""
+        with self.lock:
+            handle.refs -= 1
+
+            if handle.evicted and handle.refs <= 0:
+                os.close(handle.fd)
+
+    @staticmethod
+    def _evict(handle):
+        """Marks a handle removed from the pool and closes it if unused."""
+        handle.evicted = True
+
+        if handle.refs <= 0:
+            os.close(handle.fd)
+
+    def close(self):
+        """Closes all the handles.
+        Handles still in use are closed when they are released.
+        """
+        with self.lock:
+            for handle in self.handles.values():
+                self._evict(handle)
+
+            self.handles.clear()
 
 
 class DatGameFile(io.RawIOBase):
-    """A wrapper over a file object that restricts operations to a limited
-    zone of the file defined by offset and size.
+    """A file-like object that restricts operations to a limited zone of a
+    .dat file defined by offset and size.
     It is used to read game files inside .dat files.
+    Reads are positional, so game files that share the same .dat handle can be
+    used from different threads.
     Doesn't support truncation and writing.
 
     Members:
-    dat_file: underlying .dat file.
+    pool: DatFilePool that owns the .dat handle.
+    handle: DatHandle of the underlying .dat file.
     start: position of the begining of the game file.
     end: position of the end of the game file.
+    pos: current absolute position in the .dat file.
+    stats: LoaderStats to which reads are counted or None.
     """
 
-    def __init__(self, dat_file, offset, size):
+    # pylint: disable=too-many-arguments
+    def __init__(self, pool, handle, offset, size, stats=None):
         """Initialize a game file.
 
         Arguments:
-        dat_file: underlying .dat file.
+        pool: DatFilePool that owns the .dat handle.
+        handle: DatHandle acquired from the pool. It is released when the game
+                file is closed.
         offset: offset from the start of dat_file of the game file.
         size: size of the game file.
+        stats: LoaderStats to which reads are counted or None.
         """
         super(DatGameFile, self).__init__()
 
-        self.dat_file = dat_file
+        self.pool = pool
+        self.handle = handle
         self.start = offset
         self.end = offset + size
+        self.pos = offset
+        self.stats = stats
 
-        # seek to the game file
-        self.dat_file.seek(self.start, io.SEEK_SET)
+    def _pread(self, size):
+        """Reads from the current position of the .dat file and counts the
+        read in the stats.
+        """
+        if self.stats is None:
+            return self.handle.pread(size, self.pos)
+
+        with self.stats.timed('read'):
+            data = self.handle.pread(size, self.pos)
+
+        self.stats.count('bytes_read', len(data))
+
+        return data
 
     def _clamp_op(self, size):
         """Used to clamp the size of operations performed on the .dat in order
         to not go outside the game file.
         """
-        max_size = max(0, self.end - self.dat_file.tell())
+        max_size = max(0, self.end - self.pos)
 
-        if size < 0:
+        if size is None or size < 0:
             # operation is performed until EOF is reached. limit to max_size.
             return max_size
 
@@ -141,35 +854,36 @@ class DatGameFile(io.RawIOBase):
         return min(max(offset, self.start), self.end)
 
     def close(self):
-        """Close underlying file."""
-        self.dat_file.close()
+        """Give back the .dat handle to the pool."""
+        if not self.closed:
+            self.pool.release(self.handle)
 
-    @property
-    def closed(self):
-        """Check underlying file status."""
-        return self.dat_file.closed
+        super(DatGameFile, self).close()
 
     def fileno(self):
         """Underyling file descriptor."""
-        return self.dat_file.fileno()
-
-    def flush(self):
-        """Flush underlying file."""
-        return self.dat_file.flush()
+        return self.handle.fd
 
     def isatty(self):
-        """Check if underlying file is interactive."""
-        return self.dat_file.isatty()
+        """Returns False, game files are not interactive."""
+        return False
 
     def readable(self):
-        """Check if underlying file is readable."""
-        return self.dat_file.readable()
+        """Returns True, the game file is readable."""
+        return True
 
     def read(self, size=-1):
         """Read from the game file.
         The operation is clamped to not escape the game file boundaries.
         """
-        return self.dat_file.read(self._clamp_op(size))
+        size = self._clamp_op(size)
+        if not size:
+            return b''
+
+        data = self._pread(size)
+        self.pos += len(data)
+
+        return data
 
     def readall(self):
         """Read the whole game file.
@@ -177,66 +891,81 @@ class DatGameFile(io.RawIOBase):
         """
         size = self._clamp_op(-1)
 
-        buf = self.read(size)
-        while len(buf) < size:
-            buf += self.read(size - len(buf))
+        chunks = []
+        while size > 0:
+            chunk = self.read(size)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            size -= len(chunk)
 
-        return buf
+        return b''.join(chunks)
 
     def readinto(self, b):
         """Read the game file into a buffer.
         The operation is clamped to not escape the game file boundaries.
         """
-        size = self._clamp_op(len(b))
+        data = self.read(len(b))
+        b[0:len(data)] = data
 
-        return self.dat_file.readinto(b[0:size])
+        return len(data)
 
     def readline(self, size=-1):
         """Read a line from the game file.
         The operation is clamped to not escape the game file boundaries.
         """
-        return self.dat_file.readline(self._clamp_op(size))
+        size = self._clamp_op(size)
+        chunks = []
 
-    def readlines(self, hint=-1):
-        """Read lines from the game file.
-        The operation is clamped to not escape the game file boundaries.
-        """
-        return self.dat_file.readlines(self._clamp_op(hint))
+        while size > 0:
+            chunk = self._pread(min(size, io.DEFAULT_BUFFER_SIZE))
+            if not chunk:
+                break
+
+            newline = chunk.find(b'\n')
+            if newline >= 0:
+                chunk = chunk[:newline + 1]
+
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+
+            if newline >= 0:
+                break
+
+        return b''.join(chunks)
 
     def seek(self, offset, whence=io.SEEK_SET):
         """Seek the game file.
         Returns the final absolute position in the game file.
         The operation is clamped to not escape the game file boundaries.
         """
-        abs_pos = None
-
         if whence == io.SEEK_SET:
-            abs_pos = self._clamp_pos(offset + self.start)
+            self.pos = self._clamp_pos(offset + self.start)
         elif whence == io.SEEK_CUR:
-            abs_pos = self._clamp_pos(offset + self.dat_file.tell())
+            self.pos = self._clamp_pos(offset + self.pos)
         elif whence == io.SEEK_END:
-            abs_pos = self._clamp_pos(offset + self.end)
+            self.pos = self._clamp_pos(offset + self.end)
         else:
             raise ValueError('Invalid seek whence: {}'.format(whence))
 
-        self.dat_file.seek(abs_pos, io.SEEK_SET)
-        return abs_pos - self.start
+        return self.pos - self.start
 
     def seekable(self):
-        """Check if the underlying file is seekable."""
-        return self.dat_file.seekable()
+        """Returns True, the game file is seekable."""
+        return True
 
     def tell(self):
         """Return the current position in the game file."""
-        return self.dat_file.tell() - self.start
+        return self.pos - self.start
 
-    def truncate(self):
+    def truncate(self, size=None):
         """Not implemented."""
         raise NotImplementedError('Truncation is not supported')
 
     def writable(self):
         """Returns false, writing is not supported."""
-        # return self.dat_file.writable()
         return False
 
     def write(self, b):
@@ -247,145 +976,844 @@ class DatGameFile(io.RawIOBase):
         """Not implemented."""
         raise NotImplementedError('Writing is not supported')
 
-    def __del__(self):
-        return self.dat_file.__del__()
-
-
-CatEntry = namedtuple(
-    'CatEntry',
-    ['dat_path', 'name', 'size', 'offset']
-)
-
 
-class DirNode:
-    """Directory node used by the CatFileLoader to represent the game file
-    structure.
+def read_game_file(game_file):
+    """Returns the content of an open game file as a bytes-like object that
+    can be given to etree.fromstring.
+    Files that support getbuffer, e.g. MmapGameFile, return a view over their
+    content without copying it. The view is only valid while the file is
+    open.
 
-    Members:
-    files: dictionary or file name -> CatEntry.
-    children: dictionary of directory name -> DirNode.
+    Arguments:
+    game_file: file-like object returned by FileLoader.open_file.
     """
+    getbuffer = getattr(game_file, 'getbuffer', None)
+    if getbuffer is not None:
+        return getbuffer()
 
-    # optimization: http://book.pythontips.com/en/latest/__slots__magic.html
-    __slots__ = ('children')
-
-    def __init__(self):
-        """Initialize node with empty files and empty children."""
-
-        self.children = {}
+    return game_file.read()
 
 
-class CatFileLoader:
-    """File loader that directly reads game .cat and .dat files.
-    Cat files should be loaded in the order of highest to lowest priority.
+class MmapGameFile(io.RawIOBase):
+    """A read-only file-like object over a game file inside a memory-mapped
+    .dat file.
+    Reads are served directly from the mapping, without any system calls.
+    Use read_game_file to get the content without copying it.
+    Doesn't support truncation and writing.
 
     Members:
-    fs_root: path to the cat root directory.
-    file_tree: DirNode instance representing the root of the game files
-               hierarchy.
-    data_files: pairs of (cat_path, dat_path) of data files to load, ordered
-                from lowest to highest priority. Those are consumed from
-                the tail to the head by the _load_next_cat_file function.
-    loaded: set of path to loaded .cat files. This is used to avoid loading
-            game files twice in case self.load_from_game_root is called
-            multiple times.
+    view: memoryview over the bytes of the game file.
+    pos: current position in the game file.
     """
 
-    def __init__(self, fs_root='./'):
-        """Initializes the cat loader.
-
-        Arguments:
-        fs_root: path to where the .cat and .dat files are stored.
-        """
-        self.fs_root = fs_root
-        self.file_tree = DirNode()
-        self.data_files = []
-        self.loaded = set()
-
-    def _load_cat_file(self, cat_path, dat_path):
-        """Loads a .cat file and stores entries in the file tree.
-        The entries will reference the .dat file.
-        Returns True if the .cat file is parsed and loaded sucessfully.
-        This function will NOT override already existing entries.
+    def __init__(self, view):
+        """Initialize a game file.
 
         Arguments:
-        cat_path: path to .cat file.
-        dat_path: path to .dat file.
+        view: memoryview over the bytes of the game file.
         """
-        file_offset = 0
-        entries = []
-
-        LOG.info('Loading .cat file %s', cat_path)
+        super(MmapGameFile, self).__init__()
 
-        # first parse entries
-        # if the cat file is malformed this block will return, so the file
-        # won't be partially loaded
-        with open(cat_path, 'r') as cat_file:
-            for line_no, line in enumerate(cat_file):
-                if not line:
-                    continue
-
-                # match 'path size timestamp hash' format
-                # path might contain spaces, so a rsplit is needed
-                parts = line.lower().rsplit(' ', 3)
-                if len(parts) != 4:
-                    LOG.error('Cat file %s has invalid entry on line %s',
-                              cat_path, line_no + 1)
-                    return False
+        self.view = view
+        self.pos = 0
 
-                game_path = split_game_path(parts[0])
-                size = int(parts[1])
-                offset = file_offset
-                file_offset += size
+    def close(self):
+        """Release the view over the mapping."""
+        if not self.closed:
+            self.view.release()
 
-                if not game_path:
-                    LOG.error('Cat file %s contains malformed game file path '
-                              '%s on line %s', cat_path, parts[0], line_no + 1)
-                    continue
+        super(MmapGameFile, self).close()
 
-                file_name = game_path[-1]
-                game_path = game_path[:-1]
+    def getbuffer(self):
+        """Returns the memoryview over the whole game file, without copying
+        it.
+        """
+        return self.view
 
-                entries.append((
-                    game_path,
-                    CatEntry(dat_path, file_name, size, offset)
-                ))
+    def readable(self):
+        """Returns True, the game file is readable."""
+        return True
 
-        file_tree = self.file_tree
+    def read(self, size=-1):
+        """Read from the game file."""
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
 
-        # now add entries to the file tree
-        for (game_path, entry) in entries:
-            k = file_tree
+        data = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
 
-            for directory in game_path:
-                if directory not in k.children:
-                    k.children[directory] = DirNode()
+        return data
 
-                k = k.children[directory]
+    def readall(self):
+        """Read the whole game file."""
+        return self.read()
 
-            if entry.name not in k.children:
-                k.children[entry.name] = entry
+    def readinto(self, b):
+        """Read the game file into a buffer."""
+        size = max(0, min(len(b), len(self.view) - self.pos))
 
-        self.loaded.add(cat_path)
+        b[0:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
 
-        return True
+        return size
 
-    def _load_next_cat_file(self):
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Seek the game file.
+        Returns the final absolute position in the game file.
+        """
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self.view) + offset
+        else:
+            raise ValueError('Invalid seek whence: {}'.format(whence))
+
+        self.pos = min(max(pos, 0), len(self.view))
+        return self.pos
+
+    def seekable(self):
+        """Returns True, the game file is seekable."""
+        return True
+
+    def tell(self):
+        """Return the current position in the game file."""
+        return self.pos
+
+    def writable(self):
+        """Returns false, writing is not supported."""
+        return False
+
+
+CatEntry = namedtuple(
+    'CatEntry',
+    ['dat_path', 'path', 'size', 'offset', 'hash']
+)
+
+# Size in bytes of the MD5 hashes of game files stored in .cat files
+CAT_HASH_SIZE = 16
+
+# Stored in place of hashes that are missing or malformed
+NO_HASH = bytes(CAT_HASH_SIZE)
+
+
+class CatEntryTable:
+    """Compact storage of the entries of .cat files.
+    Entries are stored as a struct of arrays and are referred to by their
+    index in the table. CatEntry objects are only created on demand by get.
+
+    Members:
+    dat_paths: list of .dat file paths. Entries refer to them by index.
+    dat_priorities: list of priorities of the .dat files, one per .dat file.
+    dat_ids: array of .dat file indexes, one per entry.
+    paths: list of normalized game paths, one per entry. The same string
+           objects are used as keys of the CatFileLoader's file_index.
+    sizes: array of game file sizes, one per entry.
+    offsets: array of game file offsets inside the .dat files, one per entry.
+    hashes: bytearray of the CAT_HASH_SIZE bytes long hashes of the game
+            files, one per entry.
+    """
+
+    __slots__ = ('dat_paths', 'dat_priorities', 'dat_ids', 'paths', 'sizes',
+                 'offsets', 'hashes')
+
+    def __init__(self):
+        """Initialize an empty table."""
+        self.dat_paths = []
+        self.dat_priorities = []
+        self.dat_ids = array('H')
+        self.paths = []
+        self.sizes = array('Q')
+        self.offsets = array('Q')
+        self.hashes = bytearray()
+
+    def __len__(self):
+        """Returns the number of entries."""
+        return len(self.paths)
+
+    def add_dat(self, dat_path, priority=0):
+        """Adds a .dat file to the table and returns its index.
+
+        Arguments:
+        dat_path: path to the .dat file.
+        priority: priority of the .dat file. Entries from .dat files with
+                  higher priority override entries from lower priority ones.
+        """
+        self.dat_paths.append(dat_path)
+        self.dat_priorities.append(priority)
+        return len(self.dat_paths) - 1
+
+    def get_priority(self, entry_id):
+        """Returns the priority of the .dat file of an entry."""
+        return self.dat_priorities[self.dat_ids[entry_id]]
+
+    # pylint: disable=too-many-arguments
+    def add(self, dat_id, path, size, offset, file_hash=NO_HASH):
+        """Adds an entry to the table and returns its index.
+
+        Arguments:
+        dat_id: index of the .dat file returned by add_dat.
+        path: normalized game path of the game file.
+        size: size of the game file.
+        offset: offset of the game file inside the .dat file.
+        file_hash: CAT_HASH_SIZE bytes long hash of the game file.
+        """
+        self.dat_ids.append(dat_id)
+        self.paths.append(path)
+        self.sizes.append(size)
+        self.offsets.append(offset)
+        self.hashes += file_hash
+
+        return len(self.paths) - 1
+
+    # pylint: disable=too-many-arguments
+    def replace(self, entry_id, dat_id, size, offset, file_hash=NO_HASH):
+        """Makes an entry point to a game file from another .dat file.
+
+        Arguments:
+        entry_id: index of the entry to replace.
+        dat_id: index of the .dat file returned by add_dat.
+        size: size of the game file.
+        offset: offset of the game file inside the .dat file.
+        file_hash: CAT_HASH_SIZE bytes long hash of the game file.
+        """
+        self.dat_ids[entry_id] = dat_id
+        self.sizes[entry_id] = size
+        self.offsets[entry_id] = offset
+
+        start = entry_id * CAT_HASH_SIZE
+        self.hashes[start:start + CAT_HASH_SIZE] = file_hash
+
+    def get(self, entry_id):
+        """Returns a CatEntry view of an entry."""
+        start = entry_id * CAT_HASH_SIZE
+
+        return CatEntry(self.dat_paths[self.dat_ids[entry_id]],
+                        self.paths[entry_id],
+                        self.sizes[entry_id],
+                        self.offsets[entry_id],
+                        format_cat_hash(
+                            self.hashes[start:start + CAT_HASH_SIZE]))
+
+
+def format_cat_hash(file_hash):
+    """Returns the hex string of a hash stored in a CatEntryTable, or None if
+    the hash is missing.
+    """
+    return file_hash.hex() if file_hash != NO_HASH else None
+
+
+def parse_cat_hash(text):
+    """Parses the hex hash of a .cat file line. Returns NO_HASH if the hash
+    is malformed.
+    """
+    try:
+        file_hash = bytes.fromhex(text)
+    except ValueError:
+        return NO_HASH
+
+    return file_hash if len(file_hash) == CAT_HASH_SIZE else NO_HASH
+
+
+# Bump this whenever the format of the cached .cat entries changes
+CAT_CACHE_VERSION = 3
+
+
+class CatCache:
+    """On-disk cache of parsed .cat files.
+    Each .cat file is cached in a separate file named after the hash of its
+    absolute path. A cache file is only used if the size and the modification
+    time of the .cat file are the same as when the cache file was written.
+
+    Members:
+    cache_dir: directory where the cache files are stored.
+    """
+
+    def __init__(self, cache_dir):
+        """Initialize the cache.
+
+        Arguments:
+        cache_dir: directory where the cache files are stored. It is created
+                   when the first cache file is written.
+        """
+        self.cache_dir = cache_dir
+
+    def _cache_path(self, cat_path):
+        """Returns the path to the cache file of a .cat file."""
+        key = hashlib.sha1(os.path.abspath(cat_path).encode('utf-8'))
+        return os.path.join(self.cache_dir, key.hexdigest() + '.catcache')
+
+    @staticmethod
+    def _cat_key(cat_path):
+        """Returns the tuple that identifies the current version of a .cat
+        file.
+        """
+        stat = os.stat(cat_path)
+        return (CAT_CACHE_VERSION, os.path.abspath(cat_path), stat.st_size,
+                stat.st_mtime_ns)
+
+    def load(self, cat_path):
+        """Returns the cached entries of a .cat file or None if the cache is
+        missing or stale.
+
+        Arguments:
+        cat_path: path to .cat file.
+        """
+        try:
+            with open(self._cache_path(cat_path), 'rb') as cache_file:
+                key, entries = pickle.loads(cache_file.read())
+        except FileNotFoundError:
+            return None
+        # pylint: disable=broad-except
+        except Exception as ex:
+            LOG.warning('Failed to read cache for .cat file %s: %s',
+                        cat_path, ex)
+            return None
+
+        if key != self._cat_key(cat_path):
+            LOG.debug('Cache for .cat file %s is stale', cat_path)
+            return None
+
+        return entries
+
+    def _summary_path(self, fs_root):
+        """Returns the path to the cache file of the summary of the .cat files
+        in a directory.
+        """
+        key = hashlib.sha1(os.path.abspath(fs_root).encode('utf-8'))
+        return os.path.join(self.cache_dir, key.hexdigest() + '.catsummary')
+
+    @staticmethod
+    def _summary_key(cat_paths):
+        """Returns the tuple that identifies the current version of a set of
+        .cat files.
+        """
+        return (CAT_CACHE_VERSION,) + tuple(
+            CatCache._cat_key(cat_path) for cat_path in sorted(cat_paths)
+        )
+
+    def load_summary(self, fs_root, cat_paths):
+        """Returns the cached CatSummary of a set of .cat files or None if the
+        cache is missing or stale.
+
+        Arguments:
+        fs_root: directory of the .cat files.
+        cat_paths: paths to all the .cat files in the directory.
+        """
+        try:
+            with open(self._summary_path(fs_root), 'rb') as cache_file:
+                key, summary = pickle.loads(cache_file.read())
+
+            if key != self._summary_key(cat_paths):
+                LOG.debug('Summary of .cat files in %s is stale', fs_root)
+                return None
+        except FileNotFoundError:
+            return None
+        # pylint: disable=broad-except
+        except Exception as ex:
+            LOG.warning('Failed to read summary of .cat files in %s: %s',
+                        fs_root, ex)
+            return None
+
+        return CatSummary(*summary)
+
+    def store_summary(self, fs_root, cat_paths, summary):
+        """Saves the CatSummary of a set of .cat files in the cache.
+        Failures are logged and otherwise ignored.
+
+        Arguments:
+        fs_root: directory of the .cat files.
+        cat_paths: paths to all the .cat files in the directory.
+        summary: CatSummary to save.
+        """
+        cat_bits = summary.cat_bits
+        cat_paths_by_bit = sorted(cat_bits.keys(), key=cat_bits.get)
+
+        try:
+            self._write(self._summary_path(fs_root), (
+                self._summary_key(cat_paths),
+                (cat_paths_by_bit, summary.dir_masks)
+            ))
+        except OSError as ex:
+            LOG.warning('Failed to write summary of .cat files in %s: %s',
+                        fs_root, ex)
+
+    def _write(self, cache_path, obj):
+        """Atomically writes a pickled object to a cache file."""
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+
+        # atomically replace the old cache file
+        os.replace(tmp_path, cache_path)
+
+    def store(self, cat_path, entries):
+        """Saves the entries of a .cat file in the cache.
+        Failures are logged and otherwise ignored.
+
+        Arguments:
+        cat_path: path to .cat file.
+        entries: (game_paths, sizes, offsets, hashes) tuple as returned by
+                 parse_cat_file.
+        """
+        try:
+            self._write(self._cache_path(cat_path),
+                        (self._cat_key(cat_path), entries))
+        except OSError as ex:
+            LOG.warning('Failed to write cache for .cat file %s: %s',
+                        cat_path, ex)
+
+
+class CatSummary:
+    """Summary of the directories that have entries in each .cat file of a
+    CatFileLoader. It is used to skip loading .cat files that cannot contain
+    a looked up path.
+
+    Members:
+    cat_bits: dictionary of cat_path -> bit assigned to the .cat file.
+    dir_masks: dictionary of directory path -> bit mask of the .cat files
+               that contain entries under the directory. Contains all the
+               directory prefixes, the root directory is ''.
+    """
+
+    __slots__ = ('cat_bits', 'dir_masks')
+
+    def __init__(self, cat_paths, dir_masks):
+        """Initialize the summary.
+
+        Arguments:
+        cat_paths: list of paths to .cat files. The bit of each .cat file is
+                   given by its position in this list.
+        dir_masks: see class members.
+        """
+        self.cat_bits = {cat_path: 1 << i for (i, cat_path)
+                         in enumerate(cat_paths)}
+        self.dir_masks = dir_masks
+
+    @staticmethod
+    def build(cat_dirs):
+        """Builds a summary.
+
+        Arguments:
+        cat_dirs: dictionary of cat_path -> set of directories containing
+                  files in the .cat file.
+        """
+        cat_paths = sorted(cat_dirs.keys())
+        dir_masks = {}
+
+        for (i, cat_path) in enumerate(cat_paths):
+            bit = 1 << i
+            prefixes = set([''])
+
+            for dir_path in cat_dirs[cat_path]:
+                while dir_path and dir_path not in prefixes:
+                    prefixes.add(dir_path)
+                    dir_path = dir_path.rpartition('/')[0]
+
+            for prefix in prefixes:
+                dir_masks[prefix] = dir_masks.get(prefix, 0) | bit
+
+        return CatSummary(cat_paths, dir_masks)
+
+    def may_contain(self, cat_path, dir_path):
+        """Returns True if a .cat file can contain entries under a directory.
+
+        Arguments:
+        cat_path: path to .cat file. Unknown .cat files can contain anything.
+        dir_path: normalized directory path.
+        """
+        bit = self.cat_bits.get(cat_path)
+        if bit is None:
+            return True
+
+        return bool(self.dir_masks.get(dir_path, 0) & bit)
+
+
+def parse_cat_file(cat_path):
+    """Parses a .cat file.
+    Returns a (game_paths, sizes, offsets, hashes) tuple or None if the .cat
+    file is malformed. game_paths is the list of lowercase paths of the game
+    files with redundant slashes removed, sizes and offsets are arrays with the
+    sizes and offsets of the game files and hashes is a bytes object with the
+    concatenated CAT_HASH_SIZE bytes long hashes of the game files.
+
+    Arguments:
+    cat_path: path to .cat file.
+    """
+    file_offset = 0
+    game_paths = []
+    sizes = array('Q')
+    offsets = array('Q')
+    hashes = bytearray()
+
+    with open(cat_path, 'r') as cat_file:
+        for line_no, line in enumerate(cat_file):
+            if not line:
+                continue
+
+            # match 'path size timestamp hash' format
+            # path might contain spaces, so a rsplit is needed
+            parts = line.lower().rsplit(' ', 3)
+            if len(parts) != 4:
+                LOG.error('Cat file %s has invalid entry on line %s',
+                          cat_path, line_no + 1)
+                return None
+
+            game_path = normalize_game_path(parts[0])
+            size = int(parts[1])
+            offset = file_offset
+            file_offset += size
+
+            if not game_path:
+                LOG.error('Cat file %s contains malformed game file path '
+                          '%s on line %s', cat_path, parts[0], line_no + 1)
+                continue
+
+            game_paths.append(game_path)
+            sizes.append(size)
+            offsets.append(offset)
+            hashes += parse_cat_hash(parts[3].strip())
+
+    return game_paths, sizes, offsets, bytes(hashes)
+
+
+def read_cat_entries(cat_path, cache=None):
+    """Reads the entries of a .cat file from the cache or, if the cache is
+    missing or stale, by parsing the .cat file and updating the cache.
+    Returns the entries in the format of parse_cat_file or None if the .cat
+    file is malformed.
+
+    Arguments:
+    cat_path: path to .cat file.
+    cache: CatCache or None.
+    """
+    entries = None
+
+    if cache:
+        entries = cache.load(cat_path)
+
+    if entries is None:
+        LOG.info('Loading .cat file %s', cat_path)
+
+        # if the cat file is malformed no entries are returned, so the file
+        # won't be partially loaded
+        entries = parse_cat_file(cat_path)
+
+        if entries is not None and cache:
+            cache.store(cat_path, entries)
+    else:
+        LOG.info('Loaded .cat file %s from cache', cat_path)
+
+    return entries
+
+
+class DirNode:
+    """Directory node used by the CatFileLoader to represent the game file
+    structure.
+
+    Members:
+    children: dictionary of name -> DirNode for directories or CatFileLoader
+              for extensions.
+    files: array of the indexes in the owner's CatEntryTable of the files in
+           the directory.
+    """
+
+    # optimization: http://book.pythontips.com/en/latest/__slots__magic.html
+    __slots__ = ('children', 'files')
+
+    def __init__(self):
+        """Initialize node with empty files and empty children."""
+
+        self.children = {}
+        self.files = array('I')
+
+
+# pylint: disable=too-many-instance-attributes
+class CatFileLoader(FileLoader):
+    """File loader that directly reads game .cat and .dat files.
+    Cat files should be loaded in the order of highest to lowest priority.
+    Game files can be opened and read from multiple threads. Loading .cat
+    files and looking files up is serialized by the loader's lock.
+
+    Members:
+    fs_root: path to the cat root directory.
+    file_tree: DirNode instance representing the root of the game files
+               hierarchy. Only used to list directories.
+    file_index: dictionary of normalized game path -> index in self.entries
+                of the loaded game files. Used to look files up without
+                walking the file tree.
+    data_files: pairs of (cat_path, dat_path) of data files to load, ordered
+                from lowest to highest priority. Those are consumed from
+                the tail to the head by the _load_next_cat_file function.
+    loaded: set of path to loaded .cat files. This is used to avoid loading
+            game files twice in case self.load_from_game_root is called
+            multiple times.
+    cache: CatCache used to avoid parsing unchanged .cat files or None.
+    use_mmap: if True then .dat files are memory-mapped and game files are
+              read directly from the mappings.
+    dat_maps: dictionary of dat_path -> memoryview over the memory-mapped .dat
+              file. Each .dat file is mapped once, when the first game file
+              inside it is opened.
+    dat_pool: DatFilePool of open .dat files, shared with the extensions.
+    entries: CatEntryTable holding the entries of the loaded .cat files.
+    extensions: dictionary of extension name -> CatFileLoader of the
+                extension.
+    priorities: dictionary of cat_path -> priority of the registered .cat
+                files. Entries from .cat files with higher priority override
+                entries from lower priority ones.
+    summary: CatSummary of the registered .cat files or None if not
+             available. Used to only load the .cat files that can contain a
+             looked up path. Requires the cache.
+    cat_dirs: dictionary of cat_path -> set of directories of the files in the
+              .cat file. Collected while the summary is not available in order
+              to build it once all .cat files are loaded. None if not
+              collecting.
+    negative_cache: NegativeCache of normalized game paths that are not in
+                    any of the registered .cat files. Cleared when new .cat
+                    files are registered.
+    stats: LoaderStats of the operations of this loader, shared with the
+           extensions.
+    lock: RLock that protects the loaded entries, the file tree and the
+          memory-mapped .dat files. Shared with the extensions.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, fs_root='./', cache_dir=None, use_mmap=False,
+                 max_open_dats=DEFAULT_MAX_OPEN_DATS):
+        """Initializes the cat loader.
+
+        Arguments:
+        fs_root: path to where the .cat and .dat files are stored.
+        cache_dir: directory where parsed .cat files are cached. Use None to
+                   disable caching.
+        use_mmap: memory-map .dat files instead of opening them for every game
+                  file.
+        max_open_dats: maximum number of .dat files kept open.
+        """
+        self.fs_root = fs_root
+        self.file_tree = DirNode()
+        self.file_index = {}
+        self.data_files = []
+        self.loaded = set()
+        self.cache = CatCache(cache_dir) if cache_dir else None
+        self.use_mmap = use_mmap
+        self.dat_maps = {}
+        self.dat_pool = DatFilePool(max_open_dats)
+        self.entries = CatEntryTable()
+        self.extensions = {}
+        self.priorities = {}
+        self.summary = None
+        self.cat_dirs = {} if self.cache else None
+        self._summary_checked = False
+        self.negative_cache = NegativeCache()
+        self.stats = LoaderStats()
+        self.lock = threading.RLock()
+
+    def _load_cat_file(self, cat_path, dat_path, reason):
+        """Loads a .cat file and stores entries in the file tree.
+        The entries will reference the .dat file.
+        Returns True if the .cat file is parsed and loaded sucessfully.
+        This function will NOT override already existing entries.
+
+        Arguments:
+        cat_path: path to .cat file.
+        dat_path: path to .dat file.
+        reason: why the .cat file is loaded, counted in the stats.
+        """
+        with self.stats.timed('load_cat'):
+            entries = read_cat_entries(cat_path, self.cache)
+            if entries is None:
+                self._record_cat_dirs(cat_path, set())
+                return False
+
+            self._add_cat_entries(cat_path, dat_path, entries)
+
+        self.stats.count('cats_loaded')
+        self.stats.count('cats_loaded.' + reason)
+
+        return True
+
+    def _add_cat_entries(self, cat_path, dat_path, entries):
+        """Stores the entries of a .cat file in the file tree. This function
+        will NOT override already existing entries from .cat files with higher
+        priority.
+
+        Arguments:
+        cat_path: path to .cat file.
+        dat_path: path to .dat file.
+        entries: entries of the .cat file as returned by parse_cat_file.
+        """
+        file_index = self.file_index
+        table = self.entries
+        priority = self.priorities.get(cat_path, 0)
+        dat_id = table.add_dat(dat_path, priority)
+        game_paths, sizes, offsets, hashes = entries
+
+        if self.cat_dirs is not None:
+            self._record_cat_dirs(
+                cat_path, set(p.rpartition('/')[0] for p in game_paths)
+            )
+
+        # files of a .cat file are grouped by directory, so the directory
+        # node of the previous file is reused
+        last_dir = None
+        node = None
+
+        # now add entries to the file index and the file tree
+        for (i, game_path) in enumerate(game_paths):
+            size = sizes[i]
+            offset = offsets[i]
+            file_hash = hashes[i * CAT_HASH_SIZE:(i + 1) * CAT_HASH_SIZE]
+
+            entry = file_index.get(game_path)
+            if entry is not None:
+                if table.get_priority(entry) < priority:
+                    # .cat files can be loaded out of order when the summary
+                    # is used, so override entries with lower priority
+                    table.replace(entry, dat_id, size, offset, file_hash)
+
+                continue
+
+            dir_path = game_path.rpartition('/')[0]
+            if dir_path != last_dir:
+                node = self._make_dir(dir_path)
+                last_dir = dir_path
+
+            entry = table.add(dat_id, game_path, size, offset, file_hash)
+            file_index[game_path] = entry
+            node.files.append(entry)
+
+        self.loaded.add(cat_path)
+
+    def _make_dir(self, dir_path):
+        """Returns the DirNode of a directory, creating it and its parents
+        if needed.
+
+        Arguments:
+        dir_path: normalized game path of the directory.
+        """
+        k = self.file_tree
+
+        for directory in dir_path.split('/') if dir_path else []:
+            knext = k.children.get(directory)
+            if knext is None:
+                knext = k.children[directory] = DirNode()
+
+            k = knext
+
+        return k
+
+    def _record_cat_dirs(self, cat_path, dirs):
+        """Records the directories of a loaded .cat file while the summary is
+        being collected. Once all the registered .cat files are recorded the
+        summary is built and saved in the cache.
+
+        Arguments:
+        cat_path: path to .cat file.
+        dirs: set of directories of the files in the .cat file.
+        """
+        if self.cat_dirs is None:
+            return
+
+        self.cat_dirs[cat_path] = dirs
+
+        if all(c in self.cat_dirs for c in self.priorities):
+            self.summary = CatSummary.build(self.cat_dirs)
+            self.cache.store_summary(self.fs_root, list(self.priorities),
+                                     self.summary)
+            self.cat_dirs = None
+
+    def _get_summary(self):
+        """Returns the CatSummary of the registered .cat files, loading it from
+        the cache the first time it's needed, or None if not available.
+        """
+        if not self._summary_checked and self.cache and self.priorities:
+            self._summary_checked = True
+
+            summary = self.cache.load_summary(self.fs_root,
+                                              list(self.priorities))
+            if summary is not None:
+                self.summary = summary
+                self.cat_dirs = None
+
+        return self.summary
+
+    def _register_data_files(self, data_files):
+        """Records new data files with a lower priority than the already
+        registered ones.
+
+        Arguments:
+        data_files: pairs of (cat_path, dat_path), ordered from lowest to
+                    highest priority.
+        """
+        with self.lock:
+            lowest = min(self.priorities.values(), default=0)
+
+            for (i, (cat_path, _)) in enumerate(reversed(data_files)):
+                self.priorities.setdefault(cat_path, lowest - 1 - i)
+
+            self.data_files = data_files + self.data_files
+
+            # the cached summary must cover all the registered .cat files
+            self.summary = None
+            self._summary_checked = False
+
+            # the new .cat files might contain previously missing files
+            self.negative_cache.clear()
+
+    def _load_next_cat_file(self, dir_path=None, reason='lookup'):
         """Loads the next cat file in order from highest to lowest priority.
         Works by removing the last pair of self.data_files (if any) and loading
         it.
         Returns False if no new data file can be loaded.
+
+        Arguments:
+        dir_path: normalized path of the directory being looked up. If given
+                  and the summary is available then .cat files that have no
+                  entries under this directory are skipped and kept for
+                  later.
+        reason: why the .cat file is loaded, counted in the stats. One of
+                'lookup' (file lookup), 'path' (directory lookup),
+                'directory' (directory listing) or 'all'.
         """
+        summary = self._get_summary() if dir_path is not None else None
         loaded = False
+        i = len(self.data_files)
 
-        while self.data_files and not loaded:
-            (cat_path, dat_path) = self.data_files.pop()
+        while i > 0 and not loaded:
+            i -= 1
+            (cat_path, dat_path) = self.data_files[i]
+
+            if summary is not None and \
+               not summary.may_contain(cat_path, dir_path):
+                continue
+
+            del self.data_files[i]
 
             if cat_path not in self.loaded:
-                loaded = self._load_cat_file(cat_path, dat_path)
+                loaded = self._load_cat_file(cat_path, dat_path, reason)
 
         return loaded
 
+    def _load_all_cat_files(self, dir_path=None):
+        """Loads all the remaining cat files, from highest to lowest priority.
+
+        Arguments:
+        dir_path: normalized path of a directory. If given and the summary is
+                  available then only .cat files with entries under this
+                  directory are loaded.
+        """
+        reason = 'all' if dir_path is None else 'directory'
+
+        while self._load_next_cat_file(dir_path, reason):
+            pass
+
     def load_from_game_root(self):
         """Looks .cat and .dat files in the game's root directory and records
         them in self.data_files. Those files will be loaded lazily when needed.
@@ -412,7 +1840,7 @@ class CatFileLoader:
             else:
                 break
 
-        self.data_files = data_files + self.data_files
+        self._register_data_files(data_files)
 
         return loaded
 
@@ -446,7 +1874,7 @@ class CatFileLoader:
             else:
                 break
 
-        self.data_files = data_files + self.data_files
+        self._register_data_files(data_files)
 
         return loaded
 
@@ -465,11 +1893,26 @@ class CatFileLoader:
         if ext_name in exts_node.children:
             raise ValueError('Extensions {} already present'.format(ext_name))
 
-        floader = CatFileLoader(ext_dir)
+        floader = CatFileLoader(
+            ext_dir, cache_dir=self.cache.cache_dir if self.cache else None,
+            use_mmap=self.use_mmap)
+        floader.dat_pool = self.dat_pool
+        floader.stats = self.stats
+        floader.lock = self.lock
         exts_node.children[ext_name] = floader
+        self.extensions[ext_name] = floader
 
         return floader._load_extension(ext_dir)
 
+    def _get_file_entry(self, path):
+        """Returns the index in self.entries of a game file from the loaded
+        .cat files or None if not found. No .cat file is loaded.
+
+        Arguments:
+        path: normalized game path.
+        """
+        return self.file_index.get(path)
+
     def _find_entry(self, parts):
         """Tries to find the entry at the path described in the parts list.
         Loads new cat files if needed in order to resolve the path.
@@ -484,29 +1927,34 @@ class CatFileLoader:
         Returns:
         owner, entry
         owner: CatFileLoader owning the returned entry
-        entry: DirNode|CatEntry|CatFileLoader
+        entry: DirNode|int|CatFileLoader, where int is the index of a file in
+               the owner's CatEntryTable
         """
+        self.stats.count('find_entry_calls')
         k = self.file_tree
 
-        while parts:
-            if isinstance(k, CatEntry):
-                # A file cannot contain other files
-                return None, None
-
+        for (i, part) in enumerate(parts):
             if isinstance(k, CatFileLoader):
                 # delegate the rest of the search to this fie loader
-                return k._find_entry(parts)
+                return k._find_entry(parts[i:])
 
             if isinstance(k, DirNode):
-                part = parts.pop(0)
                 knext = k.children.get(part)
 
-                # load new .cat file and retry until the directory is found or
-                # no new .cat file can be loaded.
-                while not knext and self._load_next_cat_file():
+                # load new .cat file and retry until the directory is found,
+                # the path is found to be a file or no new .cat file can be
+                # loaded.
+                dir_path = '/'.join(parts[:i])
+                file_path = '/'.join(parts[:i + 1])
+                while knext is None and file_path not in self.file_index and \
+                        self._load_next_cat_file(dir_path, 'path'):
                     knext = k.children.get(part)
 
-                if not knext:
+                if knext is None and i == len(parts) - 1:
+                    knext = self.file_index.get(file_path)
+
+                if knext is None:
+                    self.stats.count('find_entry_misses')
                     return None, None
 
                 k = knext
@@ -516,33 +1964,278 @@ class CatFileLoader:
 
         return self, k
 
+    def _may_be_overridden(self, entry, dir_path):
+        """Returns True if an entry can be overridden by a .cat file that is
+        not loaded yet. This can only happen when the summary is used, because
+        .cat files are then loaded out of order.
+
+        Arguments:
+        entry: index of the entry in self.entries.
+        dir_path: normalized path of the directory of the entry.
+        """
+        if not self.data_files:
+            return False
+
+        summary = self._get_summary()
+        if summary is None:
+            return False
+
+        priority = self.entries.get_priority(entry)
+
+        for (cat_path, _) in self.data_files:
+            if self.priorities.get(cat_path, 0) > priority and \
+               cat_path not in self.loaded and \
+               summary.may_contain(cat_path, dir_path):
+                return True
+
+        return False
+
+    def _find_file(self, path):
+        """Looks up a file in the file index.
+        Loads new cat files if needed in order to find the file.
+        Returns the CatEntry of the file or None if the file cannot be found.
+
+        Arguments:
+        path: normalized game path of the file. See normalize_game_path.
+        """
+        if path.startswith('extensions/'):
+            parts = path.split('/', 2)
+            ext_loader = self.extensions.get(parts[1])
+
+            if ext_loader is not None and len(parts) == 3:
+                # delegate the search to the extension's file loader
+                # pylint: disable=protected-access
+                return ext_loader._find_file(parts[2])
+
+        with self.lock:
+            self.stats.count('file_lookups')
+
+            if self.negative_cache.check(path):
+                self.stats.count('file_lookup_misses')
+                return None
+
+            entry = self._get_file_entry(path)
+
+            # load new .cat file and retry until the file is found or no new
+            # .cat file can be loaded.
+            dir_path = path.rpartition('/')[0]
+            while (entry is None or
+                   self._may_be_overridden(entry, dir_path)) and \
+                    self._load_next_cat_file(dir_path):
+                entry = self._get_file_entry(path)
+
+            if entry is None:
+                self.negative_cache.add(path)
+                self.stats.count('file_lookup_misses')
+                return None
+
+            return self.entries.get(entry)
+
     def open_file(self, path):
         """Open file.
         Returns a binary file-like object.
         """
-        parts = split_game_path(path.lower())
-        if not path:
+        norm_path = normalize_game_path(path)
+        if not norm_path:
             raise ValueError('Empty path {}'.format(path))
 
-        _, entry = self._find_entry(parts)
-        if not entry:
-            raise ValueError('Path {} isn\'t a file'.format(path))
+        with self.stats.timed('open_file'):
+            entry = self._find_file(norm_path)
+            if entry is None:
+                raise ValueError('Path {} isn\'t a file'.format(path))
 
-        if not isinstance(entry, CatEntry):
-            raise ValueError(
-                'Path {} isn\'t a file, but a: {}'.format(path, type(entry)))
+            self.stats.count('files_opened')
+
+            if self.use_mmap:
+                self.stats.count('bytes_mapped', entry.size)
+                return self._open_mapped(entry)
+
+            handle = self.dat_pool.acquire(entry.dat_path)
+
+        return DatGameFile(self.dat_pool, handle, entry.offset, entry.size,
+                           self.stats)
+
+    def close(self):
+        """Close the .dat files kept open by this loader and its extensions.
+        Game files that are still open remain readable until they are closed.
+        """
+        self.dat_pool.close()
+
+        for loader in [self] + list(self.extensions.values()):
+            loader.close_dat_maps()
+
+    def close_dat_maps(self):
+        """Unmaps the memory-mapped .dat files of this loader.
+        Mappings still used by open game files or by views returned by
+        read_many are unmapped when those are garbage collected.
+        """
+        with self.lock:
+            for dat_map in self.dat_maps.values():
+                mapping = dat_map.obj
+
+                try:
+                    dat_map.release()
+                    mapping.close()
+                except BufferError:
+                    pass
+
+            self.dat_maps.clear()
+
+    def _open_mapped(self, entry):
+        """Open a game file from its memory-mapped .dat file.
+        Returns a MmapGameFile.
 
-        dat_file = open(entry.dat_path, 'rb')
+        Arguments:
+        entry: CatEntry of the game file.
+        """
+        if not entry.size:
+            return MmapGameFile(memoryview(b''))
+
+        dat_map = self._get_dat_map(entry.dat_path)
+
+        return MmapGameFile(dat_map[entry.offset:entry.offset + entry.size])
+
+    def _get_dat_map(self, dat_path):
+        """Returns a memoryview over a memory-mapped .dat file. Each .dat file
+        is mapped only once.
+        """
+        with self.lock:
+            dat_map = self.dat_maps.get(dat_path)
+            if dat_map is None:
+                with open(dat_path, 'rb') as dat_file:
+                    dat_map = memoryview(mmap.mmap(dat_file.fileno(), 0,
+                                                   access=mmap.ACCESS_READ))
+
+                self.dat_maps[dat_path] = dat_map
+
+            return dat_map
+
+    def _read_range(self, dat_path, offset, size):
+        """Reads a range of bytes from a .dat file.
+        Returns a bytes-like object.
+
+        Arguments:
+        dat_path: path to .dat file.
+        offset: offset of the first byte to read.
+        size: number of bytes to read.
+        """
+        if not size:
+            return b''
+
+        self.stats.count('bytes_read', size)
+
+        if self.use_mmap:
+            return self._get_dat_map(dat_path)[offset:offset + size]
+
+        handle = self.dat_pool.acquire(dat_path)
+        try:
+            chunks = []
+            while size > 0:
+                chunk = handle.pread(size, offset)
+                if not chunk:
+                    break
+
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+
+            return b''.join(chunks)
+        finally:
+            self.dat_pool.release(handle)
+
+    def read_many(self, paths):
+        """Read multiple game files.
+        Returns an iterable over (path, data) pairs.
+        All the paths are resolved first, raising ValueError if a path isn't a
+        file. The game files are then read grouped by .dat file and in order
+        of their offset. Game files that are next to each other in a .dat
+        file are read using a single read. The pairs are returned in the order
+        the files are read.
+
+        Arguments:
+        paths: iterable of game file paths.
+        """
+        entries = []
+        seen = set()
+
+        for path in paths:
+            if path in seen:
+                continue
+
+            seen.add(path)
+
+            norm_path = normalize_game_path(path)
+            entry = self._find_file(norm_path) if norm_path else None
+            if entry is None:
+                raise ValueError('Path {} isn\'t a file'.format(path))
+
+            entries.append((entry, path))
+
+        entries.sort(key=lambda e: (e[0].dat_path, e[0].offset))
+
+        i = 0
+        while i < len(entries):
+            # coalesce the following game files into a single read
+            first = entries[i][0]
+            start = first.offset
+            end = start + first.size
+            j = i + 1
 
-        return DatGameFile(dat_file, entry.offset, entry.size)
+            while j < len(entries):
+                entry = entries[j][0]
+                entry_end = max(end, entry.offset + entry.size)
+
+                if entry.dat_path != first.dat_path or \
+                   entry.offset > end + MAX_READ_GAP or \
+                   entry_end - start > MAX_READ_SIZE:
+                    break
+
+                end = entry_end
+                j += 1
+
+            with self.stats.timed('read_many'):
+                data = memoryview(self._read_range(first.dat_path, start,
+                                                   end - start))
+
+            for (entry, path) in entries[i:j]:
+                file_start = entry.offset - start
+                yield path, bytes(data[file_start:file_start + entry.size])
+
+            i = j
 
     def file_exists(self, path):
         """Check if file exists."""
-        parts = split_game_path(path.lower())
+        return self._find_file(normalize_game_path(path)) is not None
 
-        (_, entry) = self._find_entry(parts)
+    def get_file_hash(self, path):
+        """Returns the hash of the content of a game file, as stored in the
+        .cat file.
+        """
+        entry = self._find_file(normalize_game_path(path))
 
-        return entry is not None and isinstance(entry, CatEntry)
+        return entry.hash if entry else None
+
+    def get_stats(self):
+        """Returns a dictionary with statistics about the operations performed
+        by the file loader and its extensions.
+        """
+        stats = self.stats.get_stats()
+        stats['negative_cache'] = self.negative_cache.get_stats()
+
+        for (ext_name, ext_loader) in sorted(self.extensions.items()):
+            stats['negative_cache.' + ext_name] = \
+                ext_loader.negative_cache.get_stats()
+
+        return stats
+
+    def prefetch(self, paths):
+        """Hint that game files will be read soon.
+        The ranges of the game files in the .dat files are prefetched.
+        """
+        entries = (self._find_file(normalize_game_path(path))
+                   for path in paths)
+        prefetch_ranges((entry.dat_path, entry.offset, entry.size)
+                        for entry in entries if entry and entry.size)
 
     def list_files(self, path):
         """List game files under a game directory."""
@@ -552,19 +2245,686 @@ class CatFileLoader:
         # add a slash at the end
         full_path = '/'.join(parts) + '/'
 
-        owner, entry = self._find_entry(parts)
-        if isinstance(entry, CatFileLoader):
-            for e in entry.list_files(''):
-                yield Entry(full_path + e.path, e.name)
-        elif isinstance(entry, DirNode):
-            # must load ALL .cat files to ensure that all the files in the
-            # directory are known
-            while owner._load_next_cat_file():
-                pass
-
-            for e in entry.children.values():
-                if isinstance(e, CatEntry):
-                    yield Entry(full_path + e.name, e.name)
+        if len(parts) >= 2 and parts[0] == 'extensions' and \
+           parts[1] in self.extensions:
+            # delegate the listing to the extension's file loader
+            ext_loader = self.extensions[parts[1]]
+            for e in ext_loader.list_files('/'.join(parts[2:])):
+                yield Entry(full_path + e.name, e.name)
+
+            return
+
+        with self.stats.timed('list_files'), self.lock:
+            _, entry = self._find_entry(parts)
+            if isinstance(entry, DirNode):
+                # must load ALL .cat files that have entries in the directory
+                # to ensure that all the files in the directory are known
+                self._load_all_cat_files('/'.join(parts))
+
+                paths = self.entries.paths
+                names = [paths[e].rpartition('/')[2] for e in entry.files]
+
+        if isinstance(entry, DirNode):
+            for name in names:
+                yield Entry(full_path + name, name)
         else:
             raise ValueError(
-                'Path {} isn\'t a file, but a: {}'.format(path, type(entry)))
\ No newline at end of file
+                'Path {} isn\'t a file, but a: {}'.format(path, type(entry)))
+
+    def walk(self, path):
+        """Recursively list game files under a game directory."""
+        parts = split_game_path(path.lower())
+        dir_path = '/'.join(parts)
+
+        if len(parts) >= 2 and parts[0] == 'extensions' and \
+           parts[1] in self.extensions:
+            # delegate the walk to the extension's file loader
+            ext_loader = self.extensions[parts[1]]
+            ext_prefix = 'extensions/{}/'.format(parts[1])
+            for e in ext_loader.walk('/'.join(parts[2:])):
+                yield Entry(ext_prefix + e.path, e.name)
+
+            return
+
+        with self.lock:
+            _, entry = self._find_entry(parts)
+            if not isinstance(entry, DirNode):
+                return
+
+            # all the .cat files with entries in the subtree are loaded at
+            # once, instead of one listing per subdirectory
+            with self.stats.timed('walk'):
+                self._load_all_cat_files(dir_path)
+
+        paths = self.entries.paths
+        stack = [(dir_path, entry)]
+        while stack:
+            (dir_path, node) = stack.pop()
+            prefix = dir_path + '/' if dir_path else ''
+
+            # the lock isn't held while yielding, so the directory is copied
+            with self.lock:
+                names = [paths[e].rpartition('/')[2] for e in node.files]
+                children = list(node.children.items())
+
+            for name in names:
+                yield Entry(prefix + name, name)
+
+            for (name, e) in children:
+                if isinstance(e, DirNode):
+                    stack.append((prefix + name, e))
+                else:
+                    # extension subtree, only reachable when walking from
+                    # above the extension's directory
+                    for ext_e in e.walk(''):
+                        yield Entry(prefix + name + '/' + ext_e.path,
+                                    ext_e.name)
+
+    def glob(self, pattern):
+        """List game files whose paths match a glob pattern.
+        Matching is case insensitive.
+        """
+        (base, regex) = compile_glob(pattern.lower())
+
+        for entry in self.walk(base):
+            if regex.match(entry.path):
+                yield entry
+
+    def export_index(self, index_path):
+        """Exports the index of all the game files into an index file that
+        can be attached to by SharedCatFileLoader, e.g. from worker processes.
+        All the .cat files of this loader and its extensions are loaded.
+        Returns the number of game files in the index.
+
+        Arguments:
+        index_path: path of the index file to write.
+        """
+        with self.lock:
+            self._load_all_cat_files()
+
+            files = dict((path, self.entries.get(entry_id))
+                         for (path, entry_id) in self.file_index.items())
+
+            # extensions take precedence, as in _find_file
+            for (ext_name, ext_loader) in sorted(self.extensions.items()):
+                # pylint: disable=protected-access
+                ext_loader._load_all_cat_files()
+
+                prefix = 'extensions/{}/'.format(ext_name)
+                for (path, entry_id) in ext_loader.file_index.items():
+                    files[prefix + path] = ext_loader.entries.get(entry_id)
+
+        write_cat_index(index_path, sorted(self.extensions), files)
+
+        return len(files)
+
+
+# Cat index file header: magic, format version, number of extensions, number of
+# .dat files and number of game files.
+# The header is followed by these sections, each padded to 8 bytes:
+# - extension names, .dat paths and game paths, each stored as an array of
+#   count + 1 uint64 offsets followed by the UTF-8 encoded strings. Game paths
+#   are normalized and sorted.
+# - game file sizes and offsets in their .dat files, as uint64 arrays.
+# - hashes of the game files, CAT_HASH_SIZE bytes each.
+# - .dat file ids of the game files, as an uint16 array.
+# Arrays use the native byte order, so index files are not portable.
+CAT_INDEX_HEADER = struct.Struct('<8sIIQQ')
+CAT_INDEX_MAGIC = b'X4FCIDX\0'
+CAT_INDEX_VERSION = 2
+
+
+def _pack_strings(strings):
+    """Encodes strings into an (offsets, blob) pair of a cat index file."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = array('Q', [0])
+
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    return offsets.tobytes(), b''.join(encoded)
+
+
+def write_cat_index(index_path, extensions, files):
+    """Writes a cat index file. See CAT_INDEX_HEADER for the format.
+
+    Arguments:
+    index_path: path of the index file to write.
+    extensions: list of extension names.
+    files: dictionary of normalized game path -> CatEntry.
+    """
+    paths = sorted(files, key=lambda path: path.encode('utf-8'))
+    dat_paths = sorted(set(entry.dat_path for entry in files.values()))
+    dat_ids = dict((dat_path, i) for (i, dat_path) in enumerate(dat_paths))
+
+    sections = [
+        *_pack_strings(extensions),
+        *_pack_strings(dat_paths),
+        *_pack_strings(paths),
+        array('Q', (files[path].size for path in paths)).tobytes(),
+        array('Q', (files[path].offset for path in paths)).tobytes(),
+        b''.join(parse_cat_hash(files[path].hash or '') for path in paths),
+        array('H', (dat_ids[files[path].dat_path]
+                    for path in paths)).tobytes(),
+    ]
+
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(CAT_INDEX_HEADER.pack(
+            CAT_INDEX_MAGIC, CAT_INDEX_VERSION, len(extensions),
+            len(dat_paths), len(paths)))
+
+        for section in sections:
+            index_file.write(section)
+            index_file.write(b'\0' * (-len(section) % 8))
+
+    # atomically replace the old index file
+    os.replace(tmp_path, index_path)
+
+
+class StringTable:
+    """Read-only sequence of strings stored in a memory-mapped cat index file.
+    Items are returned as UTF-8 encoded bytes.
+
+    Members:
+    offsets: memoryview over the count + 1 offsets of the strings.
+    blob: memoryview over the encoded strings.
+    """
+
+    __slots__ = ('offsets', 'blob')
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+
+class SharedCatFileLoader(CatFileLoader):
+    """Cat file loader that attaches read-only to an index file exported by
+    CatFileLoader.export_index. The index file is memory-mapped, so any number
+    of processes can share it without parsing .cat files or unpickling an
+    index. Game files are read from the .dat files as by CatFileLoader.
+    Used by worker processes that are not forked, see macros.MacroDB.
+
+    Members:
+    index_path: path to the index file.
+    index_view: memoryview over the memory-mapped index file.
+    index_extensions: list of names of extensions in the index.
+    dat_paths: list of paths to .dat files.
+    paths: StringTable of the sorted normalized game paths.
+    sizes: memoryview over the sizes of the game files.
+    offsets: memoryview over the offsets of the game files.
+    hashes: memoryview over the hashes of the game files.
+    dat_ids: memoryview over the indices in dat_paths of the game files.
+    """
+
+    def __init__(self, index_path, use_mmap=False,
+                 max_open_dats=DEFAULT_MAX_OPEN_DATS):
+        """Attaches to an index file.
+
+        Arguments:
+        index_path: path to the index file.
+        use_mmap: memory-map .dat files instead of opening them for every game
+                  file.
+        max_open_dats: maximum number of .dat files kept open.
+        """
+        super(SharedCatFileLoader, self).__init__(
+            use_mmap=use_mmap, max_open_dats=max_open_dats)
+
+        self.index_path = index_path
+
+        with open(index_path, 'rb') as index_file:
+            view = memoryview(mmap.mmap(index_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+
+        try:
+            (magic, version, ext_count, dat_count, file_count) = \
+                CAT_INDEX_HEADER.unpack_from(view)
+        except struct.error:
+            magic = None
+
+        if magic != CAT_INDEX_MAGIC or version != CAT_INDEX_VERSION:
+            raise ValueError('Invalid cat index file: {}'.format(index_path))
+
+        pos = CAT_INDEX_HEADER.size
+
+        def section(size, fmt):
+            nonlocal pos
+            if size > len(view) - pos:
+                raise ValueError(
+                    'Truncated cat index file: {}'.format(index_path))
+
+            data = view[pos:pos + size]
+            pos += size + -size % 8
+            return data.cast(fmt)
+
+        def strings(count):
+            offsets = section((count + 1) * 8, 'Q')
+            return StringTable(offsets, section(offsets[-1], 'B'))
+
+        self.index_view = view
+        self.index_extensions = [ext.decode('utf-8')
+                                 for ext in strings(ext_count)]
+        self.dat_paths = [dat_path.decode('utf-8')
+                          for dat_path in strings(dat_count)]
+        self.paths = strings(file_count)
+        self.sizes = section(file_count * 8, 'Q')
+        self.offsets = section(file_count * 8, 'Q')
+        self.hashes = section(file_count * CAT_HASH_SIZE, 'B')
+        self.dat_ids = section(file_count * 2, 'H')
+
+    def load_from_game_root(self):
+        """Not supported, the index is read-only."""
+        raise ValueError(
+            'Cat index {} is read-only'.format(self.index_path))
+
+    def load_extension(self, ext_name, ext_dir):
+        """Not supported, the index is read-only."""
+        raise ValueError(
+            'Cat index {} is read-only'.format(self.index_path))
+
+    def export_index(self, index_path):
+        """Not supported, the index file can be shared as is."""
+        raise ValueError(
+            'Cat index {} is already exported'.format(self.index_path))
+
+    def get_extensions(self):
+        """Return the list of names of extensions in the index."""
+        return list(self.index_extensions)
+
+    def _find_file(self, path):
+        """Looks up a file in the index.
+        Returns the CatEntry of the file or None if the file cannot be found.
+
+        Arguments:
+        path: normalized game path of the file. See normalize_game_path.
+        """
+        key = path.encode('utf-8')
+
+        i = bisect.bisect_left(self.paths, key)
+        if i == len(self.paths) or self.paths[i] != key:
+            return None
+
+        start = i * CAT_HASH_SIZE
+
+        return CatEntry(self.dat_paths[self.dat_ids[i]],
+                        path,
+                        self.sizes[i],
+                        self.offsets[i],
+                        format_cat_hash(
+                            bytes(self.hashes[start:start + CAT_HASH_SIZE])))
+
+    def walk(self, path):
+        """Recursively list game files under a game directory."""
+        dir_path = normalize_game_path(path)
+        prefix = (dir_path + '/' if dir_path else '').encode('utf-8')
+
+        i = bisect.bisect_left(self.paths, prefix)
+        while i < len(self.paths):
+            game_path = self.paths[i]
+            if not game_path.startswith(prefix):
+                break
+
+            game_path = game_path.decode('utf-8')
+            yield Entry(game_path, game_path.rpartition('/')[2])
+            i += 1
+
+    def list_files(self, path):
+        """List game files under a game directory."""
+        dir_path = normalize_game_path(path)
+        prefix_len = len(dir_path) + 1 if dir_path else 0
+        found = False
+
+        for entry in self.walk(dir_path):
+            found = True
+            if '/' not in entry.path[prefix_len:]:
+                yield entry
+
+        if not found:
+            raise ValueError('Path {} isn\'t a directory'.format(path))
+
+
+class RecordingFileLoader(FileLoader):
+    """File loader that forwards all operations to another file loader and
+    records the game files and directories that are used.
+    Used to find out which files must be written in a pack file.
+
+    Members:
+    floader: underlying FileLoader.
+    paths: dictionary that maps normalized game paths of the files that were
+           read or found to exist to the paths used to access them.
+    dirs: set of normalized game paths of listed directories.
+    """
+
+    def __init__(self, floader):
+        """Initialize file loader.
+
+        Arguments:
+        floader: FileLoader to forward operations to.
+        """
+        self.floader = floader
+        self.paths = {}
+        self.dirs = set()
+
+    def _record(self, path):
+        """Records a used game file."""
+        self.paths.setdefault(normalize_game_path(path), path)
+
+    def _record_dirs(self, path, entries):
+        """Records a walked directory and the directories of the listed game
+        files while yielding the entries.
+        """
+        self.dirs.add(normalize_game_path(path))
+
+        for entry in entries:
+            self.dirs.add(normalize_game_path(entry.path.rpartition('/')[0]))
+            yield entry
+
+    def get_extensions(self):
+        """Return the list of names of extensions in the game directory."""
+        return self.floader.get_extensions()
+
+    def open_file(self, path):
+        """Open game file."""
+        game_file = self.floader.open_file(path)
+        self._record(path)
+
+        return game_file
+
+    def file_exists(self, path):
+        """Check if file exists."""
+        exists = self.floader.file_exists(path)
+        if exists:
+            self._record(path)
+
+        return exists
+
+    def list_files(self, path):
+        """List game files under a game directory."""
+        self.dirs.add(normalize_game_path(path))
+
+        return self.floader.list_files(path)
+
+    def walk(self, path):
+        """Recursively list game files under a game directory."""
+        return self._record_dirs(path, self.floader.walk(path))
+
+    def glob(self, pattern):
+        """List game files whose paths match a glob pattern."""
+        base = compile_glob(pattern.lower())[0]
+
+        return self._record_dirs(base, self.floader.glob(pattern))
+
+    def read_many(self, paths):
+        """Read multiple game files."""
+        for (path, data) in self.floader.read_many(paths):
+            self._record(path)
+            yield path, data
+
+    def get_stats(self):
+        """Returns the statistics of the underlying file loader."""
+        return self.floader.get_stats()
+
+    def get_file_hash(self, path):
+        """Returns the hash of the content of a game file."""
+        return self.floader.get_file_hash(path)
+
+    def prefetch(self, paths):
+        """Hint that game files will be read soon."""
+        self.floader.prefetch(paths)
+
+
+# Pack file header: magic, format version, index offset and index size
+PACK_HEADER = struct.Struct('<8sIQQ')
+PACK_MAGIC = b'X4FPACK\0'
+PACK_VERSION = 3
+
+
+def write_pack_file(pack_path, floader, paths, dirs=(), compress=False):
+    """Write game files into a pack file that can be loaded by
+    PackFileLoader.
+
+    The pack file starts with a header, followed by the contents of the game
+    files and the index, encoded as JSON. Game files are stored in path order
+    and each of them is compressed separately, if enabled and if it makes the
+    file smaller. The MD5 hash of each game file is stored in the index, like
+    in .cat files.
+
+    Returns the number of files written.
+
+    Arguments:
+    pack_path: path of the pack file to write.
+    floader: FileLoader to read the game files from.
+    paths: iterable of game paths to write.
+    dirs: iterable of game directory paths that are listable even if no files
+          in them are written.
+    compress: compress game files with zlib.
+    """
+    files = {}
+    tmp_path = '{}.{}.tmp'.format(pack_path, os.getpid())
+
+    with open(tmp_path, 'wb') as pack_file:
+        pack_file.write(b'\0' * PACK_HEADER.size)
+        offset = PACK_HEADER.size
+
+        for (path, data) in floader.read_many(sorted(paths)):
+            size = len(data)
+            file_hash = hashlib.md5(data).hexdigest()
+            compressed = False
+
+            if compress:
+                zdata = zlib.compress(data, 9)
+                if len(zdata) < size:
+                    (data, compressed) = (zdata, True)
+
+            pack_file.write(data)
+            files[normalize_game_path(path)] = \
+                [offset, len(data), size, compressed, file_hash]
+            offset += len(data)
+
+        index = json.dumps({
+            'extensions': floader.get_extensions(),
+            'dirs': sorted(set(normalize_game_path(d) for d in dirs)),
+            'files': files,
+        }, separators=(',', ':')).encode()
+
+        pack_file.write(index)
+        pack_file.seek(0)
+        pack_file.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, offset,
+                                         len(index)))
+
+    # atomically replace the old pack file
+    os.replace(tmp_path, pack_path)
+
+    return len(files)
+
+
+def _is_str_list(value):
+    """Returns True if value is a list of strings."""
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def _is_pack_entry(entry, start, end):
+    """Returns True if entry is a valid file entry of a pack index, whose
+    data lies between start and end.
+    """
+    if not isinstance(entry, list) or len(entry) != 5:
+        return False
+
+    (offset, stored_size, size, compressed, file_hash) = entry
+
+    # bool is a subclass of int
+    if not all(isinstance(v, int) and not isinstance(v, bool)
+               for v in (offset, stored_size, size)):
+        return False
+
+    return start <= offset and 0 <= stored_size <= end - offset and \
+        size >= 0 and isinstance(compressed, bool) and \
+        isinstance(file_hash, str)
+
+
+def read_pack_index(view):
+    """Reads and validates the index of a pack file written by
+    write_pack_file. Raises ValueError if the pack file is malformed.
+    Returns a (extensions, dirs, files) tuple, see PackFileLoader.
+
+    Arguments:
+    view: memoryview over the content of the pack file.
+    """
+    try:
+        (magic, version, index_offset, index_size) = \
+            PACK_HEADER.unpack_from(view)
+    except struct.error as ex:
+        raise ValueError('Invalid pack file header') from ex
+
+    if magic != PACK_MAGIC or version != PACK_VERSION:
+        raise ValueError('Invalid pack file header')
+
+    if index_offset < PACK_HEADER.size or \
+       index_size > len(view) - index_offset:
+        raise ValueError('Invalid pack file index range')
+
+    try:
+        index = json.loads(
+            bytes(view[index_offset:index_offset + index_size]))
+    except ValueError as ex:
+        raise ValueError('Invalid pack file index: {}'.format(ex)) from ex
+
+    if not isinstance(index, dict) or \
+       not _is_str_list(index.get('extensions')) or \
+       not _is_str_list(index.get('dirs')) or \
+       not isinstance(index.get('files'), dict):
+        raise ValueError('Invalid pack file index')
+
+    files = {}
+    for (path, entry) in index['files'].items():
+        if not _is_pack_entry(entry, PACK_HEADER.size, index_offset):
+            raise ValueError('Invalid pack file entry {}'.format(path))
+
+        files[path] = tuple(entry)
+
+    return index['extensions'], index['dirs'], files
+
+
+class PackFileLoader(FileLoader):
+    """Pack File Loader.
+    Loads game files from a pack file written by write_pack_file. The whole
+    pack file is memory-mapped once and uncompressed game files are read
+    directly from the mapping.
+
+    Members:
+    pack_path: path to the pack file.
+    view: memoryview over the memory-mapped pack file.
+    extensions: list of names of extensions in the pack file.
+    files: dictionary that maps normalized game paths to
+           (offset, stored size, size, compressed, hash) tuples.
+    dirs: dictionary that maps normalized game directory paths to lists of
+          names of the files directly inside them.
+    """
+
+    def __init__(self, pack_path):
+        """Initialize file loader.
+
+        Arguments:
+        pack_path: path to the pack file.
+        """
+        self.pack_path = pack_path
+
+        with open(pack_path, 'rb') as pack_file:
+            self.view = memoryview(mmap.mmap(pack_file.fileno(), 0,
+                                             access=mmap.ACCESS_READ))
+
+        try:
+            (self.extensions, dirs, self.files) = read_pack_index(self.view)
+        except ValueError as ex:
+            self.close()
+            raise ValueError('{}: {}'.format(ex, pack_path)) from ex
+
+        self.dirs = dict((d, []) for d in dirs)
+
+        for path in self.files:
+            (dir_path, _, name) = path.rpartition('/')
+            self.dirs.setdefault(dir_path, []).append(name)
+
+    def get_extensions(self):
+        """Return the list of names of extensions in the pack file."""
+        return list(self.extensions)
+
+    def open_file(self, path):
+        """Open game file."""
+        entry = self.files.get(normalize_game_path(path))
+        if entry is None:
+            raise FileNotFoundError('Game file {} not found'.format(path))
+
+        (offset, stored_size, _, compressed, _) = entry
+        data = self.view[offset:offset + stored_size]
+
+        if compressed:
+            return io.BytesIO(zlib.decompress(data))
+
+        return MmapGameFile(data)
+
+    def file_exists(self, path):
+        """Check if file exists."""
+        return normalize_game_path(path) in self.files
+
+    def get_file_hash(self, path):
+        """Returns the hash of the content of a game file."""
+        entry = self.files.get(normalize_game_path(path))
+
+        return entry[4] if entry else None
+
+    def prefetch(self, paths):
+        """Hint that game files will be read soon."""
+        entries = (self.files.get(normalize_game_path(path)) for path in paths)
+        prefetch_ranges((self.pack_path, entry[0], entry[1])
+                        for entry in entries if entry and entry[1])
+
+    def close(self):
+        """Unmaps the pack file. If game files are still open the mapping is
+        unmapped when they are garbage collected.
+        """
+        mapping = self.view.obj
+
+        try:
+            self.view.release()
+            mapping.close()
+        except BufferError:
+            pass
+
+    def list_files(self, path):
+        """List game files under a game directory."""
+        dir_path = normalize_game_path(path)
+
+        names = self.dirs.get(dir_path)
+        if names is None:
+            raise ValueError('Path {} isn\'t a directory'.format(path))
+
+        prefix = dir_path + '/' if dir_path else ''
+        for name in names:
+            yield Entry(prefix + name, name)
+
+    def walk(self, path):
+        """Recursively list game files under a game directory."""
+        dir_path = normalize_game_path(path)
+        prefix = dir_path + '/' if dir_path else ''
+
+        for game_path in self.files:
+            if game_path.startswith(prefix):
+                yield Entry(game_path, game_path.rpartition('/')[2])
+
+    def glob(self, pattern):
+        """List game files whose paths match a glob pattern.
+        Matching is case insensitive.
+        """
+        (base, regex) = compile_glob(pattern.lower())
+
+        for entry in self.walk(base):
+            if regex.match(entry.path):
+                yield entry
@@ -3,6 +3,7 @@
 import re
 import logging
 from lxml import etree
+from misc import compile_xpath
 
 
 LOG = logging.getLogger(__name__)
@@ -22,6 +23,24 @@ class LanguageResolver:
         self.lang_trees = {}
         self.default_lang = None
 
+    def __getstate__(self):
+        """Returns the state of the resolver for pickling, e.g. to send it to
+        worker processes. Language trees are serialized as XML.
+        """
+        return {
+            'lang_trees': dict((lang_name, etree.tostring(lang_tree))
+                               for (lang_name, lang_tree)
+                               in self.lang_trees.items()),
+            'default_lang': self.default_lang,
+        }
+
+    def __setstate__(self, state):
+        """Restores a pickled resolver. See __getstate__."""
+        self.lang_trees = dict(
+            (lang_name, etree.ElementTree(etree.fromstring(data)))
+            for (lang_name, data) in state['lang_trees'].items())
+        self.default_lang = state['default_lang']
+
     def load_lang_file(self, lang_name, lang_file):
         """Loads a language file.
         If this is the first language loaded and no default language was
@@ -29,10 +48,14 @@ class LanguageResolver:
 
         Arguments:
         lang_name: name that will be used to refer to this language.
-        lang_file: file path, bytes or file-like object containing the game XML
-                   file defining the language strings.
+        lang_file: file path, bytes-like object or file-like object containing
+                   the game XML file defining the language strings.
         """
-        self.lang_trees[lang_name] = etree.parse(lang_file)
+        if isinstance(lang_file, (bytes, bytearray, memoryview)):
+            self.lang_trees[lang_name] = \
+                etree.ElementTree(etree.fromstring(lang_file))
+        else:
+            self.lang_trees[lang_name] = etree.parse(lang_file)
 
         if self.default_lang is None:
             self.default_lang = lang_name
@@ -71,8 +94,8 @@ class LanguageResolver:
             page_id = match[1]
             t_id = match[2]
 
-            ts_xpath = "./page[@id='{}']/t[@id='{}']".format(page_id, t_id)
-            text_nodes = lang_tree.xpath(ts_xpath)
+            text_nodes = compile_xpath('./page[@id=$page]/t[@id=$t]')(
+                lang_tree, page=page_id, t=t_id)
             if not text_nodes:
                 LOG.error('Failure while resolving string: cannot resolve '
                           'filed %s', match[0])
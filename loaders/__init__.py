@@ -6,6 +6,8 @@ data dictionaries.
 
 __all__ = [
     'engine_loader',
+    'get_macro_types',
+    'iter_wares',
     'missilelauncher_loader',
     'shield_loader',
     'ship_loader',
@@ -15,8 +17,10 @@ __all__ = [
 
 
 from loaders.macro_loaders import engine_loader
+from loaders.macro_loaders import get_macro_types
 from loaders.macro_loaders import missilelauncher_loader
 from loaders.macro_loaders import shield_loader
 from loaders.macro_loaders import ship_loader
 from loaders.macro_loaders import weapon_loader
+from loaders.ware_loader import iter_wares
 from loaders.ware_loader import ware_loader
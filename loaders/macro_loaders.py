@@ -1,14 +1,58 @@
 """Loads data about ships and equipment."""
 
+import functools
 import logging
+import os
 import re
-from misc import get_xpath_attrib, get_xpath_attribs, find_nodes_with_tag
+from collections import Counter
+from misc import get_xpath_attrib, get_xpath_attribs, compile_xpath
 from misc import get_path_in_ext
 
 
 LOG = logging.getLogger(__name__)
 
 
+# Bump this whenever macro_parser or component_parser change, in order to
+# invalidate their results stored in MacroDB parse caches.
+PARSER_VERSION = 1
+
+# Matches the words of a tags string, the tags a connection has.
+TAG_WORD_RE = re.compile(r'\w+')
+
+# Macro classes whose properties are used when exporting each kind of game
+# object, including the classes of the macros they refer to.
+OBJECT_MACRO_TYPES = {
+    'engines': ['engine'],
+    'missilelaunchers': ['missilelauncher', 'missileturret', 'bomblauncher',
+                         'missile', 'bomb', 'engine'],
+    'shields': ['shieldgenerator'],
+    'ships': ['ship_xs', 'ship_s', 'ship_m', 'ship_l', 'ship_xl',
+              'dockingbay', 'storage'],
+    'weapons': ['weapon', 'turret', 'bullet'],
+}
+
+
+def get_macro_types(objects):
+    """Returns the set of macro classes whose properties are needed to export
+    the given kinds of game objects. See MacroDB.set_wanted_types.
+
+    Arguments:
+    objects: iterable of kinds of game objects, e.g. 'engines', 'ships'.
+    """
+    types = set()
+    for obj in objects:
+        types.update(OBJECT_MACRO_TYPES.get(obj, []))
+
+    return types
+
+
+def _get_weapon_type(entry):
+    """Returns the weapon type of a macro file listed from
+    'assets/props/WeaponSystems/<type>/macros/'.
+    """
+    return os.path.basename(os.path.dirname(os.path.dirname(entry.path)))
+
+
 # pylint: disable=too-many-statements,too-many-locals
 def macro_parser(macro_id, macro_type, prop_node, lresolver):
     """Macro parser.
@@ -362,33 +406,74 @@ def get_size_from_tags(tags):
     return ''
 
 
-def get_component_size(comp_node, comp_name, conns_xpath, tag):
-    """Gets the size of a component by looking for a connection node with a
+class ConnectionIndex:
+    """Index of the tags of the connections of a component, built in a single
+    pass over the connection nodes.
+
+    Members:
+    counts: Counter of tag -> number of connections with the tag.
+    sizes: dict of tag -> Counter of size tag -> number of connections with
+           the tag and the size, in the order the sizes were first found. See
+           get_size_from_tags.
+    """
+
+    __slots__ = ('counts', 'sizes')
+
+    def __init__(self, comp_node, conns_xpath):
+        """Builds the index.
+
+        Arguments:
+        comp_node: component node.
+        conns_xpath: XPath that references the connection nodes inside the
+                     component node.
+        """
+        self.counts = Counter()
+        self.sizes = {}
+
+        # many connections share the same tags, so each distinct tags string
+        # is only split once. Strings are kept in the order they were first
+        # found.
+        tags_strings = Counter(
+            node.get('tags', '')
+            for node in compile_xpath(conns_xpath)(comp_node)
+        )
+
+        for (tags, num) in tags_strings.items():
+            size = get_size_from_tags(tags)
+
+            for tag in set(TAG_WORD_RE.findall(tags)):
+                self.counts[tag] += num
+
+                if size:
+                    self.sizes.setdefault(tag, Counter())[size] += num
+
+    def count(self, tag):
+        """Returns the number of connections with a tag."""
+        return self.counts[tag]
+
+
+def get_component_size(conn_index, comp_name, tag):
+    """Gets the size of a component from the size of its connections with a
     certain tag.
 
     Arguments:
-    comp_node: component node.
+    conn_index: ConnectionIndex of the component.
     comp_name: name of the component. Used for logging.
-    conns_xpath: XPath that references the connection nodes inside the
-                 component node.
     tag: tag to look for.
     """
-    size = ''
-
-    for node in find_nodes_with_tag(comp_node, conns_xpath, tag):
-        temp = get_size_from_tags(node.get('tags', ''))
-        if temp and not size:
-            size = temp
-        elif temp and size:
-            LOG.warning('Error when determine %s size for %s: too many'
-                        '%s nodes found', tag, comp_name, tag)
-            return size
-
-    if not size:
+    sizes = conn_index.sizes.get(tag)
+
+    if not sizes:
         LOG.warning('Cannot determine %s size for %s: no %s nodes found',
                     tag, comp_name, tag)
+        return ''
+
+    if sum(sizes.values()) > 1:
+        LOG.warning('Error when determine %s size for %s: too many'
+                    '%s nodes found', tag, comp_name, tag)
 
-    return size
+    # the size of the first connection with the tag
+    return next(iter(sizes))
 
 
 # pylint: disable=too-many-branches
@@ -401,45 +486,25 @@ def component_parser(comp_name, comp_type, comp_node):
     comp_node: component XML node.
     """
     props = {}
-    conns_xpath = './connections/connection[@tags]'
+    conns = ConnectionIndex(comp_node, './connections/connection[@tags]')
 
     if comp_type.startswith('ship_'):
-        def glen(gen):
-            i = 0
-            for _ in gen:
-                i += 1
-
-            return i
-
-        props['num_engines'] = glen(
-            find_nodes_with_tag(comp_node, conns_xpath, 'engine')
-        )
-        props['num_shields'] = glen(
-            find_nodes_with_tag(comp_node, conns_xpath, 'shield')
-        )
-        props['num_weapons'] = glen(
-            find_nodes_with_tag(comp_node, conns_xpath, 'weapon')
-        )
-        props['num_turrets'] = glen(
-            find_nodes_with_tag(comp_node, conns_xpath, 'turret')
-        )
-        props['num_countermeasures'] = glen(
-            find_nodes_with_tag(comp_node, conns_xpath, 'countermeasures')
-        )
+        props['num_engines'] = conns.count('engine')
+        props['num_shields'] = conns.count('shield')
+        props['num_weapons'] = conns.count('weapon')
+        props['num_turrets'] = conns.count('turret')
+        props['num_countermeasures'] = conns.count('countermeasures')
     elif comp_type == 'storage':
         pass
     elif comp_type == 'shieldgenerator':
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'shield')
+        props['size'] = get_component_size(conns, comp_name, 'shield')
     elif comp_type == 'engine' and comp_name.startswith('engine_'):
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'engine')
+        props['size'] = get_component_size(conns, comp_name, 'engine')
     elif comp_type == 'engine' and comp_name.startswith('generic_'):
         # no size in generic_engine components
         pass
     elif comp_type == 'engine' and comp_name.startswith('thruster_'):
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'thruster')
+        props['size'] = get_component_size(conns, comp_name, 'thruster')
     elif comp_type == 'cockpit':
         pass
     elif comp_type == 'dockingbay':
@@ -447,24 +512,19 @@ def component_parser(comp_name, comp_type, comp_node):
     elif comp_type == 'dockarea':
         pass
     elif comp_type in ('weapon', 'bomblauncher'):
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'weapon')
+        props['size'] = get_component_size(conns, comp_name, 'weapon')
     elif comp_type == 'turret':
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'turret')
+        props['size'] = get_component_size(conns, comp_name, 'turret')
     elif comp_type == 'bullet':
         pass
     elif comp_type == 'missilelauncher':
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'missile')
+        props['size'] = get_component_size(conns, comp_name, 'missile')
     elif comp_type == 'missileturret':
-        props['size'] = \
-            get_component_size(comp_node, comp_name, conns_xpath, 'missile')
+        props['size'] = get_component_size(conns, comp_name, 'missile')
     elif comp_type in ('missile', 'bomb'):
         pass
     elif comp_type == 'bomblauncher':
-        props['size'] = get_component_size(comp_node, comp_name, conns_xpath,
-                                           'bomblauncher')
+        props['size'] = get_component_size(conns, comp_name, 'bomblauncher')
     elif comp_type == 'buildmodule':
         pass
     elif comp_type == 'buildprocessor':
@@ -489,18 +549,23 @@ def ship_loader(floader, lresolver, macro_db, ext_name):
     ext_name: extension to load ships from. Use None for the base game.
     """
 
-    # pylint: disable=no-value-for-parameter
     macro_db.set_macro_parser(
-        lambda *args: macro_parser(*args, lresolver=lresolver)
+        functools.partial(macro_parser, lresolver=lresolver),
+        cache_key=('macro_parser', PARSER_VERSION)
+    )
+    macro_db.set_component_parser(
+        component_parser, cache_key=('component_parser', PARSER_VERSION)
     )
-    macro_db.set_component_parser(component_parser)
 
     units_root_xml = get_path_in_ext('assets/units', ext_name)
+    paths = []
 
     for ship_size in ['xs', 's', 'm', 'l', 'xl']:
         ships_path = '{}/size_{}/macros/'.format(units_root_xml, ship_size)
         for entry in floader.list_files(ships_path):
-            macro_db.load_macro_xml_file(entry.path)
+            paths.append(entry.path)
+
+    macro_db.load_macro_xml_files(paths)
 
 
 def shield_loader(floader, lresolver, macro_db, ext_name):
@@ -513,20 +578,25 @@ def shield_loader(floader, lresolver, macro_db, ext_name):
     macro_db: MacroDB used to load macros.
     ext_name: extension to load shields from. Use None for the base game.
     """
-    # pylint: disable=no-value-for-parameter
     macro_db.set_macro_parser(
-        lambda *args: macro_parser(*args, lresolver=lresolver)
+        functools.partial(macro_parser, lresolver=lresolver),
+        cache_key=('macro_parser', PARSER_VERSION)
+    )
+    macro_db.set_component_parser(
+        component_parser, cache_key=('component_parser', PARSER_VERSION)
     )
-    macro_db.set_component_parser(component_parser)
 
     shields_xml_root = get_path_in_ext(
         'assets/props/SurfaceElements/macros/', ext_name)
+    paths = []
 
     for entry in floader.list_files(shields_xml_root):
         if not entry.name.startswith('shield_'):
             continue
 
-        macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
+
+    macro_db.load_macro_xml_files(paths)
 
 
 def engine_loader(floader, lresolver, macro_db, ext_name):
@@ -539,20 +609,25 @@ def engine_loader(floader, lresolver, macro_db, ext_name):
     macro_db: MacroDB used to load macros.
     ext_name: extension to load engines from. Use None for the base game.
     """
-    # pylint: disable=no-value-for-parameter
     macro_db.set_macro_parser(
-        lambda *args: macro_parser(*args, lresolver=lresolver)
+        functools.partial(macro_parser, lresolver=lresolver),
+        cache_key=('macro_parser', PARSER_VERSION)
+    )
+    macro_db.set_component_parser(
+        component_parser, cache_key=('component_parser', PARSER_VERSION)
     )
-    macro_db.set_component_parser(component_parser)
 
     egines_xml_root = get_path_in_ext('assets/props/Engines/macros/', ext_name)
+    paths = []
 
     for entry in floader.list_files(egines_xml_root):
         if not entry.name.startswith('engine_') and \
            not entry.name.startswith('thruster_'):
             continue
 
-        macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
+
+    macro_db.load_macro_xml_files(paths)
 
 
 def weapon_loader(floader, lresolver, macro_db, ext_name):
@@ -565,31 +640,30 @@ def weapon_loader(floader, lresolver, macro_db, ext_name):
     macro_db: MacroDB used to load macros.
     ext_name: extension to load weapons from. Use None for the base game.
     """
-    # pylint: disable=no-value-for-parameter
     macro_db.set_macro_parser(
-        lambda *args: macro_parser(*args, lresolver=lresolver)
+        functools.partial(macro_parser, lresolver=lresolver),
+        cache_key=('macro_parser', PARSER_VERSION)
+    )
+    macro_db.set_component_parser(
+        component_parser, cache_key=('component_parser', PARSER_VERSION)
     )
-    macro_db.set_component_parser(component_parser)
 
     weapon_xml_root = get_path_in_ext('assets/props/WeaponSystems', ext_name)
+    weapon_types = set(['capital', 'heavy', 'mining', 'standard', 'spacesuit',
+                        'energy', 'xref_parts'])
+    paths = []
 
-    for weapon_type in ['capital', 'heavy', 'mining', 'standard', 'spacesuit',
-                        'energy', 'xref_parts']:
-        path = '{}/{}/macros/'.format(weapon_xml_root, weapon_type)
-
-        try:
-            entries = list(floader.list_files(path))
-        except ValueError:
+    for entry in floader.glob(weapon_xml_root + '/*/macros/*'):
+        if _get_weapon_type(entry).lower() not in weapon_types:
             continue
 
-        for entry in entries:
-            if not entry.name.startswith('weapon_') and \
-               not entry.name.startswith('turret_') and \
-               not entry.name.startswith('spacesuit_gen_laser_') and \
-               not entry.name.startswith('spacesuit_gen_repairweapon_'):
-                continue
+        if not entry.name.startswith('weapon_') and \
+           not entry.name.startswith('turret_') and \
+           not entry.name.startswith('spacesuit_gen_laser_') and \
+           not entry.name.startswith('spacesuit_gen_repairweapon_'):
+            continue
 
-            macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
 
     bullet_xml_root = get_path_in_ext('assets/fx/weaponFx/macros', ext_name)
 
@@ -597,7 +671,9 @@ def weapon_loader(floader, lresolver, macro_db, ext_name):
         if not entry.name.startswith('bullet_'):
             continue
 
-        macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
+
+    macro_db.load_macro_xml_files(paths)
 
 
 def missilelauncher_loader(floader, lresolver, macro_db, ext_name):
@@ -612,29 +688,28 @@ def missilelauncher_loader(floader, lresolver, macro_db, ext_name):
     ext_name: extension to load missile launchers from.
               Use None for the base game.
     """
-    # pylint: disable=no-value-for-parameter
     macro_db.set_macro_parser(
-        lambda *args: macro_parser(*args, lresolver=lresolver)
+        functools.partial(macro_parser, lresolver=lresolver),
+        cache_key=('macro_parser', PARSER_VERSION)
+    )
+    macro_db.set_component_parser(
+        component_parser, cache_key=('component_parser', PARSER_VERSION)
     )
-    macro_db.set_component_parser(component_parser)
 
     weapon_xml_root = get_path_in_ext('assets/props/WeaponSystems', ext_name)
+    missile_types = set(['dumbfire', 'guided', 'torpedo', 'spacesuit'])
+    paths = []
 
-    for missile_type in ['dumbfire', 'guided', 'torpedo', 'spacesuit']:
-        path = '{}/{}/macros/'.format(weapon_xml_root, missile_type)
-
-        try:
-            entries = list(floader.list_files(path))
-        except ValueError:
+    for entry in floader.glob(weapon_xml_root + '/*/macros/*'):
+        if _get_weapon_type(entry).lower() not in missile_types:
             continue
 
-        for entry in entries:
-            if not entry.name.startswith('weapon_') and \
-               not entry.name.startswith('turret_') and \
-               not entry.name.startswith('spacesuit_gen_bomblauncher_'):
-                continue
+        if not entry.name.startswith('weapon_') and \
+           not entry.name.startswith('turret_') and \
+           not entry.name.startswith('spacesuit_gen_bomblauncher_'):
+            continue
 
-            macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
 
     missiles_xml_root = get_path_in_ext(
         'assets/props/WeaponSystems/missile/macros', ext_name)
@@ -643,7 +718,7 @@ def missilelauncher_loader(floader, lresolver, macro_db, ext_name):
         if not entry.name.startswith('missile_'):
             continue
 
-        macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
 
     bomb_xml_root = get_path_in_ext('assets/fx/weaponFx/macros', ext_name)
 
@@ -651,4 +726,6 @@ def missilelauncher_loader(floader, lresolver, macro_db, ext_name):
         if not entry.name.startswith('bomb_'):
             continue
 
-        macro_db.load_macro_xml_file(entry.path)
+        paths.append(entry.path)
+
+    macro_db.load_macro_xml_files(paths)
@@ -2,71 +2,102 @@
 
 from lxml import etree
 from misc import get_xpath_attribs, get_xpath_attrib, get_path_in_ext
+from misc import compile_xpath
 
 
-def ware_loader(floader, lresolver, ext_name):
-    """Loads and parses wares and returns a ware_id -> ware_props dict.
-    Ware properties is a dictionary.
+def parse_ware(ware, lresolver):
+    """Parses a <ware> node and returns the ware properties dictionary.
 
     Arguments:
-    floader: file loader.
+    ware: XML <ware> node.
     lresolver: language resolver.
-    ext_name: extension to load wares from. Use None for the base game.
     """
-    wares = {}
+    props = {}
 
-    wares_xml_path = get_path_in_ext('libraries/wares.xml', ext_name)
+    props['name'] = lresolver.resolve_string(ware.get('name'), strip=True)
+    props['description'] = \
+        lresolver.resolve_string(ware.get('description'), strip=True)
+    props['factoryname'] = \
+        lresolver.resolve_string(ware.get('factoryname'), strip=True)
+    props['group'] = ware.get('transport')
+    props['volume'] = int(ware.get('volume'))
+    props['tags'] = ware.get('tags', '').split(' ')
+    props['illegal'] = ware.get('illegal', '').split(' ')
 
-    with floader.open_file(wares_xml_path) as wares_file:
-        tree = etree.parse(wares_file)
+    price = get_xpath_attribs(ware, './price', {})
+    props['price_min'] = int(price['min'])
+    props['price_avg'] = int(price['average'])
+    props['price_max'] = int(price['max'])
 
-    for ware in tree.xpath('./ware'):
-        props = {}
+    productions = []
+    for production in compile_xpath('./production')(ware):
+        pprops = {}
+        pprops['time'] = float(production.get('time'))
+        pprops['amount'] = int(production.get('amount'))
+        pprops['method'] = production.get('method')
+        pprops['name'] = \
+            lresolver.resolve_string(production.get('name'), strip=True)
 
-        ware_id = ware.get('id')
-        props['name'] = lresolver.resolve_string(ware.get('name'), strip=True)
-        props['description'] = \
-            lresolver.resolve_string(ware.get('description'), strip=True)
-        props['factoryname'] = \
-            lresolver.resolve_string(ware.get('factoryname'), strip=True)
-        props['group'] = ware.get('transport')
-        props['volume'] = int(ware.get('volume'))
-        props['tags'] = ware.get('tags', '').split(' ')
-        props['illegal'] = ware.get('illegal', '').split(' ')
+        consumption = {}
+        for c_ware in compile_xpath('./primary/ware')(production):
+            consumption[c_ware.get('ware')] = int(c_ware.get('amount'))
 
-        price = get_xpath_attribs(ware, './price', {})
-        props['price_min'] = int(price['min'])
-        props['price_avg'] = int(price['average'])
-        props['price_max'] = int(price['max'])
+        pprops['consumption'] = consumption
 
-        productions = []
-        for production in ware.xpath('./production'):
-            pprops = {}
-            pprops['time'] = float(production.get('time'))
-            pprops['amount'] = int(production.get('amount'))
-            pprops['method'] = production.get('method')
-            pprops['name'] = \
-                lresolver.resolve_string(production.get('name'), strip=True)
+        productions.append(pprops)
 
-            consumption = {}
-            for c_ware in production.xpath('./primary/ware'):
-                consumption[c_ware.get('ware')] = int(c_ware.get('amount'))
+    props['production'] = productions
 
-            pprops['consumption'] = consumption
+    props['licence'] = \
+        get_xpath_attrib(ware, './restriction[@licence]', 'licence', '')
 
-            productions.append(pprops)
+    owners = []
+    for owner in compile_xpath('./owner[@faction]')(ware):
+        owners.append(owner.get('faction'))
 
-        props['production'] = productions
+    props['owners'] = owners
 
-        props['licence'] = \
-            get_xpath_attrib(ware, './restriction[@licence]', 'licence', '')
+    return props
 
-        owners = []
-        for owner in ware.xpath('./owner[@faction]'):
-            owners.append(owner.get('faction'))
 
-        props['owners'] = owners
+def iter_wares(floader, lresolver, ext_name):
+    """Streams the wares file and yields (ware_id, ware_props) tuples as the
+    wares are parsed. See ware_loader.
+    Parsed <ware> nodes are removed from the tree, so only the ware being
+    parsed is kept in memory.
 
-        wares[ware_id] = props
+    Arguments:
+    floader: file loader.
+    lresolver: language resolver.
+    ext_name: extension to load wares from. Use None for the base game.
+    """
+    wares_xml_path = get_path_in_ext('libraries/wares.xml', ext_name)
+
+    with floader.open_file(wares_xml_path) as wares_file:
+        context = etree.iterparse(wares_file, events=('end',), tag='ware')
 
-    return wares
+        for (_, ware) in context:
+            root = ware.getparent()
+
+            # <ware> nodes inside productions are parsed with their ware
+            if root is None or root.getparent() is not None:
+                continue
+
+            yield (ware.get('id'), parse_ware(ware, lresolver))
+
+            # free the parsed wares
+            ware.clear()
+            while ware.getprevious() is not None:
+                del root[0]
+
+
+def ware_loader(floader, lresolver, ext_name):
+    """Loads and parses wares and returns a ware_id -> ware_props dict.
+    Ware properties is a dictionary.
+
+    Arguments:
+    floader: file loader.
+    lresolver: language resolver.
+    ext_name: extension to load wares from. Use None for the base game.
+    """
+    return dict(iter_wares(floader, lresolver, ext_name))
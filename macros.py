@@ -1,15 +1,132 @@
+# pylint: disable=too-many-lines
+
 """Loading and processing of game macro and component files."""
 
 import copy
+import functools
+import hashlib
+import multiprocessing
+import os
+import pickle
 import re
 import logging
+import tempfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from lxml import etree
 
 
-from misc import get_path_in_ext
+from file_loaders import CatFileLoader, SharedCatFileLoader
+from file_loaders import normalize_game_path, read_game_file
+from misc import compile_xpath, get_path_in_ext
 LOG = logging.getLogger(__name__)
 
 
+# Bump this whenever the format of the records stored in ParseCache changes
+PARSE_CACHE_VERSION = 1
+
+# Default maximum number of components kept by ComponentCache
+DEFAULT_COMPONENT_CACHE_SIZE = 1024
+
+# Minimum number of game files to parse for a worker pool to be worth it
+MIN_PARALLEL_FILES = 32
+
+# Worker processes are forked where possible, so they inherit the parsers
+# and the file loader without pickling them. Otherwise they are spawned and
+# _init_worker receives pickled parsers and, for CatFileLoader, the path of
+# an exported cat index.
+WORKER_START_METHOD = 'fork' \
+    if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# MacroDB whose parsers are used by _parse_macro_file and
+# _parse_component_file. Set while a batch of game files is parsed, or for
+# the lifetime of a spawned worker process.
+_WORKER_DB = None
+
+
+def _init_worker(index_path, use_mmap, parsers, wanted_types):
+    """Initializes a spawned worker process.
+
+    Arguments:
+    index_path: path to the cat index exported by MacroDB._get_worker_index
+                or None. If given the worker reads game files itself through
+                a SharedCatFileLoader.
+    use_mmap: memory-map .dat files. See CatFileLoader.
+    parsers: (macro parser, component parser) pair.
+    wanted_types: see MacroDB.wanted_types.
+    """
+    # pylint: disable=global-statement
+    global _WORKER_DB
+    _WORKER_DB = MacroDB(None)
+
+    if index_path is not None:
+        _WORKER_DB.floader = SharedCatFileLoader(index_path, use_mmap)
+
+    (_WORKER_DB.macro_parser, _WORKER_DB.component_parser) = parsers
+    _WORKER_DB.wanted_types = wanted_types
+
+
+def _parse_macro_file(path, data, lazy):
+    """Parses the macros of a game .xml file, possibly in a worker process.
+    Returns the records of MacroDB._parse_macro_tree.
+
+    Arguments:
+    path: path to game .xml file.
+    data: content of the file or None to read it with the file loader of
+          _WORKER_DB.
+    lazy: see MacroDB.load_macro_xml_files.
+    """
+    if data is None:
+        # memory-mapped content is only valid while the file is open
+        with _WORKER_DB.floader.open_file(path) as game_file:
+            return _parse_macro_file(path, read_game_file(game_file), lazy)
+
+    # pylint: disable=protected-access
+    return _WORKER_DB._parse_macro_tree(path, etree.fromstring(data), lazy)
+
+
+def _parse_component_file(comp_name, path, data):
+    """Parses a component of a game .xml file, possibly in a worker process.
+    Returns the properties dict.
+
+    Arguments:
+    comp_name: name of the component.
+    path: path to game .xml file.
+    data: content of the file or None to read it with the file loader of
+          _WORKER_DB.
+    """
+    if data is None:
+        # memory-mapped content is only valid while the file is open
+        with _WORKER_DB.floader.open_file(path) as game_file:
+            return _parse_component_file(comp_name, path,
+                                         read_game_file(game_file))
+
+    # pylint: disable=protected-access
+    return _WORKER_DB._parse_component_tree(
+        comp_name, path,
+        parse_component_xml(data))
+
+
+def parse_component_xml(source):
+    """Parses a component game .xml file and returns its root element.
+
+    Arguments:
+    source: content of the file as a bytes-like object or an open game file.
+    """
+    if not isinstance(source, (bytes, memoryview)):
+        source = read_game_file(source)
+
+    return etree.fromstring(source)
+
+
+# Parsers and wanted macro classes that lazily loaded macros are parsed with.
+# wanted_key is the sorted tuple of wanted_types or None, see MacroDB.
+ParseContext = namedtuple('ParseContext',
+                          ['macro_parser', 'component_parser',
+                           'macro_parser_key', 'wanted_key'])
+
+
 class Macro:
     """Class that describes a macro.
 
@@ -17,16 +134,54 @@ class Macro:
     name: in-game name of the macro.
     type: macro type, a.k.a. class. E.g. engine, shieldgenerator, ship_xl.
     connections: list of (connection_id, macro_id) of connected components.
-    properties: a dictionary containing parsed macro data.
+    properties: a dictionary containing parsed macro data. Lazily loaded
+                macros parse it on first access.
     """
 
-    __slots__ = ('name', 'type', 'connections', 'properties')
+    __slots__ = ('name', 'type', 'connections', '_properties', '_loader')
 
-    def __init__(self, name, macro_type, properties):
+    def __init__(self, name, macro_type, properties, loader=None):
+        """Initialize the macro.
+
+        Arguments:
+        name: macro id.
+        macro_type: macro type, a.k.a. class.
+        properties: properties dict or None if they are loaded by loader.
+        loader: function that returns the properties dict, called on the
+                first access to properties if they are None.
+        """
         self.name = name
         self.type = macro_type
         self.connections = []
-        self.properties = properties
+        self._properties = properties
+        self._loader = loader
+
+    @property
+    def properties(self):
+        """Returns the properties dict, parsing it if needed."""
+        self.load()
+
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties):
+        self._properties = properties
+        self._loader = None
+
+    def is_loaded(self):
+        """Returns True if the properties were parsed."""
+        return self._properties is not None
+
+    def load(self):
+        """Parses the properties if they weren't parsed yet."""
+        if self._properties is None:
+            if self._loader is None:
+                raise ValueError(
+                    'Macro {} has no properties and no loader'.format(
+                        self.name))
+
+            self._properties = self._loader()
+            self._loader = None
 
     def add_connection(self, conn_id, macro_id):
         """Add a connection to this macro.
@@ -35,6 +190,193 @@ class Macro:
         self.connections.append((conn_id, macro_id))
 
 
+class ParseCache:
+    """On-disk cache of the results of parsing game files.
+    Results are keyed by the hash of the content of the parsed game file and
+    by the parser that produced them, so they remain valid across game
+    patches and runs as long as the file and the parser don't change.
+    All the results are stored in a single file per salt, which is read when
+    the cache is created and written by save.
+
+    Members:
+    cache_path: path to the cache file.
+    entries: dictionary of key -> pickled result.
+    dirty: True if entries were added since the cache file was read.
+    hits: number of results found in the cache.
+    misses: number of results not found in the cache.
+    """
+
+    def __init__(self, cache_dir, salt=''):
+        """Initialize the cache and read the cache file if it exists.
+
+        Arguments:
+        cache_dir: directory where the cache file is stored. It is created if
+                   it doesn't exist.
+        salt: string that identifies everything else the parse results depend
+              on, e.g. the language used to resolve names.
+        """
+        key = hashlib.sha1(
+            '{}:{}'.format(PARSE_CACHE_VERSION, salt).encode('utf-8'))
+        self.cache_path = os.path.join(
+            cache_dir, 'parse-{}.pickle'.format(key.hexdigest()))
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                self.entries = pickle.loads(cache_file.read())
+        except FileNotFoundError:
+            pass
+        # pylint: disable=broad-except
+        except Exception as ex:
+            LOG.warning('Failed to read parse cache %s: %s',
+                        self.cache_path, ex)
+
+    def get(self, key):
+        """Returns a cached result or None if it isn't cached.
+        Each call returns a new copy of the result.
+        """
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return pickle.loads(data)
+
+    def __contains__(self, key):
+        """Returns True if a result is cached. Doesn't update the counters."""
+        return key in self.entries
+
+    def put(self, key, result):
+        """Stores a result in the cache. Results that can't be pickled are
+        not cached.
+        """
+        try:
+            self.entries[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as ex:
+            LOG.debug('Failed to cache parse result %s: %s', key, ex)
+            return
+
+        self.dirty = True
+
+    def save(self):
+        """Writes the cache file if the cache changed.
+        Failures are logged and otherwise ignored.
+        """
+        if not self.dirty:
+            return
+
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+
+            data = pickle.dumps(self.entries, pickle.HIGHEST_PROTOCOL)
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(data)
+
+            # atomically replace the old cache file
+            os.replace(tmp_path, self.cache_path)
+        except OSError as ex:
+            LOG.warning('Failed to write parse cache %s: %s',
+                        self.cache_path, ex)
+            return
+
+        self.dirty = False
+
+    def get_stats(self):
+        """Returns a dictionary with the counters and the size of the cache."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+        }
+
+
+class ComponentCache:
+    """Bounded LRU cache of parsed component properties, keyed by component
+    name.
+    Components like cockpits, docking bays and storage are shared by many
+    macros, so this avoids parsing their files again for every macro.
+    When the cache is full the least recently used component is evicted.
+
+    Members:
+    max_size: maximum number of components kept in the cache.
+    entries: OrderedDict of component name -> properties dict, from least to
+             most recently used.
+    hits: number of components found in the cache.
+    misses: number of components not found in the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_COMPONENT_CACHE_SIZE):
+        """Initialize an empty cache.
+
+        Arguments:
+        max_size: maximum number of components kept in the cache.
+        """
+        self.max_size = max(1, max_size)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, comp_name):
+        """Returns a copy of the properties of a component or None if it is
+        not in the cache. Updates the counters.
+        """
+        props = self.entries.get(comp_name)
+        if props is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(comp_name)
+        return copy.deepcopy(props)
+
+    def __contains__(self, comp_name):
+        """Returns True if a component is cached. Doesn't update the
+        counters.
+        """
+        return comp_name in self.entries
+
+    def put(self, comp_name, props):
+        """Stores the properties of a component, evicting the least recently
+        used component if the cache is full.
+        The properties are copied, so they can be modified by the caller.
+        """
+        self.entries[comp_name] = copy.deepcopy(props)
+        self.entries.move_to_end(comp_name)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forgets all components. The counters are kept."""
+        self.entries.clear()
+
+    def get_stats(self):
+        """Returns a dictionary with the counters, the hit rate and the size of
+        the cache.
+        """
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.entries),
+        }
+
+
+def _use_workers(workers, count):
+    """Returns True if count game files should be parsed by a pool of worker
+    processes.
+    """
+    return workers > 1 and count >= MIN_PARALLEL_FILES
+
+
 def noop_parser(_name, _entity_type, _node):
     """Macro and component parser that does nothing and returns an empty dict.
     Used as default parsers for Macro.
@@ -42,17 +384,37 @@ def noop_parser(_name, _entity_type, _node):
     return {}
 
 
+# pylint: disable=too-many-instance-attributes
 class MacroDB:
     """Database that takes care of loading macros and components and resolving
     dependencies.
     Macros and components are processed via custom functions passed through
     set_macro_parser and set_component_parser.
+    If a set of wanted macro classes is given through set_wanted_types, the
+    macros of the other classes are added as stubs: they keep their class
+    and connections, so dependencies are still resolved through them, but
+    their properties and components are not parsed.
+    Macros loaded only to resolve dependencies are lazy: their files are only
+    scanned for connections and their properties are parsed when they are
+    first accessed, with the parsers that were set when they were loaded.
 
     Members:
     floader: the file loader used to resolve dependencies.
+    parse_cache: ParseCache used to skip parsing unchanged game files or None.
+    workers: default number of worker processes used to parse game files.
+    component_cache: ComponentCache of the properties of parsed components.
     macros: dict of Macro objects keyed by the macro id.
     macros_by_type: dict of macro_type -> [macro_name].
     dependencies: unresolved dependencies.
+    loaded_paths: set of normalized paths of game .xml files whose macros
+                  were loaded.
+    missing_paths: set of normalized paths of game .xml files that define
+                   dependencies but that don't exist.
+    dependency_depth: maximum number of waves of macro files that were loaded
+                      to resolve dependencies.
+    unresolved_refs: dict of macro id -> sorted list of the ids of the macros
+                     that refer to it, for the dependencies that couldn't be
+                     resolved.
     macro_path_resolver: function that resolves a macro id to a game .xml file
                          path.
     component_path_resolver: function that resolve a component name to a game
@@ -63,24 +425,60 @@ class MacroDB:
     component_parser: function that receives the component name, component type
                       and component XML node and returns a dictionary that will
                       be combined into the one returned by macro_parser.
+    macro_parser_key: key that identifies macro_parser in parse_cache or None
+                      if its results are not cached.
+    component_parser_key: key that identifies component_parser in parse_cache
+                          or None if its results are not cached.
+    wanted_types: set of macro classes whose properties are parsed or None to
+                  parse the properties of all macros.
+    worker_index: (file loader, temporary directory, index path) of the cat
+                  index exported for spawned worker processes or None. See
+                  _get_worker_index.
+    lazy_records: dictionary of (normalized path, ParseContext) -> dictionary
+                  of macro name -> (properties, component name) of the lazy
+                  macros of a game .xml file that was parsed for another of
+                  its lazy macros. Entries are removed once used.
     """
 
-    def __init__(self, floader):
+    def __init__(self, floader, parse_cache=None, workers=1,
+                 component_cache_size=DEFAULT_COMPONENT_CACHE_SIZE):
         """Initialize the macro database.
 
         Arguments:
-        floader: file loader that will be used by this object.
+        floader: file loader that will be used by this object. Use None to
+                 create an empty database for a worker process.
+        parse_cache: ParseCache used to skip parsing game files whose content
+                     hash, as reported by the file loader, didn't change.
+                     Use None to disable caching.
+        workers: default number of worker processes used to parse game files.
+                 Use 1 to parse them in this process.
+        component_cache_size: maximum number of parsed components kept in
+                              memory.
         """
         self.macro_index = {}
         self.component_index = {}
         self.floader = None
+        self.parse_cache = parse_cache
+        self.workers = workers
+        self.component_cache = ComponentCache(component_cache_size)
         self.macros = {}
         self.macros_by_type = {}
         self.dependencies = set()
+        self.loaded_paths = set()
+        self.missing_paths = set()
+        self.dependency_depth = 0
+        self.unresolved_refs = {}
 
         self.macro_parser = noop_parser
         self.component_parser = noop_parser
-        self.set_floader(floader)
+        self.macro_parser_key = None
+        self.component_parser_key = None
+        self.wanted_types = None
+        self.worker_index = None
+        self.lazy_records = {}
+
+        if floader is not None:
+            self.set_floader(floader)
 
     def _load_index(self, path, dest):
         """Load an index file.
@@ -91,9 +489,9 @@ class MacroDB:
         """
 
         with self.floader.open_file(path) as idx_file:
-            idx_tree = etree.parse(idx_file)
+            idx_tree = etree.fromstring(read_game_file(idx_file))
 
-        for entry in idx_tree.xpath('./entry[@name][@value]'):
+        for entry in compile_xpath('./entry[@name][@value]')(idx_tree):
             dest[entry.get('name')] = entry.get('value').replace('\\', '/') + '.xml'
 
     def _fix_missing_index_entries(self):
@@ -112,6 +510,7 @@ class MacroDB:
 
         self.macro_index = {}
         self.component_index = {}
+        self.component_cache.clear()
 
         for ext_name in [None] + floader.get_extensions():
             macros_path = get_path_in_ext('index/macros.xml', ext_name)
@@ -122,21 +521,76 @@ class MacroDB:
 
         self._fix_missing_index_entries()
 
-    def set_macro_parser(self, macro_parser):
-        """Sets the macro parser."""
+    def set_macro_parser(self, macro_parser, cache_key=None):
+        """Sets the macro parser.
+
+        Arguments:
+        macro_parser: see the macro_parser member.
+        cache_key: hashable that identifies the parser and its version in the
+                   parse cache. Results of parsers without a key are not
+                   cached.
+        """
         self.macro_parser = macro_parser
+        self.macro_parser_key = cache_key
+
+    def set_component_parser(self, component_parser, cache_key=None):
+        """Sets the component parser.
+
+        Arguments:
+        component_parser: see the component_parser member.
+        cache_key: see set_macro_parser.
+        """
+        # cached components were parsed by the previous parser
+        if component_parser is not self.component_parser or \
+                cache_key != self.component_parser_key:
+            self.component_cache.clear()
 
-    def set_component_parser(self, component_parser):
-        """Sets the component parser."""
         self.component_parser = component_parser
+        self.component_parser_key = cache_key
+
+    def set_wanted_types(self, wanted_types):
+        """Sets the macro classes whose properties are parsed. Macros of other
+        classes are added as stubs with no properties.
+        Only affects macros loaded afterwards.
+
+        Arguments:
+        wanted_types: iterable of macro classes or None to parse the
+                      properties of all macros.
+        """
+        self.wanted_types = \
+            set(wanted_types) if wanted_types is not None else None
+
+    def _get_cache_key(self, kind, parser_key, path, *extra):
+        """Returns the parse cache key of a game file or None if its results
+        can't be cached.
+        """
+        if self.parse_cache is None or parser_key is None:
+            return None
+
+        file_hash = self.floader.get_file_hash(path)
+        if file_hash is None:
+            return None
+
+        return (kind, parser_key, file_hash) + extra
+
+    def save_parse_cache(self):
+        """Writes the parse cache, if any."""
+        if self.parse_cache is not None:
+            self.parse_cache.save()
 
     def load_component_properties(self, comp_name):
         """Loads a component, parses it and returns the properties dict.
+        The properties are taken from the component cache or from the parse
+        cache if possible.
 
         Arguments:
         comp_name: name (id) of component to load.
         """
 
+        props = self.component_cache.get(comp_name)
+        if props is not None:
+            return props
+
         path = self.component_index.get(comp_name)
 
         if not path:
@@ -144,11 +598,41 @@ class MacroDB:
                       comp_name)
             return {}
 
+        key = self._get_cache_key('component', self.component_parser_key,
+                                  path, comp_name)
+        if key is not None:
+            props = self.parse_cache.get(key)
+            if props is not None:
+                self.component_cache.put(comp_name, props)
+                return props
+
         with self.floader.open_file(path) as comp_file:
-            comp_tree = etree.parse(comp_file)
+            props = self._parse_component_tree(
+                comp_name, path,
+                parse_component_xml(comp_file))
+
+        if key is not None:
+            self.parse_cache.put(key, props)
+        self.component_cache.put(comp_name, props)
 
-        comp_xpath = "./component[@name='{}']".format(comp_name)
-        comp_nodes = comp_tree.xpath(comp_xpath)
+        return props
+
+    def _parse_component_tree(self, comp_name, path, comp_tree,
+                              component_parser=None):
+        """Parses a component and returns the properties dict.
+
+        Arguments:
+        comp_name: name (id) of component to parse.
+        path: path to the game .xml file of the component. Used for logging.
+        comp_tree: parsed XML tree or root element of the game .xml file.
+        component_parser: parser to use instead of self.component_parser.
+        """
+
+        if component_parser is None:
+            component_parser = self.component_parser
+
+        comp_nodes = compile_xpath('./component[@name=$name]')(
+            comp_tree, name=comp_name)
         if len(comp_nodes) > 1:
             LOG.error('Failed to load component properties from %s: '
                       'too many <properties> nodes', path)
@@ -157,7 +641,7 @@ class MacroDB:
 
             # some pesky component has a space in its class
             comp_type = comp_node.get('class').strip()
-            return self.component_parser(comp_name, comp_type, comp_node)
+            return component_parser(comp_name, comp_type, comp_node)
         else:
             LOG.warning('No components with name %s in file %s',
                         comp_name, path)
@@ -172,48 +656,425 @@ class MacroDB:
               E.g.: assets/props/Engine/macros/engine_(...)_macro.xml
         """
 
-        with self.floader.open_file(path) as macro_file:
-            tree = etree.parse(macro_file)
-        found_macro = False
+        self.load_macro_xml_files([path])
+
+    def load_macro_xml_files(self, paths, workers=None, lazy=False):
+        """Loads macros from multiple game .xml files.
+        Files whose results are in the parse cache are not read. The other
+        files are read in bulk using the file loader's read_many, so the order
+        in which they are loaded is decided by the file loader.
+        All the files are parsed before the macros are processed. The files
+        and then the components they refer to are parsed by a pool of worker
+        processes if workers is greater than 1, otherwise the component files
+        are prefetched and parsed while the macros are processed.
+        The parsed macros are added in the order the files were read, so the
+        result doesn't depend on the number of workers.
+        Lazily loaded macros capture the current parsers.
+
+        Arguments:
+        paths: iterable of paths to game .xml files. See load_macro_xml_file.
+        workers: number of worker processes. Use None for self.workers.
+        lazy: if True only scan the files for connections and parse the
+              properties of the macros when they are first accessed.
+        """
+
+        if workers is None:
+            workers = self.workers
 
-        for macro_node in tree.xpath('./macro[@name][@class]'):
-            found_macro = True
+        records = []
+        cache_keys = {}
+
+        # records of stubs depend on the wanted types
+        wanted_key = self._get_parse_context().wanted_key
+
+        # scans don't depend on the macro parser
+        (kind, parser_key) = ('macro_scan', PARSE_CACHE_VERSION) if lazy \
+            else ('macro', self.macro_parser_key)
+
+        for path in paths:
+            self.loaded_paths.add(normalize_game_path(path))
+            key = self._get_cache_key(kind, parser_key, path, wanted_key)
+            cached = self.parse_cache.get(key) if key is not None else None
+
+            if cached is not None:
+                records.append((path, cached))
+            elif path not in cache_keys:
+                cache_keys[path] = key
+
+        if self._workers_read_files(workers, len(cache_keys)):
+            files = [(path, None) for path in cache_keys]
+        else:
+            files = list(self.floader.read_many(cache_keys))
+
+        parsed = self._parse_files(
+            _parse_macro_file,
+            [(path, data, lazy) for (path, data) in files],
+            workers
+        )
+
+        for ((path, _), file_records) in zip(files, parsed):
+            records.append((path, file_records))
+
+            if cache_keys[path] is not None:
+                self.parse_cache.put(cache_keys[path], file_records)
+
+        comp_props = self._load_components(
+            set(record[3] for (_, file_records) in records
+                for record in file_records if record[3] is not None),
+            workers
+        )
+
+        for (path, file_records) in records:
+            self._add_macro_records(path, file_records, comp_props)
+
+    def _load_components(self, comp_names, workers):
+        """Parses the components that aren't in the parse cache ahead of the
+        macros that use them.
+        Returns a dictionary of component name -> properties dict of the
+        parsed components. If there are too few components to parse them in
+        worker processes, their files are only prefetched and an empty
+        dictionary is returned.
+
+        Arguments:
+        comp_names: set of names of the components.
+        workers: number of worker processes.
+        """
+        pending = {}
+        for comp_name in sorted(comp_names):
+            path = self.component_index.get(comp_name)
+            if not path or comp_name in self.component_cache:
+                continue
+
+            key = self._get_cache_key('component', self.component_parser_key,
+                                      path, comp_name)
+            if key is None or key not in self.parse_cache:
+                pending[comp_name] = (path, key)
+
+        paths = sorted(set(path for (path, _) in pending.values()))
+
+        if not _use_workers(workers, len(pending)):
+            self.floader.prefetch(paths)
+            return {}
+
+        if self._workers_read_files(workers, len(pending)):
+            data = dict.fromkeys(paths)
+        else:
+            data = dict(self.floader.read_many(paths))
+
+        results = self._parse_files(
+            _parse_component_file,
+            [(comp_name, path, data[path])
+             for (comp_name, (path, _)) in pending.items()],
+            workers
+        )
+
+        comp_props = {}
+        for ((comp_name, (_, key)), props) in zip(pending.items(), results):
+            if key is not None:
+                self.parse_cache.put(key, props)
+            self.component_cache.put(comp_name, props)
+
+            comp_props[comp_name] = props
+
+        return comp_props
+
+    def _get_worker_index(self):
+        """Returns the path of a cat index of the file loader that spawned
+        worker processes attach to, or None if the file loader is not a
+        CatFileLoader. The index is exported once per file loader and stored
+        in a temporary directory that is removed with this object.
+        """
+        if not isinstance(self.floader, CatFileLoader) or \
+           isinstance(self.floader, SharedCatFileLoader):
+            return None
+
+        if self.worker_index is None or \
+           self.worker_index[0] is not self.floader:
+            # pylint: disable=consider-using-with
+            tmp_dir = tempfile.TemporaryDirectory(prefix='x4fp-')
+            index_path = os.path.join(tmp_dir.name, 'cat.index')
+            self.floader.export_index(index_path)
+
+            self.worker_index = (self.floader, tmp_dir, index_path)
+
+        return self.worker_index[2]
+
+    def _workers_read_files(self, workers, count):
+        """Returns True if count game files are parsed by spawned worker
+        processes that read the files themselves through the exported cat
+        index, instead of getting their content from this process.
+        """
+        return _use_workers(workers, count) and \
+            WORKER_START_METHOD != 'fork' and \
+            self._get_worker_index() is not None
+
+    def _make_executor(self, workers):
+        """Returns a ProcessPoolExecutor whose workers can run
+        _parse_macro_file and _parse_component_file.
+        """
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+
+        if WORKER_START_METHOD == 'fork':
+            # workers inherit _WORKER_DB
+            return ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=context)
+
+        return ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_init_worker,
+            initargs=(self._get_worker_index(),
+                      getattr(self.floader, 'use_mmap', False),
+                      (self.macro_parser, self.component_parser),
+                      self.wanted_types))
+
+    def _parse_files(self, func, args, workers):
+        """Calls a parse function for each tuple of arguments, using a pool of
+        worker processes if possible.
+        Returns the list of results, in the order of args.
+        Spawned worker processes need picklable parsers. If the pool can't be
+        used, the game files are parsed in this process.
+
+        Arguments:
+        func: _parse_macro_file or _parse_component_file.
+        args: list of argument tuples.
+        workers: number of worker processes.
+        """
+        # pylint: disable=global-statement
+        global _WORKER_DB
+        _WORKER_DB = self
+
+        try:
+            if _use_workers(workers, len(args)):
+                try:
+                    chunksize = max(1, len(args) // (workers * 4))
+                    with self._make_executor(workers) as executor:
+                        return list(executor.map(func, *zip(*args),
+                                                 chunksize=chunksize))
+                except (OSError, BrokenProcessPool, pickle.PicklingError,
+                        AttributeError, TypeError) as ex:
+                    LOG.warning('Failed to parse game files in parallel: %s',
+                                ex)
+
+            return [func(*arg) for arg in args]
+        finally:
+            _WORKER_DB = None
+
+    def _get_parse_context(self):
+        """Returns the ParseContext of the current parsers."""
+        wanted_key = tuple(sorted(self.wanted_types)) \
+            if self.wanted_types is not None else None
+
+        return ParseContext(self.macro_parser, self.component_parser,
+                            self.macro_parser_key, wanted_key)
+
+    def _parse_macro_tree(self, path, tree, lazy=False, context=None):
+        """Parses the macros of a parsed game .xml file.
+        Returns a list of (macro name, macro type, properties, component name,
+        connections) records, where properties are the ones returned by the
+        macro parser, component name is the name of the macro's component or
+        None and connections is a list of (connection id, macro id).
+        Macros whose class is not wanted get stub records, with no properties
+        and no component.
+
+        Arguments:
+        path: path to game .xml file. Used for logging.
+        tree: parsed XML tree or its root element.
+        lazy: if True only scan the connections. The records of the wanted
+              macros have None properties and no component.
+        context: ParseContext whose macro parser and wanted types are used
+                 instead of the current ones or None.
+        """
+        records = []
+
+        if context is None:
+            (macro_parser, wanted_types) = (None, self.wanted_types)
+        else:
+            macro_parser = context.macro_parser
+            wanted_types = set(context.wanted_key) \
+                if context.wanted_key is not None else None
+
+        for macro_node in compile_xpath('./macro[@name][@class]')(tree):
             macro_name = macro_node.get('name')
             macro_type = macro_node.get('class')
             properties = {}
+            comp_name = None
+
+            if wanted_types is not None and macro_type not in wanted_types:
+                pass
+            elif lazy:
+                properties = None
+            else:
+                (properties, comp_name) = \
+                    self._parse_macro_node(path, macro_name, macro_type,
+                                           macro_node, macro_parser)
 
-            prop_nodes = macro_node.xpath('./properties')
-            if len(prop_nodes) > 1:
-                LOG.error('Failed to load macro properties from %s: too '
-                          'many <properties> nodes', path)
-            elif prop_nodes:
-                # parse properties
-                properties = \
-                    self.macro_parser(macro_name, macro_type, prop_nodes[0])
-
-            comp_nodes = macro_node.xpath('./component')
-            if len(comp_nodes) > 1:
-                LOG.error('Failed to load component properties from %s: '
-                          'too many <properties> nodes', path)
-            elif comp_nodes:
-                comp_name = comp_nodes[0].get('ref')
-
-                # parse properties from the component
-                comp_props = self.load_component_properties(comp_name)
-                properties.update(comp_props)
-
-            macro = Macro(macro_name, macro_type, properties)
-
-            connections_xpath = './connections/connection[@ref]'
-            for conn_node in macro_node.xpath(connections_xpath):
+            connections = []
+            connections_xpath = compile_xpath('./connections/connection[@ref]')
+            for conn_node in connections_xpath(macro_node):
                 conn_ref = conn_node.get('ref')
 
-                for conn_m_node in conn_node.xpath('./macro[@ref]'):
-                    macro_ref = conn_m_node.get('ref')
-                    if macro_ref not in self.macros:
-                        self.dependencies.add(macro_ref)
+                for conn_m_node in compile_xpath('./macro[@ref]')(conn_node):
+                    connections.append((conn_ref, conn_m_node.get('ref')))
+
+            records.append((macro_name, macro_type, properties, comp_name,
+                            connections))
+
+        if not records:
+            LOG.warning('No macros found in file %s', path)
+
+        return records
+
+    def _parse_macro_node(self, path, macro_name, macro_type, macro_node,
+                          macro_parser=None):
+        """Parses the properties of a macro and finds its component.
+        Returns (properties, component name or None).
+
+        Arguments:
+        path: path to game .xml file. Used for logging.
+        macro_name: macro id.
+        macro_type: macro type, a.k.a. class.
+        macro_node: XML <macro> node.
+        macro_parser: parser to use instead of self.macro_parser.
+        """
+        if macro_parser is None:
+            macro_parser = self.macro_parser
+
+        properties = {}
+
+        prop_nodes = compile_xpath('./properties')(macro_node)
+        if len(prop_nodes) > 1:
+            LOG.error('Failed to load macro properties from %s: too '
+                      'many <properties> nodes', path)
+        elif prop_nodes:
+            # parse properties
+            properties = macro_parser(macro_name, macro_type, prop_nodes[0])
+
+        comp_name = None
+        comp_nodes = compile_xpath('./component')(macro_node)
+        if len(comp_nodes) > 1:
+            LOG.error('Failed to load component properties from %s: '
+                      'too many <properties> nodes', path)
+        elif comp_nodes:
+            comp_name = comp_nodes[0].get('ref')
+
+        return (properties, comp_name)
+
+    def _get_lazy_records(self, path, context):
+        """Returns the lazy_records entry of a game .xml file, parsing the
+        file with the parsers of context if needed. The results are taken
+        from and stored in the parse cache under the same key as the ones of
+        load_macro_xml_files.
+
+        Arguments:
+        path: path to the game .xml file.
+        context: ParseContext of the lazy macros.
+        """
+        lazy_key = (normalize_game_path(path), context)
+
+        pending = self.lazy_records.get(lazy_key)
+        if pending is not None:
+            return pending
+
+        key = self._get_cache_key('macro', context.macro_parser_key, path,
+                                  context.wanted_key)
+        records = self.parse_cache.get(key) if key is not None else None
+
+        if records is None:
+            with self.floader.open_file(path) as macro_file:
+                tree = etree.fromstring(read_game_file(macro_file))
+
+            records = self._parse_macro_tree(path, tree, context=context)
+
+            if key is not None:
+                self.parse_cache.put(key, records)
+
+        # only keep the macros that can still be loaded from this file
+        pending = {}
+        for (macro_name, _, properties, comp_name, _) in records:
+            macro = self.macros.get(macro_name)
+            if macro is not None and not macro.is_loaded():
+                pending[macro_name] = (properties, comp_name)
+
+        self.lazy_records[lazy_key] = pending
+
+        return pending
+
+    def _load_lazy_properties(self, path, macro_name, context):
+        """Parses the properties of a lazily loaded macro and of its
+        component. Returns the properties dict.
+        The game .xml file is parsed once for all its lazy macros.
+
+        Arguments:
+        path: path to the game .xml file of the macro.
+        macro_name: macro id.
+        context: ParseContext of the parsers set when the macro was loaded.
+        """
+        lazy_key = (normalize_game_path(path), context)
+        pending = self._get_lazy_records(path, context)
+        record = pending.pop(macro_name, None)
+
+        if not pending:
+            self.lazy_records.pop(lazy_key, None)
+
+        if record is None:
+            LOG.error('Failed to load macro %s, not found in file %s',
+                      macro_name, path)
+            return {}
+
+        (properties, comp_name) = record
+
+        if comp_name is None:
+            pass
+        elif context.component_parser is self.component_parser:
+            properties.update(self.load_component_properties(comp_name))
+        elif comp_name in self.component_index:
+            # the parser changed, so the caches can't be used
+            comp_path = self.component_index[comp_name]
+            with self.floader.open_file(comp_path) as comp_file:
+                properties.update(self._parse_component_tree(
+                    comp_name, comp_path,
+                    parse_component_xml(comp_file),
+                    context.component_parser))
+        else:
+            LOG.error('Failed to load component %s, not found in index',
+                      comp_name)
+
+        return properties
+
+    def _add_macro_records(self, path, records, comp_props=None):
+        """Adds macros parsed by _parse_macro_tree to the database.
+        The properties of their components are loaded and merged into the
+        macro properties. Macros whose records have None properties are lazy.
+
+        Arguments:
+        path: path to the game .xml file of the macros.
+        records: list of records returned by _parse_macro_tree.
+        comp_props: dictionary of component name -> properties dict of
+                    already parsed components or None.
+        """
+        context = self._get_parse_context()
 
-                    macro.add_connection(conn_ref, macro_ref)
+        for (macro_name, macro_type, properties, comp_name, connections) \
+                in records:
+            if properties is None:
+                macro = Macro(macro_name, macro_type, None, functools.partial(
+                    self._load_lazy_properties, path, macro_name, context))
+            else:
+                if comp_props and comp_name in comp_props:
+                    # each macro gets its own copy of the component properties
+                    properties.update(copy.deepcopy(comp_props[comp_name]))
+                elif comp_name is not None:
+                    # parse properties from the component
+                    properties.update(
+                        self.load_component_properties(comp_name))
+
+                macro = Macro(macro_name, macro_type, properties)
+
+            for (conn_ref, macro_ref) in connections:
+                if macro_ref not in self.macros:
+                    self.dependencies.add(macro_ref)
+
+                macro.add_connection(conn_ref, macro_ref)
 
             # save macro, remove dependency if it exists
             self.macros[macro_name] = macro
@@ -222,51 +1083,106 @@ class MacroDB:
             t_macros = self.macros_by_type.setdefault(macro_type, [])
             t_macros.append(macro_name)
 
-        if not found_macro:
-            LOG.warning('No macros found in file %s', path)
+    def _get_dependency_wave(self, failed):
+        """Maps the pending dependencies to the game .xml files that define
+        them.
+        Returns a sorted list of paths of files that weren't loaded yet.
 
-    def _resolve_step(self):
-        """One step in the dependency resolution algorithm.
-        Returns true if the set of dependencies has changed.
+        Arguments:
+        failed: set of refs that can't be resolved. Refs that can't be mapped
+                to a file that wasn't loaded yet are added to it.
         """
 
-        # step 1: remove deps that are satisfied just to be sure
-        for ref in list(self.dependencies):
-            if ref in self.macros:
-                self.dependencies.remove(ref)
-
-        # step 2: make a copy of the dependency set
-        deps_before = copy.deepcopy(self.dependencies)
+        # remove deps that are satisfied just to be sure
+        self.dependencies.difference_update(self.macros)
 
-        # step 3: try to load dependencies
-        for ref in deps_before:
+        # normalized path -> path of the files to load
+        wave = {}
+        for ref in sorted(self.dependencies - failed):
             path = self.macro_index.get(ref)
+            norm_path = normalize_game_path(path) if path else None
+
             if not path:
                 LOG.error('Failed to load ref %s, not found in index', ref)
+                failed.add(ref)
+            elif norm_path in self.loaded_paths:
+                LOG.error('Failed to load ref %s, not found in file %s', ref,
+                          path)
+                failed.add(ref)
+            elif norm_path in wave:
                 continue
-
-            if not self.floader.file_exists(path):
+            elif norm_path in self.missing_paths or \
+                    not self.floader.file_exists(path):
                 LOG.error('Failed to load ref %s, file %s not found', ref, path)
-                continue
+                failed.add(ref)
+                self.missing_paths.add(norm_path)
+            else:
+                wave[norm_path] = path
 
-            self.load_macro_xml_file(path)
-
-        # step 4: return True if the new dependency set is different
-        return deps_before != self.dependencies
+        return sorted(wave.values())
 
     def resolve_dependencies(self):
         """Loads macros that aren't loaded yet but that are referred to by
         loaded macros.
+        Dependencies are resolved in waves: all the files that define pending
+        dependencies are loaded together, then the dependencies of the newly
+        loaded macros form the next wave. Each file is loaded at most once.
+        The macros are loaded lazily, so their properties are only parsed if
+        they are used.
+        Updates dependency_depth and unresolved_refs.
         Returns True if all dependencies were resolved.
         """
 
-        # while there are dependencies resolve them
-        # when the set of dependencies doesn't change anymore stop
-        while self.dependencies:
-            if not self._resolve_step():
-                LOG.error('Failed to resolve all dependencies. Remaining: %s',
-                          self.dependencies)
-                break
+        failed = set()
+        depth = 0
+
+        wave = self._get_dependency_wave(failed)
+        while wave:
+            depth += 1
+            LOG.debug('Loading %d macro files to resolve dependencies, '
+                      'depth %d', len(wave), depth)
+
+            self.floader.prefetch(wave)
+            self.load_macro_xml_files(wave, lazy=True)
+            wave = self._get_dependency_wave(failed)
+
+        self.dependency_depth = max(self.dependency_depth, depth)
+
+        self.unresolved_refs = {ref: [] for ref in self.dependencies}
+        for (macro_name, macro) in self.macros.items():
+            for (_, macro_ref) in macro.connections:
+                if macro_ref in self.unresolved_refs:
+                    self.unresolved_refs[macro_ref].append(macro_name)
+
+        for referrers in self.unresolved_refs.values():
+            referrers.sort()
+
+        if self.dependencies:
+            LOG.error('Failed to resolve all dependencies. Remaining: %s',
+                      ', '.join(sorted(self.dependencies)))
 
         # return True if no dependencies left
         return not self.dependencies
+
+    def load_properties(self):
+        """Parses the properties of all the lazily loaded macros that weren't
+        accessed yet, reading their game files.
+        """
+
+        for macro in self.macros.values():
+            macro.load()
+
+    def get_stats(self):
+        """Returns a dictionary of statistics about the loaded macros and the
+        dependency resolution.
+        """
+
+        return {
+            'macros': len(self.macros),
+            'unparsed_macros': sum(1 for macro in self.macros.values()
+                                   if not macro.is_loaded()),
+            'files_loaded': len(self.loaded_paths),
+            'files_missing': len(self.missing_paths),
+            'dependency_depth': self.dependency_depth,
+            'unresolved_refs': self.unresolved_refs,
+        }
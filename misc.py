@@ -1,12 +1,63 @@
 """Misc functions that provide commonly-used functionalities."""
 
+import functools
 import re
 import logging
+from lxml import etree
 
 
 LOG = logging.getLogger(__name__)
 
 
+# Queries that only select the child elements with a given tag
+CHILD_XPATH_RE = re.compile(r'\./([A-Za-z_][\w.-]*)\Z')
+
+# Registry of compiled XPath queries, keyed by the XPath string
+XPATH_REGISTRY = {}
+
+# If False compile_xpath doesn't use the registry and every query is compiled
+# again when it runs. Used by benchmark_parsers.py to measure the registry.
+USE_XPATH_REGISTRY = True
+
+
+def _select_children(tag, node):
+    """Returns the list of child elements of a node or of the root of an
+    element tree with the given tag. Same as the XPath query './tag'.
+    """
+    if not etree.iselement(node):
+        node = node.getroot()
+
+    return list(node.iterchildren(tag))
+
+
+def compile_xpath(xpath):
+    """Returns a function that runs an XPath query on a node, an XML element
+    or element tree, and returns the result. XPath variables are passed as
+    keyword arguments.
+    Queries are compiled once and kept in XPATH_REGISTRY. Queries of the form
+    './tag' don't use XPath, they select the child elements directly.
+    See USE_XPATH_REGISTRY.
+
+    Arguments:
+    xpath: XPath query.
+    """
+    if not USE_XPATH_REGISTRY:
+        return lambda node, **variables: node.xpath(xpath, **variables)
+
+    query = XPATH_REGISTRY.get(xpath)
+
+    if query is None:
+        match = CHILD_XPATH_RE.match(xpath)
+        if match:
+            query = functools.partial(_select_children, match[1])
+        else:
+            query = etree.XPath(xpath)
+
+        XPATH_REGISTRY[xpath] = query
+
+    return query
+
+
 def get_xpath_attrib(node, xpath, attrib, default=None):
     """Returns the value of an attribute of the first node selected by an XPath
     query.
@@ -19,7 +70,7 @@ def get_xpath_attrib(node, xpath, attrib, default=None):
     attrib: attribute to look up.
     default: value to return if no node is found or the attribute is missing.
     """
-    nodes = node.xpath(xpath)
+    nodes = compile_xpath(xpath)(node)
     if isinstance(nodes, list):
         if nodes:
             if len(nodes) > 1:
@@ -42,7 +93,7 @@ def get_xpath_attribs(node, xpath, default=None):
     xpath: XPath query.
     default: value to return if no node is found or the attribute is missing.
     """
-    nodes = node.xpath(xpath)
+    nodes = compile_xpath(xpath)(node)
     if isinstance(nodes, list):
         if nodes:
             if len(nodes) > 1:
@@ -54,23 +105,6 @@ def get_xpath_attribs(node, xpath, default=None):
     return nodes.attrib
 
 
-def find_nodes_with_tag(root_node, xpath, tag):
-    """Performs an XPath query on a node and yields nodes that have a 'tags'
-    attribute that contains the given tag.
-
-    Arguments:
-    root_node: node to perform the XPath query on.
-    xpath: XPath query.
-    tag: requested tag.
-    """
-
-    # regex that matches the tag in a tags string
-    tag_re = re.compile(r'\b{}\b'.format(tag))
-
-    for node in root_node.xpath(xpath):
-        if tag_re.search(node.get('tags', '')):
-            yield node
-
 def get_path_in_ext(path, ext_name):
     """Transform a game path relative to an extension root into a game path
     relative to the game root.
@@ -0,0 +1,505 @@
+"""Tests of the file loaders, using synthetic .cat/.dat files."""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import file_loaders
+
+
+def write_cat(root, name, files):
+    """Writes a .cat file and its .dat file.
+
+    Arguments:
+    root: directory where the files are written.
+    name: name of the files without extension, e.g. '01'.
+    files: list of (game path, content) pairs, in .dat file order.
+    """
+    with open(os.path.join(root, name + '.cat'), 'w') as cat_file, \
+            open(os.path.join(root, name + '.dat'), 'wb') as dat_file:
+        for (path, data) in files:
+            cat_file.write('{} {} 0 {}\n'.format(
+                path, len(data), hashlib.md5(data).hexdigest()))
+            dat_file.write(data)
+
+
+class TestCatFileLoader(unittest.TestCase):
+    """Tests of CatFileLoader."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp_dir.name, 'game')
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        os.mkdir(self.root)
+
+        write_cat(self.root, '01', [
+            ('a/x.xml', b'old x'),
+            ('b/y.xml', b'y'),
+            ('b/gap.xml', b'-' * (file_loaders.MAX_READ_GAP + 1)),
+            ('b/far.xml', b'far'),
+        ])
+        write_cat(self.root, '02', [
+            ('A/X.xml', b'new x'),
+            ('c/z.xml', b'z'),
+        ])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_loader(self, **kwargs):
+        """Returns a CatFileLoader of the synthetic game root."""
+        floader = file_loaders.CatFileLoader(self.root, **kwargs)
+        floader.load_from_game_root()
+
+        return floader
+
+    def read(self, floader, path):
+        """Returns the content of a game file."""
+        with floader.open_file(path) as game_file:
+            return game_file.read()
+
+    def test_priority(self):
+        """Files of later .cat files override earlier ones."""
+        floader = self.make_loader()
+
+        self.assertEqual(self.read(floader, 'a/x.xml'), b'new x')
+        self.assertEqual(self.read(floader, 'b/y.xml'), b'y')
+        self.assertEqual(self.read(floader, 'C//Z.XML'), b'z')
+        self.assertFalse(floader.file_exists('a/missing.xml'))
+        self.assertEqual(sorted(e.name for e in floader.list_files('a')),
+                         ['x.xml'])
+
+    def test_file_index(self):
+        """Files are looked up in the flat index and listed from the tree."""
+        floader = self.make_loader()
+        list(floader.walk(''))
+
+        self.assertEqual(sorted(floader.file_index), [
+            'a/x.xml', 'b/far.xml', 'b/gap.xml', 'b/y.xml', 'c/z.xml'])
+        self.assertEqual(sorted(e.path for e in floader.walk('b')),
+                         ['b/far.xml', 'b/gap.xml', 'b/y.xml'])
+        # pylint: disable=protected-access
+        self.assertEqual(floader.entries.get(floader.file_index['a/x.xml']),
+                         floader._find_file('a/x.xml'))
+
+        with self.assertRaises(ValueError):
+            list(floader.list_files('a/x.xml'))
+
+    def test_negative_cache(self):
+        """Missing files are only searched for once, until new .cat files
+        are registered.
+        """
+        floader = self.make_loader()
+
+        for _ in range(3):
+            self.assertFalse(floader.file_exists('a/missing.xml'))
+            self.assertIsNone(floader.get_file_hash('A/Missing.xml'))
+
+        self.assertEqual(floader.get_stats()['negative_cache'],
+                         {'hits': 5, 'lookups': 6, 'size': 1})
+        self.assertEqual(floader.get_stats()['counters']['cats_loaded'], 2)
+
+        write_cat(self.root, '03', [('a/missing.xml', b'found')])
+        floader.load_from_game_root()
+        self.assertEqual(floader.get_stats()['negative_cache']['size'], 0)
+        self.assertEqual(self.read(floader, 'a/missing.xml'), b'found')
+
+    def test_summary(self):
+        """The summary skips .cat files without entries in a directory."""
+        cat_paths = [os.path.join(self.root, name) for name in
+                     ['01.cat', '02.cat']]
+        summary = file_loaders.CatSummary.build({
+            cat_paths[0]: {'a', 'b'},
+            cat_paths[1]: {'a', 'c/d'},
+        })
+
+        self.assertTrue(summary.may_contain(cat_paths[0], ''))
+        self.assertTrue(summary.may_contain(cat_paths[0], 'b'))
+        self.assertFalse(summary.may_contain(cat_paths[1], 'b'))
+        self.assertTrue(summary.may_contain(cat_paths[1], 'c'))
+        self.assertTrue(summary.may_contain('unknown.cat', 'b'))
+
+    def test_summary_override(self):
+        """Entries loaded out of order through the summary are overridden by
+        .cat files with a higher priority.
+        """
+        # the first run loads all the .cat files and saves the summary
+        floader = self.make_loader(cache_dir=self.cache_dir)
+        list(floader.walk(''))
+
+        floader = self.make_loader(cache_dir=self.cache_dir)
+        self.assertEqual(self.read(floader, 'b/y.xml'), b'y')
+        self.assertEqual(floader.get_stats()['counters']['cats_loaded'], 1)
+
+        # a/x.xml was loaded from 01.cat, but 02.cat can override it
+        # pylint: disable=protected-access
+        entry = floader._get_file_entry('a/x.xml')
+        self.assertTrue(floader._may_be_overridden(entry, 'a'))
+        self.assertEqual(self.read(floader, 'a/x.xml'), b'new x')
+        self.assertEqual(floader.get_stats()['counters']['cats_loaded'], 2)
+
+    def test_read_many(self):
+        """Adjacent game files are read with a single read."""
+        for use_mmap in [False, True]:
+            floader = self.make_loader(use_mmap=use_mmap)
+            paths = ['b/far.xml', 'b/y.xml', 'a/x.xml', 'c/z.xml']
+
+            data = dict(floader.read_many(paths))
+            self.assertEqual(data, {
+                'a/x.xml': b'new x',
+                'b/y.xml': b'y',
+                'b/far.xml': b'far',
+                'c/z.xml': b'z',
+            })
+            floader.close()
+
+        floader = self.make_loader()
+        list(floader.read_many(['a/x.xml', 'c/z.xml']))
+        self.assertEqual(floader.get_stats()['times']['read_many']['calls'],
+                         1)
+
+        # b/far.xml is too far from b/y.xml to read them together
+        floader = self.make_loader()
+        list(floader.read_many(['b/y.xml', 'b/far.xml']))
+        self.assertEqual(floader.get_stats()['times']['read_many']['calls'],
+                         2)
+
+    def test_threads(self):
+        """Game files can be looked up and read from multiple threads while
+        the .cat files are loaded lazily.
+        """
+        files = {}
+        for cat in range(4):
+            cat_files = [('t/{}/f{}.xml'.format(cat, i),
+                          '{} {}'.format(cat, i).encode() * (i % 7 + 1))
+                         for i in range(200)]
+            write_cat(self.root, '{:02d}'.format(cat + 3), cat_files)
+            files.update(cat_files)
+
+        for use_mmap in [False, True]:
+            floader = self.make_loader(use_mmap=use_mmap)
+            errors = []
+
+            def read_all(floader, errors):
+                for (path, data) in reversed(list(files.items())):
+                    if not floader.file_exists(path) or \
+                       self.read(floader, path) != data:
+                        errors.append(path)
+
+            threads = [threading.Thread(target=read_all,
+                                        args=(floader, errors))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(floader.negative_cache.get_stats()['size'], 0)
+            floader.close()
+
+    def test_shared_index(self):
+        """A loader attached to an exported index finds the same files."""
+        ext_dir = os.path.join(self.root, 'extensions', 'ego_test')
+        os.makedirs(ext_dir)
+        write_cat(ext_dir, 'ext_01', [('a/x.xml', b'ext x')])
+
+        floader = self.make_loader()
+        floader.load_extension('ego_test', ext_dir)
+        index_path = os.path.join(self.tmp_dir.name, 'cat.index')
+        self.assertEqual(floader.export_index(index_path), 6)
+
+        shared = file_loaders.SharedCatFileLoader(index_path)
+        paths = ['a/x.xml', 'B/Y.xml', 'c/z.xml',
+                 'extensions/ego_test/a/x.xml']
+
+        self.assertEqual(shared.get_extensions(), ['ego_test'])
+        for path in paths:
+            self.assertEqual(self.read(shared, path), self.read(floader, path))
+            self.assertEqual(shared.get_file_hash(path),
+                             floader.get_file_hash(path))
+        self.assertFalse(shared.file_exists('a/missing.xml'))
+        self.assertEqual(sorted(e.path for e in shared.list_files('b')),
+                         ['b/far.xml', 'b/gap.xml', 'b/y.xml'])
+        self.assertEqual(sorted(e.path for e in shared.walk('')),
+                         sorted(e.path for e in floader.walk('')))
+
+        with self.assertRaises(ValueError):
+            shared.load_from_game_root()
+
+        # truncated index files are rejected
+        with open(index_path, 'rb') as index_file:
+            data = index_file.read()
+        with open(index_path, 'wb') as index_file:
+            index_file.write(data[:-8])
+
+        with self.assertRaises(ValueError):
+            file_loaders.SharedCatFileLoader(index_path)
+
+    def test_pack_round_trip(self):
+        """Game files and listed directories survive a pack file."""
+        pack_path = os.path.join(self.tmp_dir.name, 'game.pack')
+        recorder = file_loaders.RecordingFileLoader(self.make_loader())
+
+        self.assertEqual(self.read(recorder, 'A/x.xml'), b'new x')
+        self.assertTrue(recorder.file_exists('c/z.xml'))
+        list(recorder.list_files('b'))
+
+        for compress in [False, True]:
+            count = file_loaders.write_pack_file(
+                pack_path, recorder.floader, recorder.paths, recorder.dirs,
+                compress=compress)
+            self.assertEqual(count, 2)
+
+            floader = file_loaders.PackFileLoader(pack_path)
+            game_file = floader.open_file('a/x.xml')
+
+            self.assertEqual(self.read(floader, 'c/z.xml'), b'z')
+            self.assertFalse(floader.file_exists('b/y.xml'))
+            self.assertEqual(list(floader.list_files('b')), [])
+            self.assertEqual(floader.get_file_hash('a/x.xml'),
+                             hashlib.md5(b'new x').hexdigest())
+
+            # open game files stay readable after the pack is closed
+            floader.close()
+            self.assertEqual(game_file.read(), b'new x')
+
+
+    def test_malformed_pack(self):
+        """Malformed pack files are rejected without running their index."""
+        pack_path = os.path.join(self.tmp_dir.name, 'game.pack')
+        file_loaders.write_pack_file(pack_path, self.make_loader(),
+                                     ['a/x.xml', 'c/z.xml'])
+
+        with open(pack_path, 'rb') as pack_file:
+            data = pack_file.read()
+
+        header = file_loaders.PACK_HEADER
+        (magic, version, index_offset, index_size) = header.unpack_from(data)
+        index = json.loads(data[index_offset:])
+
+        def pack(index_offset=index_offset, index_size=index_size,
+                 version=version, body=data[header.size:index_offset],
+                 index=data[index_offset:]):
+            return header.pack(magic, version, index_offset, index_size) + \
+                body + index
+
+        bad_entry = dict(index, files={'a/x.xml': [0, 5, 5, False, '']})
+        bad_range = dict(index, files={'a/x.xml': [header.size, 10**6, 5,
+                                                   False, '']})
+        bad_packs = [
+            data[:header.size - 1],
+            pack(version=version - 1),
+            pack(index_offset=len(data)),
+            pack(index_size=index_size + 1),
+            pack(index=b'\x80\x04K\x01.', index_size=5),
+            pack(index=b'[]', index_size=2),
+            pack(index=json.dumps(bad_entry).encode(),
+                 index_size=len(json.dumps(bad_entry))),
+            pack(index=json.dumps(bad_range).encode(),
+                 index_size=len(json.dumps(bad_range))),
+        ]
+
+        self.assertEqual(pack(), data)
+
+        for bad_pack in bad_packs:
+            with open(pack_path, 'wb') as pack_file:
+                pack_file.write(bad_pack)
+
+            with self.assertRaises(ValueError):
+                file_loaders.PackFileLoader(pack_path)
+
+
+class TestFSFileLoader(unittest.TestCase):
+    """Tests of FSFileLoader."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+
+        self.write('Assets/Props/Engine.XML', b'engine')
+        self.write('index/macros.xml', b'macros')
+        self.floader = file_loaders.FSFileLoader(self.root)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, path, data):
+        """Writes an extracted game file and bumps the modification time of
+        its directory, in case the file system has a coarse resolution.
+        """
+        fs_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+
+        with open(fs_path, 'wb') as game_file:
+            game_file.write(data)
+
+        dir_stat = os.stat(os.path.dirname(fs_path))
+        os.utime(os.path.dirname(fs_path),
+                 ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns + 10**9))
+
+    def read(self, path):
+        """Returns the content of a game file."""
+        with self.floader.open_file(path) as game_file:
+            return game_file.read()
+
+    def test_lowercase_index(self):
+        """Game paths are case insensitive."""
+        self.assertEqual(self.read('assets/props/engine.xml'), b'engine')
+        self.assertEqual(self.read('ASSETS/props//Engine.xml'), b'engine')
+        self.assertTrue(self.floader.file_exists('Index/Macros.xml'))
+        self.assertFalse(self.floader.file_exists('assets/props'))
+        self.assertEqual([(e.path, e.name) for e in
+                          self.floader.list_files('assets/PROPS')],
+                         [('Assets/Props/Engine.XML', 'Engine.XML')])
+        self.assertEqual(self.floader.get_stats()['times']['index']['calls'],
+                         1)
+
+    def test_negative_cache(self):
+        """Repeated misses are answered by the negative cache."""
+        for _ in range(3):
+            self.assertFalse(self.floader.file_exists('index/Missing.xml'))
+            with self.assertRaises(FileNotFoundError):
+                self.floader.open_file('INDEX//missing.xml')
+
+        self.assertEqual(self.floader.get_stats()['negative_cache'],
+                         {'hits': 5, 'lookups': 6, 'size': 1})
+        self.assertEqual(
+            self.floader.get_stats()['counters']['file_lookup_misses'], 6)
+
+        # re-indexing a directory clears the cache
+        self.write('index/other.xml', b'other')
+        self.assertFalse(self.floader.file_exists('index/missing.xml'))
+        self.assertEqual(
+            self.floader.get_stats()['negative_cache']['size'], 1)
+        self.assertEqual(
+            self.floader.get_stats()['counters']['dirs_reindexed'], 1)
+
+    def test_refresh(self):
+        """Modified directories are re-indexed."""
+        self.assertFalse(self.floader.file_exists('assets/props/new.xml'))
+        self.assertFalse(self.floader.file_exists('assets/new/new.xml'))
+
+        # files created after a missed lookup are found
+        self.write('Assets/Props/New.xml', b'new')
+        self.write('Assets/New/New.xml', b'new dir')
+        self.assertEqual(self.read('assets/props/new.xml'), b'new')
+        self.assertEqual(self.read('assets/new/new.xml'), b'new dir')
+
+        # removed files are dropped from the index when it's listed
+        os.remove(os.path.join(self.root, 'Assets', 'Props', 'New.xml'))
+        self.write('Assets/Props/Other.xml', b'other')
+        self.assertEqual(sorted(e.name for e in
+                                self.floader.list_files('assets/props')),
+                         ['Engine.XML', 'Other.xml'])
+        self.assertFalse(self.floader.file_exists('assets/props/new.xml'))
+        self.assertGreater(
+            self.floader.get_stats()['counters']['dirs_reindexed'], 0)
+
+
+class TestDatFilePool(unittest.TestCase):
+    """Tests of DatFilePool."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dat_paths = []
+
+        for name in ['01.dat', '02.dat', '03.dat']:
+            dat_path = os.path.join(self.tmp_dir.name, name)
+            with open(dat_path, 'wb') as dat_file:
+                dat_file.write(name.encode())
+
+            self.dat_paths.append(dat_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def is_open(handle):
+        """Returns True if the descriptor of a handle is open."""
+        try:
+            os.fstat(handle.fd)
+        except OSError:
+            return False
+
+        return True
+
+    def test_eviction(self):
+        """The least recently used handle is evicted and closed once it is
+        no longer used.
+        """
+        pool = file_loaders.DatFilePool(max_size=2)
+        dat1 = self.dat_paths[0]
+        dat2 = self.dat_paths[1]
+        dat3 = self.dat_paths[2]
+
+        handle1 = pool.acquire(dat1)
+        handle2 = pool.acquire(dat2)
+        pool.release(handle2)
+        self.assertIs(pool.acquire(dat1), handle1)
+        pool.release(handle1)
+
+        # dat2 is the least recently used
+        handle3 = pool.acquire(dat3)
+        self.assertEqual(list(pool.handles), [dat1, dat3])
+        self.assertTrue(handle2.evicted)
+        self.assertFalse(self.is_open(handle2))
+
+        # handle1 is still used by a reader when it's evicted
+        pool.release(handle3)
+        pool.acquire(dat2)
+        self.assertTrue(handle1.evicted)
+        self.assertTrue(self.is_open(handle1))
+        self.assertEqual(handle1.pread(2, 0), b'01')
+
+        pool.release(handle1)
+        self.assertFalse(self.is_open(handle1))
+
+        pool.close()
+        self.assertEqual(list(pool.handles), [])
+
+
+class TestCompileGlob(unittest.TestCase):
+    """Tests of compile_glob."""
+
+    def check(self, pattern, base, matches, non_matches):
+        """Checks the base directory and the paths matched by a pattern."""
+        (glob_base, regex) = file_loaders.compile_glob(pattern)
+
+        self.assertEqual(glob_base, base)
+        for path in matches:
+            self.assertTrue(regex.match(path), path)
+        for path in non_matches:
+            self.assertFalse(regex.match(path), path)
+
+    def test_wildcards(self):
+        """Single component wildcards."""
+        self.check('assets/props/*/macros/*.xml', 'assets/props',
+                   ['assets/props/engines/macros/e.xml'],
+                   ['assets/props/engines/e.xml',
+                    'assets/props/a/b/macros/e.xml',
+                    'assets/props/engines/macros/e.xmlx'])
+        self.check('a/?[!0-9][ab].xml', 'a',
+                   ['a/xxa.xml', 'a/1xb.xml'],
+                   ['a/x1a.xml', 'a/xxc.xml', 'a/x/a.xml'])
+
+    def test_recursive(self):
+        """** matches zero or more directories."""
+        self.check('a/**/m/*.xml', 'a',
+                   ['a/m/x.xml', 'a/b/m/x.xml', 'a/b/c/m/x.xml'],
+                   ['a/x.xml', 'a/bm/x.xml'])
+        self.check('a/b/**', 'a/b', ['a/b/x', 'a/b/c/x'], ['a/c/x'])
+
+    def test_no_wildcards(self):
+        """Patterns without wildcards match one path."""
+        self.check('a/b.xml', 'a', ['a/b.xml'], ['a/b.xmlx', 'a/c.xml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Tests of the macro and component parsers."""
+
+import re
+import unittest
+
+from lxml import etree
+
+from loaders import macro_loaders
+
+
+COMPONENT = b'''<?xml version="1.0"?>
+<components>
+<component name="ship_test" class="ship_m">
+<connections>
+<connection name="c1" tags="part engine medium"/>
+<connection name="c2" tags="engine_small part"/>
+<connection name="c3" tags="weapon small hittable"/>
+<connection name="c4" tags="weapon medium hittable"/>
+<connection name="c5" tags="weapon small hittable"/>
+<connection name="c6" tags="turret large  shield"/>
+<connection name="c7" tags="shield shield"/>
+<connection name="c8" tags="countermeasures"/>
+<connection name="c9"/>
+<connection name="c10" tags=""/>
+</connections>
+</component>
+</components>'''
+
+TAGS = ['engine', 'engine_small', 'weapon', 'turret', 'shield',
+        'countermeasures', 'part', 'hittable', 'missile', 'small']
+
+
+def find_nodes_with_tag(comp_node, tag):
+    """Connections of a component with a tag, matched with a word boundary
+    regex over the tags string, as the parsers did before ConnectionIndex.
+    """
+    tag_re = re.compile(r'\b{}\b'.format(tag))
+
+    return [node for node in
+            comp_node.xpath('./connections/connection[@tags]')
+            if tag_re.search(node.get('tags', ''))]
+
+
+class TestConnectionIndex(unittest.TestCase):
+    """Tests of ConnectionIndex."""
+
+    def setUp(self):
+        self.comp_node = etree.fromstring(COMPONENT)[0]
+        self.conns = macro_loaders.ConnectionIndex(
+            self.comp_node, './connections/connection[@tags]')
+
+    def test_counts(self):
+        """Counts match the connections found with a regex per tag."""
+        for tag in TAGS:
+            self.assertEqual(self.conns.count(tag),
+                             len(find_nodes_with_tag(self.comp_node, tag)),
+                             tag)
+
+    def test_sizes(self):
+        """The size of a component is the size of its first connection with
+        the tag.
+        """
+        for tag in TAGS:
+            sizes = [macro_loaders.get_size_from_tags(node.get('tags'))
+                     for node in find_nodes_with_tag(self.comp_node, tag)]
+            sizes = [size for size in sizes if size]
+
+            self.assertEqual(
+                macro_loaders.get_component_size(self.conns, 'test', tag),
+                sizes[0] if sizes else '', tag)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,485 @@
+"""Tests of MacroDB, using synthetic extracted game files."""
+
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import file_loaders
+import macros
+
+
+GAME_FILES = {
+    'index/macros.xml': '''<?xml version="1.0"?>
+<index>
+<entry name="ship_macro" value="assets\\units\\macros\\ship_macro"/>
+<entry name="engine_macro" value="assets\\props\\macros\\engine_macro"/>
+<entry name="thruster_a_macro" value="assets\\props\\macros\\thrusters"/>
+<entry name="thruster_b_macro" value="assets\\props\\macros\\thrusters"/>
+</index>''',
+    'index/components.xml': '''<?xml version="1.0"?>
+<index>
+<entry name="engine" value="assets\\props\\engine"/>
+</index>''',
+    'assets/units/macros/ship_macro.xml': '''<?xml version="1.0"?>
+<macros>
+<macro name="ship_macro" class="ship_s">
+<properties><hull max="100"/></properties>
+<connections>
+<connection ref="con_engine"><macro ref="engine_macro"/></connection>
+</connections>
+</macro>
+</macros>''',
+    'assets/props/macros/engine_macro.xml': '''<?xml version="1.0"?>
+<macros>
+<macro name="engine_macro" class="engine">
+<component ref="engine"/>
+<properties><thrust forward="10"/></properties>
+</macro>
+</macros>''',
+    'assets/units/macros/ship2_macro.xml': '''<?xml version="1.0"?>
+<macros>
+<macro name="ship2_macro" class="ship_s">
+<connections>
+<connection ref="con_a"><macro ref="thruster_a_macro"/></connection>
+<connection ref="con_b"><macro ref="thruster_b_macro"/></connection>
+</connections>
+</macro>
+</macros>''',
+    'assets/props/macros/thrusters.xml': '''<?xml version="1.0"?>
+<macros>
+<macro name="thruster_a_macro" class="engine">
+<properties><thrust strafe="1"/></properties>
+</macro>
+<macro name="thruster_b_macro" class="engine">
+<properties><thrust strafe="2"/></properties>
+</macro>
+</macros>''',
+    'assets/props/engine.xml': '''<?xml version="1.0"?>
+<components>
+<component name="engine" class="engine">
+<layers><layer><lights/></layer></layers>
+<connections>
+<connection name="c1" tags="part engine"/>
+<connection name="c2" tags="part"/>
+</connections>
+</component>
+</components>''',
+}
+
+
+def macro_parser(_name, _macro_type, node):
+    """Returns the attributes of the children of <properties>."""
+    return {child.tag: dict(child.attrib) for child in node}
+
+
+def component_parser(_name, _comp_type, node):
+    """Returns the tags of the connections of a component."""
+    return {
+        'connections': [conn.get('tags') for conn in
+                        node.iterfind('./connections/connection')],
+        'children': [child.tag for child in node],
+    }
+
+
+def write_game_cat(root):
+    """Writes GAME_FILES into 01.cat and 01.dat in a game root directory."""
+    with open(os.path.join(root, '01.cat'), 'w') as cat_file, \
+            open(os.path.join(root, '01.dat'), 'wb') as dat_file:
+        for (path, content) in sorted(GAME_FILES.items()):
+            data = content.encode()
+            cat_file.write('{} {} 0 {}\n'.format(
+                path, len(data), hashlib.md5(data).hexdigest()))
+            dat_file.write(data)
+
+
+class TestMacroDB(unittest.TestCase):
+    """Tests of MacroDB."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        for (path, content) in GAME_FILES.items():
+            fs_path = os.path.join(self.tmp_dir.name, path)
+            os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+            with open(fs_path, 'w') as game_file:
+                game_file.write(content)
+
+        self.floader = file_loaders.FSFileLoader(self.tmp_dir.name)
+        self.macro_db = macros.MacroDB(self.floader)
+        self.macro_db.set_macro_parser(macro_parser)
+        self.macro_db.set_component_parser(component_parser)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lazy_dependencies(self):
+        """Dependencies are loaded lazily and parsed on first access."""
+        self.macro_db.load_macro_xml_files(
+            ['assets/units/macros/ship_macro.xml'])
+        self.assertEqual(self.macro_db.dependencies, {'engine_macro'})
+
+        self.assertTrue(self.macro_db.resolve_dependencies())
+        ship = self.macro_db.macros['ship_macro']
+        engine = self.macro_db.macros['engine_macro']
+
+        self.assertTrue(ship.is_loaded())
+        self.assertEqual(ship.connections, [('con_engine', 'engine_macro')])
+        self.assertFalse(engine.is_loaded())
+        self.assertEqual(self.macro_db.get_stats()['unparsed_macros'], 1)
+
+        self.assertEqual(engine.properties, {
+            'thrust': {'forward': '10'},
+            'connections': ['part engine', 'part'],
+            'children': ['layers', 'connections'],
+        })
+        self.assertTrue(engine.is_loaded())
+
+    def test_load_properties(self):
+        """load_properties reads the files of all the lazy macros."""
+        recorder = file_loaders.RecordingFileLoader(self.floader)
+        self.macro_db.set_floader(recorder)
+        self.macro_db.load_macro_xml_files(
+            ['assets/units/macros/ship_macro.xml'])
+        self.macro_db.resolve_dependencies()
+
+        self.assertNotIn('assets/props/engine.xml', recorder.paths)
+        self.macro_db.load_properties()
+        self.assertIn('assets/props/engine.xml', recorder.paths)
+        self.assertEqual(self.macro_db.get_stats()['unparsed_macros'], 0)
+
+    def test_lazy_file_parsed_once(self):
+        """The file of several lazy macros is parsed once for all of them,
+        and then taken from the parse cache.
+        """
+        game_root = os.path.join(self.tmp_dir.name, 'cat')
+        os.mkdir(game_root)
+        write_game_cat(game_root)
+        floader = file_loaders.CatFileLoader(game_root)
+        floader.load_from_game_root()
+
+        parsed = []
+
+        def counting_parser(name, macro_type, node):
+            parsed.append(name)
+            return macro_parser(name, macro_type, node)
+
+        for run in range(2):
+            parse_cache = macros.ParseCache(
+                os.path.join(self.tmp_dir.name, 'cache'))
+            macro_db = macros.MacroDB(floader, parse_cache)
+            macro_db.set_macro_parser(counting_parser, cache_key=('test', 1))
+            macro_db.load_macro_xml_files(
+                ['assets/units/macros/ship2_macro.xml'])
+            macro_db.resolve_dependencies()
+
+            counters = floader.get_stats()['counters']
+            before = counters.get('files_opened', 0)
+            self.assertEqual(
+                macro_db.macros['thruster_b_macro'].properties,
+                {'thrust': {'strafe': '2'}})
+            self.assertEqual(
+                macro_db.macros['thruster_a_macro'].properties,
+                {'thrust': {'strafe': '1'}})
+            counters = floader.get_stats()['counters']
+            self.assertEqual(counters.get('files_opened', 0) - before,
+                             1 - run)
+            self.assertEqual(macro_db.lazy_records, {})
+
+            parse_cache.save()
+
+        self.assertEqual(sorted(parsed), ['thruster_a_macro',
+                                          'thruster_b_macro'])
+
+    def test_component_cache(self):
+        """Components are parsed once until the component parser changes."""
+        def opened():
+            return self.floader.get_stats()['counters']['files_opened']
+
+        engine = {
+            'connections': ['part engine', 'part'],
+            'children': ['layers', 'connections'],
+        }
+
+        props = self.macro_db.load_component_properties('engine')
+        before = opened()
+        props['connections'].clear()
+
+        self.assertEqual(self.macro_db.load_component_properties('engine'),
+                         engine)
+        self.assertEqual(opened(), before)
+        self.assertEqual(self.macro_db.component_cache.get_stats()['hits'], 1)
+
+        self.macro_db.set_component_parser(macro_parser)
+        self.macro_db.load_component_properties('engine')
+        self.assertEqual(opened(), before + 1)
+
+    def test_parse_component_xml(self):
+        """Components are parsed from bytes, views and game files."""
+        path = 'assets/props/engine.xml'
+
+        with self.floader.open_file(path) as game_file:
+            data = game_file.read()
+
+        with self.floader.open_file(path) as game_file:
+            sources = [data, memoryview(data), game_file]
+
+            for source in sources:
+                root = macros.parse_component_xml(source)
+                self.assertEqual(root.tag, 'components')
+                self.assertEqual(root[0].get('name'), 'engine')
+                self.assertEqual(len(root[0].find('connections')), 2)
+
+    def test_missing_loader(self):
+        """Macros without properties and loader raise a clear error."""
+        macro = macros.Macro('macro', 'engine', None)
+
+        with self.assertRaises(ValueError):
+            macro.load()
+
+
+class TestComponentCache(unittest.TestCase):
+    """Tests of ComponentCache and of its use by MacroDB."""
+
+    def test_lru(self):
+        """The least recently used component is evicted first."""
+        cache = macros.ComponentCache(2)
+        props = {'connections': ['part']}
+        cache.put('a', props)
+        props['connections'].append('engine')
+        cache.put('b', {})
+
+        self.assertEqual(cache.get('a'), {'connections': ['part']})
+        cache.get('a')['connections'].append('engine')
+        cache.put('c', {})
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'connections': ['part']})
+        self.assertEqual(cache.get_stats(), {
+            'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'size': 2})
+
+        cache.clear()
+        self.assertNotIn('a', cache)
+        self.assertEqual(macros.ComponentCache(0).max_size, 1)
+
+
+class TestParseCache(unittest.TestCase):
+    """Tests of ParseCache and of its use by MacroDB."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+        write_game_cat(self.tmp_dir.name)
+        self.floader = file_loaders.CatFileLoader(self.tmp_dir.name)
+        self.floader.load_from_game_root()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_save(self):
+        """Results are copied, saved per salt and read back."""
+        cache = macros.ParseCache(self.cache_dir)
+        result = {'a': [1, 2]}
+        cache.put('key', result)
+        cache.put('lambda', lambda: None)
+        result['a'].append(3)
+
+        self.assertEqual(cache.get('key'), {'a': [1, 2]})
+        self.assertIsNot(cache.get('key'), cache.get('key'))
+        self.assertIsNone(cache.get('lambda'))
+        self.assertEqual(cache.get_stats(),
+                         {'hits': 3, 'misses': 1, 'size': 1})
+        cache.save()
+
+        self.assertEqual(macros.ParseCache(self.cache_dir).get('key'),
+                         {'a': [1, 2]})
+        self.assertIsNone(macros.ParseCache(self.cache_dir, 'de').get('key'))
+
+    def test_corrupt_file(self):
+        """A corrupt cache file is ignored and replaced on save."""
+        cache = macros.ParseCache(self.cache_dir)
+        os.makedirs(self.cache_dir)
+        with open(cache.cache_path, 'wb') as cache_file:
+            cache_file.write(b'not a pickle')
+
+        with self.assertLogs(macros.LOG, 'WARNING'):
+            cache = macros.ParseCache(self.cache_dir)
+        self.assertEqual(cache.entries, {})
+
+        cache.put('key', 1)
+        cache.save()
+        self.assertEqual(macros.ParseCache(self.cache_dir).get('key'), 1)
+
+    def load(self, parser_key):
+        """Loads the ship and its dependencies with a new MacroDB and parse
+        cache. Returns the MacroDB and the number of bytes read from the game
+        files.
+        """
+        macro_db = macros.MacroDB(self.floader,
+                                  macros.ParseCache(self.cache_dir))
+        macro_db.set_macro_parser(macro_parser, cache_key=parser_key)
+        macro_db.set_component_parser(component_parser,
+                                      cache_key=parser_key)
+
+        before = self.floader.get_stats()['counters'].get('bytes_read', 0)
+        macro_db.load_macro_xml_files(
+            ['assets/units/macros/ship_macro.xml'])
+        macro_db.resolve_dependencies()
+        macro_db.load_properties()
+        macro_db.save_parse_cache()
+        after = self.floader.get_stats()['counters'].get('bytes_read', 0)
+
+        return macro_db, after - before
+
+    def test_macro_db(self):
+        """Unchanged game files parsed by the same parsers are taken from the
+        cache.
+        """
+        (first_db, read) = self.load(('test', 1))
+        self.assertGreater(read, 0)
+
+        (cached_db, read) = self.load(('test', 1))
+        self.assertEqual(read, 0)
+        for (name, macro) in first_db.macros.items():
+            self.assertEqual(cached_db.macros[name].properties,
+                             macro.properties)
+            self.assertEqual(cached_db.macros[name].connections,
+                             macro.connections)
+
+        (_, read) = self.load(('test', 2))
+        self.assertGreater(read, 0)
+
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                     'fork start method not available')
+class TestForkedWorkers(unittest.TestCase):
+    """Tests of MacroDB with forked worker processes."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        write_game_cat(self.tmp_dir.name)
+
+        self.saved = (macros.WORKER_START_METHOD, macros.MIN_PARALLEL_FILES)
+        macros.WORKER_START_METHOD = 'fork'
+        macros.MIN_PARALLEL_FILES = 1
+
+    def tearDown(self):
+        (macros.WORKER_START_METHOD, macros.MIN_PARALLEL_FILES) = self.saved
+        self.tmp_dir.cleanup()
+
+    def load(self, workers):
+        """Loads all the macro files with a new MacroDB and returns it."""
+        floader = file_loaders.CatFileLoader(self.tmp_dir.name)
+        floader.load_from_game_root()
+
+        macro_db = macros.MacroDB(floader, workers=workers)
+        macro_db.set_macro_parser(macro_parser)
+        macro_db.set_component_parser(component_parser)
+        macro_db.load_macro_xml_files(
+            [path for path in sorted(GAME_FILES, reverse=True)
+             if '/macros/' in path])
+
+        return macro_db
+
+    def assert_same_macros(self, macro_db, expected_db):
+        """Checks that two MacroDB loaded the same macros in the same
+        order.
+        """
+        self.assertEqual(list(macro_db.macros), list(expected_db.macros))
+        self.assertEqual(macro_db.macros_by_type, expected_db.macros_by_type)
+        self.assertEqual(macro_db.dependencies, expected_db.dependencies)
+
+        for (name, macro) in expected_db.macros.items():
+            self.assertEqual(macro_db.macros[name].type, macro.type)
+            self.assertEqual(macro_db.macros[name].connections,
+                             macro.connections)
+            self.assertEqual(macro_db.macros[name].properties,
+                             macro.properties)
+
+    def test_fork(self):
+        """Forked workers parse the same macros as this process."""
+        with mock.patch.object(macros, 'ProcessPoolExecutor',
+                               wraps=macros.ProcessPoolExecutor) as pool:
+            macro_db = self.load(4)
+
+        self.assertTrue(pool.called)
+        self.assert_same_macros(macro_db, self.load(1))
+
+    def test_pool_failure(self):
+        """Game files are parsed in this process if the pool can't start."""
+        serial_db = self.load(1)
+
+        with mock.patch.object(macros, 'ProcessPoolExecutor',
+                               side_effect=OSError('no processes')), \
+                self.assertLogs(macros.LOG, 'WARNING'):
+            macro_db = self.load(4)
+
+        self.assert_same_macros(macro_db, serial_db)
+
+
+class TestSpawnedWorkers(unittest.TestCase):
+    """Tests of MacroDB with spawned worker processes, which read game files
+    through an exported cat index.
+    """
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        write_game_cat(self.tmp_dir.name)
+        self.saved = (macros.WORKER_START_METHOD, macros.MIN_PARALLEL_FILES)
+        macros.WORKER_START_METHOD = 'spawn'
+        macros.MIN_PARALLEL_FILES = 1
+
+    def tearDown(self):
+        (macros.WORKER_START_METHOD, macros.MIN_PARALLEL_FILES) = self.saved
+        self.tmp_dir.cleanup()
+
+    def load(self, workers):
+        """Loads the ship and its dependencies. Returns the MacroDB and the
+        file loader counters before and after loading.
+        """
+        floader = file_loaders.CatFileLoader(self.tmp_dir.name)
+        floader.load_from_game_root()
+
+        macro_db = macros.MacroDB(floader, workers=workers)
+        macro_db.set_macro_parser(macro_parser)
+        macro_db.set_component_parser(component_parser)
+
+        before = dict(floader.get_stats()['counters'])
+        macro_db.load_macro_xml_files(
+            ['assets/units/macros/ship_macro.xml',
+             'assets/props/macros/engine_macro.xml'])
+        after = dict(floader.get_stats()['counters'])
+
+        return macro_db, before, after
+
+    def test_spawn(self):
+        """Spawned workers parse the same macros and read the game files
+        themselves.
+        """
+        (serial_db, _, _) = self.load(1)
+        (spawn_db, before, after) = self.load(2)
+
+        self.assertIsNotNone(spawn_db.worker_index)
+        for counter in ['file_lookups', 'files_opened', 'bytes_read']:
+            self.assertEqual(before.get(counter), after.get(counter), counter)
+
+        for (name, macro) in serial_db.macros.items():
+            spawned = spawn_db.macros[name]
+            self.assertEqual(spawned.connections, macro.connections)
+            self.assertEqual(spawned.properties, macro.properties)
+        self.assertEqual(
+            spawn_db.macros['engine_macro'].properties['children'],
+            ['layers', 'connections'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests of the ware loader."""
+
+import importlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+import file_loaders
+import lang
+
+# the loaders package exports the ware_loader function under the name of its
+# module
+ware_loader = importlib.import_module('loaders.ware_loader')
+
+
+WARES = b'''<?xml version="1.0"?>
+<wares>
+<ware id="energycells" name="{20201,101}" transport="container" volume="6"
+      tags="economy container">
+<price min="10" average="16" max="22"/>
+<production time="60" amount="175" method="default" name="{20206,101}"/>
+<owner faction="argon"/>
+</ware>
+<ware id="hullparts" name="{20201,201}" transport="container" volume="12"
+      tags="economy" illegal="paranid">
+<price min="150" average="200" max="250"/>
+<production time="300" amount="20" method="default" name="{20206,101}">
+<primary>
+<ware ware="energycells" amount="80"/>
+<ware ware="graphene" amount="4"/>
+</primary>
+</production>
+<restriction licence="generaluseequipment"/>
+<owner faction="argon"/>
+<owner faction="teladi"/>
+</ware>
+<ware id="graphene" name="Graphene" transport="container" volume="20">
+<price min="60" average="80" max="100"/>
+</ware>
+</wares>'''
+
+LANGUAGE = b'''<?xml version="1.0"?>
+<language id="44">
+<page id="20201">
+<t id="101">Energy Cells</t>
+<t id="201"> Hull Parts </t>
+</page>
+<page id="20206">
+<t id="101">Universal</t>
+</page>
+</language>'''
+
+
+class TestIterWares(unittest.TestCase):
+    """Tests of iter_wares."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        for path in ['libraries/wares.xml',
+                     'extensions/ego_dlc_test/libraries/wares.xml']:
+            fs_path = os.path.join(self.tmp_dir.name, path)
+            os.makedirs(os.path.dirname(fs_path))
+            with open(fs_path, 'wb') as wares_file:
+                wares_file.write(WARES)
+
+        self.floader = file_loaders.FSFileLoader(self.tmp_dir.name)
+        self.lresolver = lang.LanguageResolver()
+        self.lresolver.load_lang_file('english', LANGUAGE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_wares(self):
+        """Streamed wares match the wares parsed from the whole tree."""
+        root = etree.fromstring(WARES)
+        expected = [(ware.get('id'),
+                     ware_loader.parse_ware(ware, self.lresolver))
+                    for ware in root.iterfind('./ware')]
+
+        for ext_name in [None, 'ego_dlc_test']:
+            self.assertEqual(list(ware_loader.iter_wares(
+                self.floader, self.lresolver, ext_name)), expected)
+
+        wares = ware_loader.ware_loader(self.floader, self.lresolver, None)
+        self.assertEqual(list(wares), ['energycells', 'hullparts',
+                                       'graphene'])
+        self.assertEqual(wares['hullparts']['name'], 'Hull Parts')
+        self.assertEqual(wares['hullparts']['production'][0]['consumption'],
+                         {'energycells': 80, 'graphene': 4})
+        self.assertEqual(wares['hullparts']['owners'], ['argon', 'teladi'])
+
+    def test_parsed_wares_freed(self):
+        """Wares are cleared once they were parsed, and removed from the tree
+        when the next ware is parsed.
+        """
+        previous = []
+        parse_ware = ware_loader.parse_ware
+
+        def checking_parse_ware(ware, lresolver):
+            previous.append([(len(node), dict(node.attrib))
+                             for node in ware.itersiblings(preceding=True)])
+            return parse_ware(ware, lresolver)
+
+        with mock.patch.object(ware_loader, 'parse_ware',
+                               checking_parse_ware):
+            wares = ware_loader.iter_wares(self.floader, self.lresolver, None)
+            self.assertEqual([ware_id for (ware_id, _) in wares],
+                             ['energycells', 'hullparts', 'graphene'])
+
+        self.assertEqual(previous, [[], [(0, {})], [(0, {})]])
+
+if __name__ == '__main__':
+    unittest.main()